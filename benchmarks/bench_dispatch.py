@@ -0,0 +1,108 @@
+"""Mede o custo por mensagem de achar o handler de um botão do teclado.
+
+Uso: python benchmarks/bench_dispatch.py [mensagens]
+
+Compara, com os handlers reais do python-telegram-bot e sem rede:
+  regex   os entry points antigos (um MessageHandler com filters.Regex por
+          botão, testados em ordem) seguidos da lista botoes_especiais e da
+          cadeia de if/elif de handle_search_product_input;
+  tabela  o entry point único com main.FILTRO_BOTOES_MENU seguido do lookup
+          em main.ROTAS_BOTOES, como despachar_botao faz.
+As mensagens misturam botões e texto livre de pesquisa (o caso mais caro para
+os regex, que testam todos antes de desistir). A última coluna é a fração de
+um núcleo gasta só com o roteamento a 1000 mensagens/s.
+"""
+import os
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123:bench",
+    "SUPABASE_URL": "https://bench.supabase.co",
+    "SUPABASE_KEY": "bench",
+    "WEBHOOK_DOMAIN": "https://bench.invalid",
+})
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import MessageHandler, filters  # noqa: E402
+
+TEXTOS = sorted(main.BOTOES_ESPECIAIS) + [" ❌ Cancelar", "arroz", "feijão carioca 1kg", "coca cola 2l", "sabão em pó"]
+
+def gerar_updates(total: int) -> list:
+    return [
+        Update.de_json({
+            "update_id": i,
+            "message": {
+                "message_id": i, "date": 0, "text": TEXTOS[i % len(TEXTOS)],
+                "chat": {"id": 1, "type": "private"},
+                "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+            },
+        }, None)
+        for i in range(total)
+    ]
+
+def _nada(update, context):
+    return None
+
+ENTRADAS_REGEX = [
+    MessageHandler(filters.Regex(f"^{texto}$"), _nada)
+    for texto in ("➕ Adicionar Produto", "✏️ Editar ou Excluir", "📋 Listar Produtos", "🔍 Pesquisar Produto", "ℹ️ Ajuda")
+]
+ENTRADA_TABELA = MessageHandler(main.FILTRO_BOTOES_MENU, _nada)
+
+def rotear_regex(update: Update):
+    for handler in ENTRADAS_REGEX:
+        if handler.check_update(update):
+            return handler.callback
+    if update.message.text == "❌ Cancelar":
+        return main.cancel
+    botoes_especiais = [
+        "➕ Adicionar Produto", "✏️ Editar ou Excluir", "📋 Listar Produtos",
+        "🔍 Pesquisar Produto", "ℹ️ Ajuda", "❌ Cancelar",
+        "👪 Compartilhar Lista", "🔐 Inserir Código", "✅ Confirmar"
+    ]
+    if update.message.text.strip() in botoes_especiais:
+        text = update.message.text.strip()
+        if text == "➕ Adicionar Produto":
+            return main.ask_for_product_data
+        elif text == "📋 Listar Produtos":
+            return main.list_products
+        elif text == "🔍 Pesquisar Produto":
+            return main.search_product_input
+        elif text == "ℹ️ Ajuda":
+            return main.help_command
+        elif text == "👪 Compartilhar Lista":
+            return main.compartilhar_lista_callback
+        elif text == "🔐 Inserir Código":
+            return main.ask_for_invite_code
+        elif text == "✏️ Editar ou Excluir":
+            return main.ask_for_edit_delete_choice
+    return None
+
+def rotear_tabela(update: Update):
+    if ENTRADA_TABELA.check_update(update):
+        return ENTRADA_TABELA.callback
+    if update.message.text == "❌ Cancelar":
+        return main.cancel
+    text = update.message.text.strip()
+    if text in main.BOTOES_ESPECIAIS:
+        return main.ROTAS_BOTOES.get(text)
+    return None
+
+def medir(rotear, updates: list) -> float:
+    inicio = time.perf_counter()
+    for update in updates:
+        rotear(update)
+    return (time.perf_counter() - inicio) / len(updates) * 1e6
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    updates = gerar_updates(total)
+    for update in updates[:len(TEXTOS)]:
+        assert rotear_regex(update) == rotear_tabela(update), update.message.text
+    for nome, rotear in (("regex", rotear_regex), ("tabela", rotear_tabela)):
+        us = min(medir(rotear, updates) for _ in range(3))
+        print(f"{nome:7s} {us:6.2f} µs/mensagem  ({us * 1000 / 1e6:.2%} de um núcleo a 1k msgs/s)")
@@ -0,0 +1,147 @@
+"""Compara a vazão de entrega de updates: webhook x long polling em lote.
+
+Uso: python benchmarks/bench_polling.py [updates] [chats] [ms_por_handler]
+
+Nenhuma conexão é feita: o bot é trocado por um falso cujo getUpdates devolve
+lotes de main.POLLING_LIMITE updates simulados, e o process_update só espera
+ms_por_handler (simulando a ida ao Supabase/Telegram). Cenários:
+  webhook        POST /webhook pelo cliente de teste do Flask, um por vez,
+                 agendado no loop do bot como em produção;
+  polling        consumir_updates_polling(), com os updates de chats diferentes
+                 em paralelo e os de cada chat em ordem;
+  polling serial o mesmo getUpdates em lote, mas processando um update por vez
+                 (o comportamento padrão do Updater do python-telegram-bot).
+Ao fim de cada cenário confere que nenhum chat recebeu updates fora de ordem.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123:bench",
+    "SUPABASE_URL": "https://bench.supabase.co",
+    "SUPABASE_KEY": "bench",
+    "WEBHOOK_DOMAIN": "https://bench.invalid",
+    # As cotas por usuário recusariam a carga sintética
+    "COTA_USUARIO_TAXA": "1000000", "COTA_USUARIO_RAJADA": "1000000",
+    "COTA_GRUPO_TAXA": "1000000", "COTA_GRUPO_RAJADA": "1000000",
+})
+
+import logging  # noqa: E402
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+def gerar_updates(total: int, chats: int, base: int) -> list:
+    return [
+        {
+            "update_id": base + i,
+            "message": {
+                "message_id": i, "date": 0, "text": "/lista",
+                "chat": {"id": 1000 + i % chats, "type": "private"},
+                "from": {"id": 1000 + i % chats, "is_bot": False, "first_name": "bench"},
+            },
+        }
+        for i in range(total)
+    ]
+
+class BotFalso:
+    def __init__(self, dados: list):
+        self.pendentes = list(dados)
+
+    async def get_updates(self, offset=None, limit=100, timeout=0, allowed_updates=None):
+        if offset is not None:
+            self.pendentes = [d for d in self.pendentes if d["update_id"] >= offset]
+        if not self.pendentes:
+            await asyncio.sleep(min(timeout, 0.05))
+            return []
+        return [Update.de_json(d, self) for d in self.pendentes[:limit]]
+
+class AplicacaoFalsa:
+    def __init__(self, dados: list, atraso: float):
+        self.bot = BotFalso(dados)
+        self.atraso = atraso
+        self.total = len(dados)
+        self.ordem = defaultdict(list)
+        self.pronto = asyncio.Event()
+
+    async def process_update(self, update: Update):
+        await asyncio.sleep(self.atraso)
+        self.ordem[update.effective_chat.id].append(update.update_id)
+        if sum(map(len, self.ordem.values())) == self.total:
+            self.pronto.set()
+
+    def fora_de_ordem(self) -> int:
+        return sum(ids != sorted(ids) for ids in self.ordem.values())
+
+async def _grupo_do_proprio_usuario(user_id):
+    return user_id
+
+def preparar(dados: list, atraso: float) -> AplicacaoFalsa:
+    aplicacao = AplicacaoFalsa(dados, atraso)
+    main.bot_application = aplicacao
+    main.aceitando_updates = True
+    main.bot_pronto = True
+    main._offset_polling = None
+    main.get_grupo_id = _grupo_do_proprio_usuario
+    return aplicacao
+
+async def cenario_polling(dados: list, atraso: float) -> tuple:
+    aplicacao = preparar(dados, atraso)
+    inicio = time.perf_counter()
+    main._tarefa_polling = asyncio.create_task(main.consumir_updates_polling())
+    await aplicacao.pronto.wait()
+    duracao = time.perf_counter() - inicio
+    main.aceitando_updates = False
+    await main.parar_polling()
+    main._tarefa_polling = None
+    return duracao, aplicacao.fora_de_ordem()
+
+async def cenario_polling_serial(dados: list, atraso: float) -> tuple:
+    aplicacao = preparar(dados, atraso)
+    inicio = time.perf_counter()
+    offset = None
+    while not aplicacao.pronto.is_set():
+        for update in await aplicacao.bot.get_updates(offset, limit=main.POLLING_LIMITE, timeout=0):
+            offset = update.update_id + 1
+            await main.processar_update(update)
+    return time.perf_counter() - inicio, aplicacao.fora_de_ordem()
+
+def cenario_webhook(dados: list, atraso: float) -> tuple:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    aplicacao = asyncio.run_coroutine_threadsafe(_criar_no_loop(dados, atraso), loop).result()
+    main.bot_event_loop = loop
+    cliente = main.app.test_client()
+    inicio = time.perf_counter()
+    for d in dados:
+        cliente.post("/webhook", json=d)
+    asyncio.run_coroutine_threadsafe(aplicacao.pronto.wait(), loop).result()
+    duracao = time.perf_counter() - inicio
+    loop.call_soon_threadsafe(loop.stop)
+    return duracao, aplicacao.fora_de_ordem()
+
+async def _criar_no_loop(dados: list, atraso: float) -> AplicacaoFalsa:
+    return preparar(dados, atraso)
+
+if __name__ == "__main__":
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    chats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    atraso = (float(sys.argv[3]) if len(sys.argv) > 3 else 20) / 1000
+    print(f"{total} updates, {chats} chats, {atraso * 1000:g} ms por handler, lotes de {main.POLLING_LIMITE}")
+    cenarios = [
+        ("webhook", lambda base: cenario_webhook(gerar_updates(total, chats, base), atraso)),
+        ("polling", lambda base: asyncio.run(cenario_polling(gerar_updates(total, chats, base), atraso))),
+        ("polling serial", lambda base: asyncio.run(cenario_polling_serial(gerar_updates(total, chats, base), atraso))),
+    ]
+    for n, (nome, rodar) in enumerate(cenarios):
+        # update_ids distintos por cenário: a deduplicação é global ao processo
+        duracao, fora = rodar(10_000_000 * (n + 1))
+        print(f"{nome:15s} {total / duracao:9.0f} updates/s  ({duracao:.2f}s, chats fora de ordem: {fora})")
@@ -0,0 +1,50 @@
+"""Mede o cold start do bot: tempo para importar main.py num interpretador novo.
+
+Uso: python benchmarks/bench_startup.py [repetições]
+
+Cada rodada sobe um processo Python limpo com variáveis de ambiente fictícias
+(nenhuma conexão é feita no import) e mede o tempo até o módulo estar pronto
+para o Flask servir /healthz e guardar updates. A linha "eager" importa também
+o pacote supabase, como o boot fazia antes de obter_supabase() ser preguiçoso.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AMBIENTE = {
+    **os.environ,
+    "TELEGRAM_BOT_TOKEN": "123:bench",
+    "SUPABASE_URL": "https://bench.supabase.co",
+    "SUPABASE_KEY": "bench",
+    "WEBHOOK_DOMAIN": "https://bench.invalid",
+}
+
+CENARIOS = {
+    "lazy": "import main",
+    "eager": "import main, supabase; main.obter_supabase()",
+}
+
+def medir(codigo: str) -> float:
+    script = (
+        "import time; t = time.perf_counter(); "
+        f"{codigo}; "
+        "print((time.perf_counter() - t) * 1000)"
+    )
+    saida = subprocess.run(
+        [sys.executable, "-c", script], cwd=RAIZ, env=AMBIENTE,
+        capture_output=True, text=True, check=True,
+    )
+    return float(saida.stdout.strip().splitlines()[-1])
+
+def main():
+    repeticoes = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    medir(CENARIOS["lazy"])  # aquece o cache de bytecode
+    for nome, codigo in CENARIOS.items():
+        amostras = [medir(codigo) for _ in range(repeticoes)]
+        print(f"{nome:>6}: mediana {statistics.median(amostras):7.1f} ms | "
+              f"mín {min(amostras):7.1f} ms | máx {max(amostras):7.1f} ms ({repeticoes} rodadas)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Renderização dos gráficos do /grafico.
+
+Roda como processo à parte (python graficos.py), iniciado por
+main.renderizar_em_processo. O script não importa main.py: o matplotlib (pesado)
+é carregado só nesses processos, e eles não repetem a inicialização do bot.
+"""
+import json
+import sys
+from datetime import datetime
+from io import BytesIO
+
+
+def renderizar_grafico_precos(titulo: str, series: dict, unidade_base: str) -> bytes:
+    """PNG com uma linha por série; series: rótulo -> (datas ISO, preços por unidade base)."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(8, 4.5), dpi=100)
+    try:
+        for rotulo, (datas, valores) in series.items():
+            # O preço vale até a próxima alteração: degraus, e não retas entre os pontos
+            ax.plot([datetime.fromisoformat(data) for data in datas], valores,
+                    drawstyle="steps-post", marker="o", markersize=3, linewidth=1.5, label=rotulo)
+        ax.set_title(titulo)
+        ax.set_ylabel(f"R$ / {unidade_base}")
+        ax.yaxis.set_major_formatter(lambda valor, _: f"R$ {valor:.2f}".replace(".", ","))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter("%d/%m/%y"))
+        ax.grid(alpha=0.3)
+        if len(series) > 1:
+            ax.legend(fontsize=8)
+        fig.autofmt_xdate()
+        fig.tight_layout()
+        buffer = BytesIO()
+        fig.savefig(buffer, format="png")
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+def servir():
+    """Atende pedidos até o EOF no stdin.
+
+    Cada pedido é uma linha JSON {"titulo", "series", "unidade_base"}; cada
+    resposta é 1 byte de status (0 = PNG, 1 = mensagem de erro), 4 bytes de
+    tamanho (big-endian) e o corpo.
+    """
+    entrada, saida = sys.stdin.buffer, sys.stdout.buffer
+    for linha in entrada:
+        try:
+            pedido = json.loads(linha)
+            status, corpo = 0, renderizar_grafico_precos(pedido["titulo"], pedido["series"], pedido["unidade_base"])
+        except Exception as e:
+            status, corpo = 1, repr(e).encode()
+        saida.write(bytes([status]) + len(corpo).to_bytes(4, "big") + corpo)
+        saida.flush()
+
+
+if __name__ == "__main__":
+    servir()
@@ -1,13 +1,40 @@
+from __future__ import annotations
+
+import time
+
+_inicio_processo = time.perf_counter()  # Marco zero para medir o cold start
+
 import asyncio
+import atexit
+import contextvars
+import hashlib
+import hmac
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import re
-from threading import Thread
+import signal
+import sqlite3
+from collections import Counter, OrderedDict, deque
+from threading import Lock, Thread
+import sys
+import threading
+import unicodedata
 import uuid
-from typing import Optional  # Adicionado para melhor tipagem, se desejar
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+from inspect import iscoroutinefunction
+from io import BytesIO
+from typing import TYPE_CHECKING, Optional  # Adicionado para melhor tipagem, se desejar
 
 # Flask
-from flask import Flask, request
+from flask import Flask, jsonify, request
 
 from telegram import (
     Update,
@@ -15,7 +42,10 @@ from telegram import (
     KeyboardButton,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
 )
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -23,9 +53,13 @@ from telegram.ext import (
     ConversationHandler,
     ContextTypes,
     filters,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    InlineQueryHandler,
 )
-from supabase import create_client, Client
+
+if TYPE_CHECKING:
+    # O pacote supabase é o import mais pesado do boot; ele só é carregado em obter_supabase()
+    from supabase import Client
 
 # ========================
 # Configuração Flask
@@ -40,6 +74,15 @@ def health_check():
 def home():
     return "🛒 Bot de Compras está no ar!", 200
 
+@app.route("/metrics")
+def metrics():
+    return jsonify({
+        **metricas,
+        "inicializacao_ms": tempos_inicializacao,
+        "carga_grupos": resumo_carga_grupos(),
+        "replica_diario_pendente": _replica.pendencias() if _replica is not None else None,
+    }), 200
+
 # ========================
 # Configurações Bot / Supabase
 # ========================
@@ -47,13 +90,68 @@ TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 WEBHOOK_DOMAIN = os.environ.get("WEBHOOK_DOMAIN")  # Ex: https://bot-mercado.onrender.com
+# Long polling em vez de webhook: python main.py --polling (ou BOT_MODO=polling); dispensa domínio público
+MODO_POLLING = "--polling" in sys.argv or os.environ.get("BOT_MODO", "").lower() == "polling"
+POLLING_LIMITE = 100  # Updates por getUpdates (máximo da API)
+POLLING_TIMEOUT = 50  # Segundos que o getUpdates espera por updates novos
+POLLING_MAX_EM_ANDAMENTO = int(os.environ.get("POLLING_MAX_EM_ANDAMENTO", 1000))  # Updates despachados e não concluídos antes de parar de buscar
+GRUPO_CACHE_TTL = float(os.environ.get("GRUPO_CACHE_TTL", 300))  # Segundos que o grupo de um usuário fica em memória
+INLINE_CACHE_TTL = float(os.environ.get("INLINE_CACHE_TTL", 30))  # Validade dos resultados da consulta inline
+INLINE_DEBOUNCE = float(os.environ.get("INLINE_DEBOUNCE", 0.35))  # Espera por novas teclas antes de consultar
+INLINE_MAX_RESULTADOS = 50  # Limite do Telegram por resposta inline
+NFCE_MAX_BYTES = int(os.environ.get("NFCE_MAX_BYTES", 5 * 1024 * 1024))  # Tamanho máximo do XML aceito em /nota
+NFCE_LOTE = 100  # Produtos por requisição ao gravar os itens de uma nota
+GRAFICO_PROCESSOS = int(os.environ.get("GRAFICO_PROCESSOS", 1))  # Processos que renderizam os gráficos do /grafico
+GRAFICO_MAX_PONTOS = 500  # Pontos de histórico mais recentes usados num gráfico
+GRAFICO_MAX_SERIES = 6  # Linhas (produto + marca) por gráfico
+GRAFICO_CACHE_MAX = 500  # Gráficos (file_id do Telegram) guardados em memória
+LISTA_MAX_ITENS = int(os.environ.get("LISTA_MAX_ITENS", 50))  # Itens aceitos por /lista (todos numa única consulta)
+UPDATES_INICIAIS_MAX = int(os.environ.get("UPDATES_INICIAIS_MAX", 500))  # Updates guardados enquanto o bot inicializa
+PRAZO_ENCERRAMENTO = float(os.environ.get("PRAZO_ENCERRAMENTO", 25))  # Segundos para drenar updates no shutdown
+DEDUP_MAX_IDS = int(os.environ.get("DEDUP_MAX_IDS", 10000))  # Quantos update_id recentes lembrar
+DEDUP_SUPABASE = os.environ.get("DEDUP_SUPABASE", "").lower() in ("1", "true", "sim")  # Compartilha a deduplicação entre réplicas
+ADMIN_USER_IDS = frozenset(int(i) for i in os.environ.get("ADMIN_USER_IDS", "").replace(",", " ").split())  # Quem pode usar /trace
+TRACE_UPDATES = int(os.environ.get("TRACE_UPDATES", 0))  # Rastreia os próximos N updates já no boot
+TRACE_CHAT_ID = int(os.environ["TRACE_CHAT_ID"]) if os.environ.get("TRACE_CHAT_ID") else None  # ...só deste chat
+TRACE_DIR = os.environ.get("TRACE_DIR", "traces")  # Onde os arquivos de rastro são gravados
+COTA_USUARIO_TAXA = float(os.environ.get("COTA_USUARIO_TAXA", 1))  # Updates/s por usuário, em média
+COTA_USUARIO_RAJADA = int(os.environ.get("COTA_USUARIO_RAJADA", 10))  # ...com rajadas de até N seguidos
+COTA_GRUPO_TAXA = float(os.environ.get("COTA_GRUPO_TAXA", 5))  # Updates/s somando todos os membros de um grupo
+COTA_GRUPO_RAJADA = int(os.environ.get("COTA_GRUPO_RAJADA", 40))
+GRUPO_MAX_CONCORRENTES = int(os.environ.get("GRUPO_MAX_CONCORRENTES", 4))  # Updates de um grupo processados ao mesmo tempo
+GRUPO_MAX_FILA = int(os.environ.get("GRUPO_MAX_FILA", 20))  # Updates de um grupo esperando vaga antes de recusar
+REPLICA_LOCAL = os.environ.get("REPLICA_LOCAL")  # Caminho do SQLite local; vazio = ler e gravar direto no Supabase
+REPLICA_SYNC_INTERVALO = float(os.environ.get("REPLICA_SYNC_INTERVALO", 2))  # Segundos entre envios do diário
+REPLICA_ATUALIZACAO = float(os.environ.get("REPLICA_ATUALIZACAO", 60))  # Segundos entre buscas de alterações remotas
+REPLICA_RECARGA = float(os.environ.get("REPLICA_RECARGA", 3600))  # Segundos até recarregar um grupo inteiro
+REPLICA_LOTE = 200  # Escritas do diário por envio
+REPLICA_BACKOFF_MAX = 300  # Espera máxima entre novas tentativas de envio
+USER_DATA_TTL = float(os.environ.get("USER_DATA_TTL", 1800))  # Segundos sem mensagens até descartar o user_data
+USER_DATA_VARREDURA = float(os.environ.get("USER_DATA_VARREDURA", 300))  # Intervalo da varredura de user_data inativo
 
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("SUPABASE_URL e SUPABASE_KEY devem ser definidos nas variáveis de ambiente.")
-if not WEBHOOK_DOMAIN:
-    raise ValueError("WEBHOOK_DOMAIN deve ser definido (ex: https://bot-mercado.onrender.com)")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+if not WEBHOOK_DOMAIN and not MODO_POLLING:
+    raise ValueError("WEBHOOK_DOMAIN deve ser definido (ex: https://bot-mercado.onrender.com) ou use --polling")
+
+_supabase: Optional[Client] = None
+_supabase_lock = Lock()
+
+def obter_supabase() -> Client:
+    """Cria o cliente Supabase no primeiro uso (start_bot já o aquece em paralelo)."""
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                import httpx
+                from supabase import ClientOptions, create_client
+                # Mesmas opções do cliente padrão do PostgREST, mais os ganchos do /trace
+                cliente_http = httpx.Client(
+                    timeout=120, follow_redirects=True, http2=True,
+                    event_hooks={"request": [_inicio_requisicao_rastreada], "response": [_fim_requisicao_rastreada]},
+                )
+                _supabase = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=cliente_http))
+    return _supabase
 
 # ========================
 # Estados ConversationHandler (ajuste conforme seu código)
@@ -70,16 +168,224 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
     AWAIT_ENTRY_CHOICE, # Estado para esperar o número do produto na edição/exclusão
     AWAIT_ACTION_CHOICE, # <--- NOVO: Estado para esperar o clique em Editar/Excluir
     AWAIT_INVITE_CODE,
-    AWAIT_INVITE_CODE_INPUT
-) = range(12) # Ajuste o range para 12 pois adicionamos um novo estado
+    AWAIT_INVITE_CODE_INPUT,
+    AWAIT_SHOPPING_LIST, # Estado para esperar os itens do /lista
+    CONFIRM_BULK_DELETION, # Confirmação da exclusão de vários produtos
+    AWAIT_BULK_PRICES, # Estado para esperar os novos preços da edição em lote
+    AWAIT_NFCE_DOCUMENT, # Estado para esperar o XML da NFC-e (/nota)
+    CONFIRM_NFCE, # Confirmação dos itens lidos da NFC-e
+) = range(17) # Ajuste o range sempre que adicionar um novo estado
 
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+# ========================
+# Logging
+# ========================
+# Os handlers só enfileiram o LogRecord; formatação e escrita acontecem numa thread
+# separada (QueueListener), fora do event loop. As chamadas passam os valores como
+# argumentos ("... %s", valor), nunca em f-string: assim a mensagem só é montada se
+# o registro passar do nível configurado.
+LOG_AMOSTRA_VERBOSO = float(os.getenv("LOG_AMOSTRA_VERBOSO", "0.01"))  # Fração dos registros verbosos mantida
+
+# Contexto do update em andamento, preenchido em processar_update e get_grupo_id
+_log_update_id = contextvars.ContextVar("log_update_id", default=None)
+_log_grupo_id = contextvars.ContextVar("log_grupo_id", default=None)
+
+class FiltroContextoLog(logging.Filter):
+    """Copia o contexto para o registro ainda na thread/tarefa que gerou o log."""
+    def filter(self, record):
+        record.update_id = _log_update_id.get()
+        record.grupo_id = _log_grupo_id.get()
+        return True
+
+class FilaLogHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # O QueueHandler padrão formata a mensagem aqui, no event loop. Como a fila
+        # é do mesmo processo, o registro segue intacto e o listener formata depois.
+        return record
+
+class FormatadorJson(logging.Formatter):
+    def format(self, record):
+        registro = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "handler": record.funcName,
+            "update_id": getattr(record, "update_id", None),
+            "grupo_id": getattr(record, "grupo_id", None),
+        }
+        if hasattr(record, "duration_ms"):
+            registro["duration_ms"] = record.duration_ms
+        if record.exc_info:
+            registro["exc"] = self.formatException(record.exc_info)
+        return json.dumps(registro, ensure_ascii=False, default=str)
+
+def configurar_logging(nivel=logging.INFO):
+    fila = queue.SimpleQueue()
+    saida = logging.StreamHandler(sys.stderr)
+    saida.setFormatter(FormatadorJson())
+    ouvinte = logging.handlers.QueueListener(fila, saida, respect_handler_level=True)
+    handler_fila = FilaLogHandler(fila)
+    handler_fila.addFilter(FiltroContextoLog())
+    raiz = logging.getLogger()
+    raiz.handlers[:] = [handler_fila]
+    raiz.setLevel(nivel)
+    ouvinte.start()
+    # atexit e não um gancho de encerramento: os logs do próprio shutdown também precisam sair
+    atexit.register(ouvinte.stop)
+    return ouvinte
+
+def log_verboso(mensagem, *args):
+    """Registros volumosos (ex.: respostas inteiras do Supabase) saem só numa amostra.
+
+    O sorteio vem antes de criar o LogRecord, e os argumentos só são formatados se
+    o registro for mantido."""
+    if random.random() < LOG_AMOSTRA_VERBOSO:
+        logging.info(mensagem, *args, stacklevel=2)
+
+_ouvinte_log = configurar_logging()
+
+# ========================
+# Rastreamento por update (/trace)
+# ========================
+# Desligado por padrão. Um administrador liga para os próximos N updates (de todos
+# os chats ou de um só) com /trace ou TRACE_UPDATES/TRACE_CHAT_ID. Cada update
+# rastreado vira um arquivo no formato Chrome trace em TRACE_DIR, que abre em
+# chrome://tracing, ui.perfetto.dev ou speedscope. Fora do rastreamento, cada
+# ponto instrumentado custa só a leitura de um contextvar.
+_rastreio = {"restantes": TRACE_UPDATES, "chat_id": TRACE_CHAT_ID}
+_rastro_atual = contextvars.ContextVar("rastro_atual", default=None)
+
+class Rastro:
+    __slots__ = ("update_id", "inicio", "eventos", "requisicoes")
+
+    def __init__(self, update_id):
+        self.update_id = update_id
+        self.inicio = time.perf_counter()
+        self.eventos = []
+        self.requisicoes = {}  # id(httpx.Request) -> início, até a resposta chegar
+
+    def registrar(self, nome, categoria, inicio, fim, **args):
+        self.eventos.append({
+            "name": nome, "cat": categoria, "ph": "X",
+            "ts": round((inicio - self.inicio) * 1e6, 1), "dur": round((fim - inicio) * 1e6, 1),
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": args,
+        })
+
+    def gravar(self):
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        caminho = os.path.join(TRACE_DIR, f"update_{self.update_id}_{int(time.time())}.json")
+        with open(caminho, "w", encoding="utf-8") as arquivo:
+            json.dump({"traceEvents": self.eventos, "displayTimeUnit": "ms"}, arquivo, default=str)
+        return caminho
+
+def deve_rastrear(update) -> bool:
+    if _rastreio["restantes"] <= 0:
+        return False
+    chat_id = _rastreio["chat_id"]
+    if chat_id is not None and (update.effective_chat is None or update.effective_chat.id != chat_id):
+        return False
+    _rastreio["restantes"] -= 1
+    return True
+
+@contextmanager
+def span(nome, categoria, **args):
+    rastro = _rastro_atual.get()
+    if rastro is None:
+        yield
+        return
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        rastro.registrar(nome, categoria, inicio, time.perf_counter(), **args)
+
+def rastreado(categoria):
+    """Decorator: registra cada chamada da função (sync ou async) como um span."""
+    def decorar(funcao):
+        if iscoroutinefunction(funcao):
+            @wraps(funcao)
+            async def envolver_async(*args, **kwargs):
+                with span(funcao.__name__, categoria):
+                    return await funcao(*args, **kwargs)
+            return envolver_async
+
+        @wraps(funcao)
+        def envolver(*args, **kwargs):
+            with span(funcao.__name__, categoria):
+                return funcao(*args, **kwargs)
+        return envolver
+    return decorar
+
+def instrumentar_handlers(application):
+    """Envolve o callback de cada handler registrado (inclusive os do ConversationHandler) num span."""
+    pendentes = [h for grupo in application.handlers.values() for h in grupo]
+    while pendentes:
+        handler = pendentes.pop()
+        if isinstance(handler, ConversationHandler):
+            pendentes.extend(handler.entry_points)
+            pendentes.extend(h for estado in handler.states.values() for h in estado)
+            pendentes.extend(handler.fallbacks)
+        elif not getattr(handler.callback, "_rastreado", False):
+            handler.callback = rastreado("handler")(handler.callback)
+            handler.callback._rastreado = True
+
+# Ganchos do httpx.Client do Supabase (ver obter_supabase)
+def _inicio_requisicao_rastreada(requisicao):
+    rastro = _rastro_atual.get()
+    if rastro is not None:
+        rastro.requisicoes[id(requisicao)] = time.perf_counter()
+
+def _fim_requisicao_rastreada(resposta):
+    rastro = _rastro_atual.get()
+    if rastro is None:
+        return
+    inicio = rastro.requisicoes.pop(id(resposta.request), None)
+    if inicio is not None:
+        requisicao = resposta.request
+        rastro.registrar(f"{requisicao.method} {requisicao.url.path}", "supabase", inicio, time.perf_counter(),
+                         query=requisicao.url.query.decode(), status=resposta.status_code)
+
+class RequestRastreado(HTTPXRequest):
+    """HTTPXRequest que registra cada chamada à API do Telegram (sendMessage...) como um span."""
+    async def do_request(self, url, method, *args, **kwargs):
+        with span(url.rsplit("/", 1)[-1], "telegram"):
+            return await super().do_request(url, method, *args, **kwargs)
 
 # ========================
 # Variáveis Globais para o Loop e Application
 # ========================
 bot_application = None
 bot_event_loop = None
+bot_pronto = False  # Só vira True depois de initialize/start e do webhook configurado
+aceitando_updates = True  # Vira False no shutdown: o webhook devolve 503 e o Telegram reenvia a outra instância
+
+# Updates que chegaram antes do bot ficar pronto (JSON cru, processados em ordem no fim do start_bot)
+_updates_iniciais = deque()
+_prontidao_lock = Lock()
+
+# Futures de run_coroutine_threadsafe dos updates aceitos pelo webhook. O agendamento e
+# a virada de aceitando_updates acontecem sob o mesmo lock: ou o update é recusado com
+# 503, ou encerrar_bot espera por ele (mesmo que a tarefa ainda não tenha começado).
+_webhooks_agendados = set()
+_webhook_lock = Lock()
+
+# Tempos do boot em milissegundos, expostos em /metrics
+tempos_inicializacao = {}
+
+# Corrotinas sem argumentos executadas no shutdown, depois de drenar os updates
+# e antes de parar o bot_application (filas, caches, estado persistido...)
+_ganchos_encerramento = []
+
+def registrar_gancho_encerramento(gancho):
+    _ganchos_encerramento.append(gancho)
+    return gancho
+
+# Contadores expostos em /metrics
+metricas = {
+    "updates_recebidos": 0,
+    "updates_duplicados": 0,
+    "updates_recusados": 0,
+}
 
 # ========================
 # Funções Auxiliares
@@ -97,6 +403,11 @@ def parse_price(price_str):
     except ValueError:
         return None
 
+def preco_valido(preco) -> bool:
+    """Preço digitado pelo usuário: positivo e finito (rejeita 0, negativos, nan e inf)."""
+    return preco is not None and 0 < preco < float("inf")
+
+@rastreado("calculo")
 def calculate_unit_price(unit_str, price):
     unit_str_lower = unit_str.lower().strip()
     try:
@@ -179,38 +490,795 @@ def calculate_unit_price(unit_str, price):
 
     return {'preco_unitario': price, 'unidade': unit_str}
 
+# Grafias de unidade aceitas -> forma canônica, grudada na quantidade ("1 Litro" -> "1l")
+_UNIDADES_CANONICAS = {
+    "kg": "kg", "kgs": "kg", "kilo": "kg", "kilos": "kg", "quilo": "kg", "quilos": "kg",
+    "g": "g", "gr": "g", "grs": "g", "grama": "g", "gramas": "g",
+    "l": "l", "lt": "l", "lts": "l", "litro": "l", "litros": "l",
+    "ml": "ml", "m": "m", "mt": "m", "metro": "m", "metros": "m",
+    "un": "und", "und": "und", "unid": "und", "unidade": "und", "unidades": "und",
+}
+
+# Variações de grafia de nome/marca -> forma canônica. As chaves já estão sem acento
+# e em minúsculas (como saem do início de normalizar_campo_produto). Entram só
+# abreviações de várias palavras que não têm outra leitura: o resultado vai para
+# chave_produto, e uma regra ampla demais ("coca", "det", "refri" sozinhos) junta
+# produtos diferentes numa chave só e faz o compactar-produtos apagar linhas.
+SINONIMOS = {
+    "cocacola": "coca cola",
+    "papel hig": "papel higienico",
+    "pap higienico": "papel higienico",
+    "sab em po": "sabao em po",
+    "sabao po": "sabao em po",
+    "cr dental": "creme dental",
+    "leite cond": "leite condensado",
+    "oleo soja": "oleo de soja",
+}
+
+# Compilado uma vez: tupla de palavras -> palavras canônicas, para casar a frase mais longa
+_SINONIMOS_COMPILADOS = {tuple(chave.split()): tuple(valor.split()) for chave, valor in SINONIMOS.items()}
+_SINONIMO_MAX_PALAVRAS = max(len(chave) for chave in _SINONIMOS_COMPILADOS)
+
+def _aplicar_sinonimos(palavras: list) -> list:
+    resultado = []
+    i = 0
+    while i < len(palavras):
+        for tamanho in range(min(_SINONIMO_MAX_PALAVRAS, len(palavras) - i), 0, -1):
+            canonico = _SINONIMOS_COMPILADOS.get(tuple(palavras[i:i + tamanho]))
+            if canonico:
+                resultado.extend(canonico)
+                i += tamanho
+                break
+        else:
+            resultado.append(palavras[i])
+            i += 1
+    return resultado
+
+@lru_cache(maxsize=8192)
+def normalizar_campo_produto(texto) -> str:
+    """Forma normalizada de nome/tipo/marca/unidade, usada em chave_produto e em nome_normalizado.
+
+    Remove acentos, pontuação e maiúsculas, canoniza unidades ("1 Litro" -> "1l",
+    "1,5 L" -> "1.5l") e aplica SINONIMOS ("CocaCola" -> "coca cola")."""
+    texto = unicodedata.normalize("NFKD", str(texto or ""))
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    texto = re.sub(r"(\d),(\d)", r"\1.\2", texto)
+    texto = re.sub(r"(?<!\d)\.|\.(?!\d)|[^a-z0-9.]+", " ", texto)
+    texto = re.sub(
+        r"(\d+(?:\.\d+)?)\s*([a-z]+)\b",
+        lambda m: m.group(1) + _UNIDADES_CANONICAS[m.group(2)] if m.group(2) in _UNIDADES_CANONICAS else m.group(0),
+        texto,
+    )
+    return " ".join(_aplicar_sinonimos(texto.split()))
+
+def chave_produto(nome, tipo, marca, unidade) -> str:
+    """Identidade canônica de um produto dentro do grupo (base do índice único em produtos)."""
+    return "|".join(normalizar_campo_produto(campo) for campo in (nome, tipo, marca, unidade))
+
+def formatar_preco_unitario(unit_info, price) -> str:
+    """Texto gravado em preco_por_unidade_formatado, ex.: "R$ 5,20/kg"."""
+    if 'preco_por_metro' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_metro'])}/metro"
+    elif 'preco_por_100g' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_100g'])}/100g"
+    elif 'preco_por_kg' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_kg'])}/kg"
+    elif 'preco_por_100ml' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_100ml'])}/100ml"
+    elif 'preco_por_litro' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_litro'])}/L"
+    elif 'preco_por_unidade' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_unidade'])}/unidade"
+    elif 'preco_por_embalagem' in unit_info:
+        if 'preco_por_100' in unit_info:
+            return f"R$ {format_price(unit_info['preco_por_100'])}/100(g/ml)"
+        elif 'preco_por_100_base' in unit_info:
+            return f"R$ {format_price(unit_info['preco_por_100_base'])}/100(g/ml)"
+        else:
+            return f"R$ {format_price(unit_info['preco_por_embalagem'])}/embalagem"
+    elif 'preco_por_rolo' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_rolo'])}/rolo"
+    elif 'preco_por_folha' in unit_info:
+        return f"R$ {format_price(unit_info['preco_por_folha'])}/folha"
+    else:
+        return f"R$ {format_price(price)}/unidade"
+
+def preco_unitario_normalizado(unit_str, price):
+    """Reduz o resultado de calculate_unit_price a (valor, unidade_base) comparável entre
+    embalagens: kg, L, m, und, rolo ou folha. Retorna (None, None) se não houver preço."""
+    unit_info = calculate_unit_price(unit_str, price)
+    if 'preco_por_metro' in unit_info:
+        return unit_info['preco_por_metro'], "m"
+    if 'preco_por_kg' in unit_info:
+        return unit_info['preco_por_kg'], "kg"
+    if 'preco_por_100g' in unit_info:
+        return unit_info['preco_por_100g'] * 10, "kg"
+    if 'preco_por_litro' in unit_info:
+        return unit_info['preco_por_litro'], "L"
+    if 'preco_por_100ml' in unit_info:
+        return unit_info['preco_por_100ml'] * 10, "L"
+    if 'preco_por_embalagem' in unit_info:
+        # "3.0 tubos de 60.0g" -> a unidade de medida está no fim do texto
+        base = "L" if unit_info['unidade'].lower().endswith("l") else "kg"
+        if 'preco_por_100' in unit_info:
+            return unit_info['preco_por_100'] * 10, base
+        if 'preco_por_unidade_base' in unit_info:
+            return unit_info['preco_por_unidade_base'], base
+        return unit_info['preco_por_embalagem'], "und"
+    if 'preco_por_unidade' in unit_info:
+        return unit_info['preco_por_unidade'], "und"
+    if 'preco_por_rolo' in unit_info:
+        return unit_info['preco_por_rolo'], "rolo"
+    if 'preco_por_folha' in unit_info:
+        return unit_info['preco_por_folha'], "folha"
+    if isinstance(unit_info.get('preco_unitario'), (int, float)):
+        return float(unit_info['preco_unitario']), "und"
+    return None, None
+
 # ========================
 # Funções Supabase
 # ========================
+# user_id -> (grupo_id, expira_em); evita uma consulta a usuarios em cada mensagem
+_cache_grupo_usuario = OrderedDict()
+_CACHE_GRUPO_USUARIO_MAX = 20000
+
+def _guardar_grupo_em_cache(user_id: int, grupo_id: str):
+    _cache_grupo_usuario[user_id] = (grupo_id, time.monotonic() + GRUPO_CACHE_TTL)
+    _cache_grupo_usuario.move_to_end(user_id)
+    while len(_cache_grupo_usuario) > _CACHE_GRUPO_USUARIO_MAX:
+        _cache_grupo_usuario.popitem(last=False)
+
 async def get_grupo_id(user_id: int) -> str:
-    try:
-        resp = supabase.table("usuarios").select("grupo_id").eq("user_id", user_id).execute()
-        if resp.data:
-            return resp.data[0]['grupo_id']
-        novo = str(uuid.uuid4())
-        supabase.table("usuarios").insert({"user_id": user_id, "grupo_id": novo}).execute()
-        return novo
-    except Exception:
-        return str(user_id)
+    em_cache = _cache_grupo_usuario.get(user_id)
+    if em_cache and em_cache[1] > time.monotonic():
+        _cache_grupo_usuario.move_to_end(user_id)
+        grupo_id = em_cache[0]
+    else:
+        try:
+            # Devolve o grupo ativo ou cria um grupo novo para o usuário, atomicamente
+            grupo_id = obter_supabase().rpc("obter_grupo_ativo", {"p_user_id": user_id}).execute().data
+            _guardar_grupo_em_cache(user_id, grupo_id)
+            if _replica is not None and _replica.grupo_do_usuario(user_id) != grupo_id:
+                _replica.definir_grupo_do_usuario(user_id, grupo_id)
+        except Exception:
+            # Supabase fora do ar: vale o último grupo conhecido pela réplica local
+            grupo_id = (_replica.grupo_do_usuario(user_id) if _replica is not None else None) or str(user_id)
+    _log_grupo_id.set(grupo_id)
+    if _replica is not None:
+        await _replica.preparar_grupo(grupo_id)
+    return grupo_id
+
+def definir_grupo_em_cache(user_id: int, grupo_id: str):
+    _guardar_grupo_em_cache(user_id, grupo_id)
+    if _replica is not None:
+        _replica.definir_grupo_do_usuario(user_id, grupo_id)
 
 async def adicionar_usuario_ao_grupo(novo_user_id: int, codigo_convite: str, convidante_user_id: int = None):
     try:
-        resp = supabase.table("usuarios").select("grupo_id").eq("grupo_id", codigo_convite).limit(1).execute()
-        if not resp.data:
+        status = obter_supabase().rpc("entrar_grupo", {"p_user_id": novo_user_id, "p_codigo": codigo_convite}).execute().data
+        if status == "invalido":
             return False, "❌ Código de convite inválido."
-        grupo_id_para_adicionar = codigo_convite
-        check_resp = supabase.table("usuarios").select("grupo_id").eq("user_id", novo_user_id).eq("grupo_id", grupo_id_para_adicionar).execute()
-        if check_resp.data:
-            return True, f"✅ Você já está no grupo '{grupo_id_para_adicionar}'."
-        exists_resp = supabase.table("usuarios").select("user_id").eq("user_id", novo_user_id).execute()
-        if exists_resp.data:
-            supabase.table("usuarios").update({"grupo_id": grupo_id_para_adicionar}).eq("user_id", novo_user_id).execute()
-        else:
-            supabase.table("usuarios").insert({"user_id": novo_user_id, "grupo_id": grupo_id_para_adicionar}).execute()
-        return True, f"✅ Você foi adicionado ao grupo '{grupo_id_para_adicionar}'!"
+        definir_grupo_em_cache(novo_user_id, codigo_convite)
+        if status == "ja_ativo":
+            return True, f"✅ Você já está no grupo '{codigo_convite}'."
+        if status == "reativado":
+            return True, f"✅ Grupo '{codigo_convite}' ativado novamente!"
+        return True, f"✅ Você foi adicionado ao grupo '{codigo_convite}'!"
     except Exception:
         return False, "❌ Erro ao processar o convite. Tente novamente mais tarde."
 
+async def trocar_grupo_ativo(user_id: int, grupo_id: str) -> bool:
+    ativado = obter_supabase().rpc("ativar_grupo", {"p_user_id": user_id, "p_grupo_id": grupo_id}).execute().data
+    if ativado:
+        definir_grupo_em_cache(user_id, grupo_id)
+    return bool(ativado)
+
+def invalidar_caches_grupo(grupo_id):
+    """Descarta o que está em memória sobre os produtos do grupo; chamar depois de cada escrita."""
+    for chave in [c for c in _cache_inline if c[0] == grupo_id]:
+        _cache_inline.pop(chave, None)
+
+def campos_preco_base(unidade, preco) -> dict:
+    """Preço por unidade base gravado junto do produto; alimenta os agregados do /stats."""
+    valor, base = preco_unitario_normalizado(unidade, preco)
+    return {"preco_unitario_base": round(valor, 4) if valor is not None else None, "unidade_base": base}
+
+def campos_novo_preco(unidade, preco) -> dict:
+    """Tudo que muda em produtos quando o preço muda: preço, texto por unidade e preço base."""
+    return {
+        "preco": preco,
+        "preco_por_unidade_formatado": formatar_preco_unitario(calculate_unit_price(unidade, preco), preco),
+        **campos_preco_base(unidade, preco),
+    }
+
+def preparar_linha_produto(novo_produto: dict) -> dict:
+    return {
+        **novo_produto,
+        "chave_produto": chave_produto(novo_produto['nome'], novo_produto['tipo'],
+                                       novo_produto['marca'], novo_produto['unidade']),
+        "nome_normalizado": normalizar_campo_produto(novo_produto['nome']),
+        **campos_preco_base(novo_produto['unidade'], novo_produto['preco']),
+        # Atualizações também sobem para o topo das listagens (ordenadas por timestamp)
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+def salvar_produto(novo_produto: dict):
+    """Grava o produto numa única ida ao banco: insere ou, se o grupo já tem a mesma
+    chave_produto, atualiza preço/observações da linha existente."""
+    linha = preparar_linha_produto(novo_produto)
+    if _replica is not None:
+        return _replica.salvar([linha])[0]
+    return obter_supabase().table("produtos").upsert(linha, on_conflict="grupo_id,chave_produto").execute()
+
+def salvar_produtos_em_lote(novos_produtos: list, tamanho_lote: int = NFCE_LOTE) -> int:
+    """Upsert de vários produtos, tamanho_lote linhas por requisição. Retorna quantos foram gravados."""
+    # Um mesmo upsert não pode tocar a mesma linha duas vezes: fica a última ocorrência de cada chave
+    linhas = {}
+    for novo_produto in novos_produtos:
+        linha = preparar_linha_produto(novo_produto)
+        linhas[(linha['grupo_id'], linha['chave_produto'])] = linha
+    linhas = list(linhas.values())
+    if _replica is not None:
+        return len(_replica.salvar(linhas))
+    for inicio in range(0, len(linhas), tamanho_lote):
+        (obter_supabase().table("produtos")
+         .upsert(linhas[inicio:inicio + tamanho_lote], on_conflict="grupo_id,chave_produto")
+         .execute())
+    return len(linhas)
+
+def atualizar_produto_condicional(produto_id, grupo_id, versao, campos: dict) -> Optional[dict]:
+    """Atualiza o produto só se ele ainda é do grupo e está na versão lida.
+
+    Retorna a linha nova, ou None se alguém do grupo alterou/excluiu o produto antes
+    (o trigger em produtos incrementa versao a cada UPDATE)."""
+    if _replica is not None:
+        atualizadas = _replica.atualizar_condicional([(produto_id, versao, campos)], grupo_id)
+        return atualizadas[0] if atualizadas else None
+    response = (obter_supabase().table("produtos")
+                .update(campos)
+                .eq("id", produto_id)
+                .eq("grupo_id", grupo_id)
+                .eq("versao", versao)
+                .execute())
+    return response.data[0] if response.data else None
+
+def excluir_produto_condicional(produto_id, grupo_id, versao) -> bool:
+    """Exclui o produto só se ele ainda é do grupo e está na versão lida."""
+    if _replica is not None:
+        return bool(_replica.excluir_condicional([(produto_id, versao)], grupo_id))
+    response = (obter_supabase().table("produtos")
+                .delete()
+                .eq("id", produto_id)
+                .eq("grupo_id", grupo_id)
+                .eq("versao", versao)
+                .execute())
+    return bool(response.data)
+
+def buscar_produto_do_grupo(produto_id, grupo_id) -> Optional[dict]:
+    """Linha atual do produto (com versao), ou None se ele não existe mais ou é de outro grupo."""
+    if _replica is not None:
+        linhas = _replica.consultar("select * from produtos where id = ? and grupo_id = ?", (str(produto_id), grupo_id))
+        return linhas[0] if linhas else None
+    response = (obter_supabase().table("produtos")
+                .select("id, nome, tipo, marca, unidade, preco, observacoes, versao")
+                .eq("id", produto_id)
+                .eq("grupo_id", grupo_id)
+                .limit(1)
+                .execute())
+    return response.data[0] if response.data else None
+
+def excluir_produtos_em_lote(produtos: list, grupo_id) -> list:
+    """Exclui vários produtos numa única requisição, cada um condicionado à versão lida.
+    Retorna os ids efetivamente excluídos."""
+    if _replica is not None:
+        return _replica.excluir_condicional([(p.id, p.versao) for p in produtos], grupo_id)
+    versoes = ",".join(f"and(id.eq.{p.id},versao.eq.{p.versao})" for p in produtos)
+    response = (obter_supabase().table("produtos")
+                .delete()
+                .eq("grupo_id", grupo_id)
+                .in_("id", [p.id for p in produtos])
+                .or_(versoes)
+                .execute())
+    return [linha['id'] for linha in response.data]
+
+def atualizar_precos_em_lote(itens: list, grupo_id) -> list:
+    """Atualiza vários preços numa única chamada (RPC atualizar_precos_em_lote).
+
+    Cada item traz id, versao e os campos de campos_novo_preco(); linhas cuja versão
+    mudou são ignoradas. Retorna os ids efetivamente atualizados."""
+    if _replica is not None:
+        atualizadas = _replica.atualizar_condicional(
+            [(item['id'], item['versao'], {c: v for c, v in item.items() if c not in ("id", "versao")}) for item in itens],
+            grupo_id,
+        )
+        return [linha['id'] for linha in atualizadas]
+    response = obter_supabase().rpc("atualizar_precos_em_lote", {"p_grupo_id": grupo_id, "p_itens": itens}).execute()
+    return [linha['id'] for linha in response.data]
+
+def compactar_produtos_duplicados(tamanho_lote: int = 500):
+    """Tarefa avulsa: preenche chave_produto e remove duplicatas antigas de cada grupo.
+
+    Mantém a linha mais recente de cada (grupo_id, chave_produto). Deve rodar antes
+    de criar o índice único (supabase/migrations/0003_produtos_chave_unica.sql) e
+    de novo sempre que normalizar_campo_produto ou SINONIMOS mudarem:
+        python main.py compactar-produtos
+    """
+    sb = obter_supabase()
+    grupo_atual = None
+    chaves_do_grupo = set()
+    ids_duplicados = []
+    atualizar = []
+    offset = 0
+    while True:
+        # Só leitura aqui: gravar durante a paginação por offset deslocaria as páginas
+        lote = (sb.table("produtos")
+                .select("*")
+                .order("grupo_id")
+                .order("timestamp", desc=True)
+                .order("id")
+                .range(offset, offset + tamanho_lote - 1)
+                .execute()).data
+        if not lote:
+            break
+        for produto in lote:
+            if produto['grupo_id'] != grupo_atual:
+                grupo_atual = produto['grupo_id']
+                chaves_do_grupo = set()
+            chave = chave_produto(produto['nome'], produto['tipo'], produto['marca'], produto['unidade'])
+            if chave in chaves_do_grupo:
+                ids_duplicados.append(produto['id'])
+                continue
+            chaves_do_grupo.add(chave)
+            if produto.get('chave_produto') != chave:
+                atualizar.append({**produto, "chave_produto": chave})
+        logging.info("Compactação: %s produtos lidos, %s duplicatas encontradas.", offset + len(lote), len(ids_duplicados))
+        if len(lote) < tamanho_lote:
+            break
+        offset += tamanho_lote
+
+    # Com o índice único já criado, a ordem importa: primeiro saem as duplicatas,
+    # depois as chaves que mudaram são zeradas (nulos não colidem) e só então regravadas.
+    for inicio in range(0, len(ids_duplicados), tamanho_lote):
+        sb.table("produtos").delete().in_("id", ids_duplicados[inicio:inicio + tamanho_lote]).execute()
+    for inicio in range(0, len(atualizar), tamanho_lote):
+        ids = [produto['id'] for produto in atualizar[inicio:inicio + tamanho_lote]]
+        sb.table("produtos").update({"chave_produto": None}).in_("id", ids).execute()
+    for inicio in range(0, len(atualizar), tamanho_lote):
+        sb.table("produtos").upsert(atualizar[inicio:inicio + tamanho_lote], on_conflict="id").execute()
+    logging.info("Compactação concluída: %s produtos duplicados removidos, %s chaves regravadas.",
+                 len(ids_duplicados), len(atualizar))
+    return len(ids_duplicados)
+
+def recalcular_campos_derivados(tamanho_lote: int = 500):
+    """Tarefa avulsa: regrava os campos que a aplicação deriva de cada produto
+    (nome normalizado e preço por unidade base) nas linhas antigas e reconstrói
+    os agregados do /stats.
+        python main.py recalcular-produtos
+    """
+    sb = obter_supabase()
+    atualizados = 0
+    offset = 0
+    while True:
+        lote = (sb.table("produtos")
+                .select("*")
+                .order("id")
+                .range(offset, offset + tamanho_lote - 1)
+                .execute()).data
+        atualizar = []
+        for produto in lote:
+            derivados = {
+                "nome_normalizado": normalizar_campo_produto(produto['nome']),
+                **campos_preco_base(produto['unidade'], produto['preco']),
+            }
+            if any(produto.get(campo) != valor for campo, valor in derivados.items()):
+                atualizar.append({**produto, **derivados})
+        if atualizar:
+            sb.table("produtos").upsert(atualizar, on_conflict="id").execute()
+            atualizados += len(atualizar)
+        if len(lote) < tamanho_lote:
+            break
+        offset += tamanho_lote
+    sb.rpc("reconstruir_estatisticas").execute()
+    logging.info("Recálculo concluído: %s produtos atualizados e estatísticas reconstruídas.", atualizados)
+    return atualizados
+
+# ========================
+# Réplica local (SQLite, opcional)
+# ========================
+# Com REPLICA_LOCAL=/caminho/replica.db, os produtos e o grupo ativo de cada
+# usuário ficam também num SQLite local. list_products e as buscas leem dele, e as
+# gravações (salvar, editar, excluir) são aplicadas localmente e anotadas num
+# diário, que sincronizar_replica envia ao Supabase em lotes, com novas tentativas.
+# Lentidão ou queda do Supabase deixa de travar o bot.
+#
+# Conflitos: vence a escrita mais recente (atualizado_em), dos dois lados. As RPCs
+# da migração 0010 só aplicam uma linha do diário se ela for mais nova que a do
+# banco, e uma linha vinda do banco só substitui a local se for mais nova. O id de
+# um produto criado na réplica pode não ser o do banco (se outra instância já o
+# criou lá); por isso o diário identifica produtos por (grupo_id, chave_produto),
+# como o índice único do banco. Cada grupo é carregado inteiro no primeiro acesso
+# (get_grupo_id, numa thread) e recarregado a cada REPLICA_RECARGA em segundo
+# plano; no meio tempo, o que outras instâncias gravam chega pela busca
+# incremental (as exclusões feitas por elas, só na recarga).
+COLUNAS_REPLICA = (
+    "id", "grupo_id", "nome", "nome_normalizado", "tipo", "marca", "unidade", "preco", "observacoes",
+    "preco_por_unidade_formatado", "chave_produto", "preco_unitario_base", "unidade_base",
+    "timestamp", "versao", "atualizado_em",
+)
+
+ESQUEMA_REPLICA = """
+pragma journal_mode = wal;
+pragma synchronous = normal;
+create table if not exists produtos (
+    id text primary key,
+    grupo_id text not null,
+    nome text, nome_normalizado text, tipo text, marca text, unidade text,
+    preco real, observacoes text, preco_por_unidade_formatado text, chave_produto text,
+    preco_unitario_base real, unidade_base text, "timestamp" text,
+    versao integer not null default 1,
+    atualizado_em text,
+    atualizado_ts real not null default 0
+);
+create unique index if not exists produtos_grupo_chave_idx on produtos (grupo_id, chave_produto);
+create index if not exists produtos_grupo_timestamp_idx on produtos (grupo_id, "timestamp" desc);
+create table if not exists usuarios (user_id integer primary key, grupo_id text not null);
+create table if not exists grupos_replicados (grupo_id text primary key, carregado_em real not null, marca text);
+create table if not exists diario (
+    seq integer primary key autoincrement,
+    operacao text not null,
+    dados text not null,
+    tentativas integer not null default 0,
+    proxima_tentativa real not null default 0
+);
+"""
+_COLUNAS_SQL = ", ".join(f'"{coluna}"' for coluna in COLUNAS_REPLICA)
+
+def _epoch(texto) -> float:
+    return datetime.fromisoformat(texto).timestamp() if texto else 0.0
+
+def _chave_pendente(dados: dict) -> tuple:
+    return dados['grupo_id'], dados['chave_produto']
+
+class ReplicaLocal:
+    def __init__(self, caminho: str):
+        self.conexao = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self.conexao.row_factory = sqlite3.Row
+        self.conexao.executescript(ESQUEMA_REPLICA)
+        self.lock = Lock()  # Usada no event loop e na thread de sincronização
+        # (grupo_id, chave_produto) -> escritas no diário; o diário só é lido inteiro aqui
+        self.pendentes = self._contar_pendentes()
+        self.carregados = {linha['grupo_id']: linha['carregado_em']
+                           for linha in self.consultar("select grupo_id, carregado_em from grupos_replicados")}
+        self.carregando = {}  # grupo_id -> primeira carga em andamento
+        self.recargas = set()  # Grupos com cópia vencida, recarregados por sincronizar_replica
+
+    @contextmanager
+    def transacao(self):
+        with self.lock:
+            self.conexao.execute("begin immediate")
+            try:
+                yield self.conexao
+            except BaseException:
+                self.conexao.execute("rollback")
+                self.pendentes = self._contar_pendentes()  # Desfaz o que _anotar contou
+                raise
+            self.conexao.execute("commit")
+
+    def consultar(self, sql: str, parametros=()) -> list:
+        with self.lock:
+            return [dict(linha) for linha in self.conexao.execute(sql, parametros)]
+
+    def _contar_pendentes(self) -> Counter:
+        return Counter(_chave_pendente(json.loads(linha['dados'])) for linha in self.conexao.execute("select dados from diario"))
+
+    def chaves_pendentes(self) -> set:
+        with self.lock:
+            return set(self.pendentes)
+
+    # ---- Leitura ----
+    async def preparar_grupo(self, grupo_id):
+        """Chamado por get_grupo_id. A primeira carga do grupo roda numa thread (acessos
+        simultâneos esperam a mesma carga); uma cópia vencida continua valendo e é
+        recarregada por sincronizar_replica, fora do caminho das mensagens."""
+        carregado_em = self.carregados.get(grupo_id)
+        if carregado_em is not None:
+            if carregado_em + REPLICA_RECARGA <= time.time():
+                self.recargas.add(grupo_id)
+            return
+        carga = self.carregando.get(grupo_id)
+        if carga is None:
+            carga = self.carregando[grupo_id] = asyncio.ensure_future(asyncio.to_thread(self.carregar_grupo, grupo_id))
+            carga.add_done_callback(lambda _: self.carregando.pop(grupo_id, None))
+        try:
+            await asyncio.shield(carga)
+        except Exception as e:
+            # listar/buscar acusam o erro dentro do handler; o próximo acesso tenta de novo
+            logging.error("Réplica: não foi possível carregar o grupo %s: %s", grupo_id, e)
+
+    def _exigir_grupo(self, grupo_id):
+        if grupo_id not in self.carregados:
+            raise RuntimeError(f"Réplica: o grupo {grupo_id} ainda não foi carregado do Supabase")
+
+    def carregar_grupo(self, grupo_id, tamanho_lote: int = 1000):
+        linhas = []
+        offset = 0
+        while True:
+            lote = (obter_supabase().table("produtos")
+                    .select(", ".join(COLUNAS_REPLICA))
+                    .eq("grupo_id", grupo_id)
+                    .order("id")
+                    .range(offset, offset + tamanho_lote - 1)
+                    .execute()).data
+            linhas.extend(lote)
+            if len(lote) < tamanho_lote:
+                break
+            offset += tamanho_lote
+        pendentes = self.chaves_pendentes()
+        remotos = {str(linha['id']) for linha in linhas}
+        agora = time.time()
+        with self.transacao() as conexao:
+            # Some o que foi excluído no banco (ou está lá com outro id, que _gravar_remota
+            # traz abaixo); produtos com escrita ainda no diário ficam como estão
+            locais = conexao.execute("select id, chave_produto from produtos where grupo_id = ?", (grupo_id,)).fetchall()
+            conexao.executemany("delete from produtos where id = ?", [
+                (local['id'],) for local in locais
+                if local['id'] not in remotos and (grupo_id, local['chave_produto']) not in pendentes
+            ])
+            for linha in linhas:
+                if (grupo_id, linha['chave_produto']) not in pendentes:
+                    self._gravar_remota(conexao, linha)
+            # Grupo vazio: as alterações de outras instâncias contam a partir de agora (com folga)
+            marca = max((linha['atualizado_em'] for linha in linhas), key=_epoch,
+                        default=datetime.fromtimestamp(time.time() - 60, timezone.utc).isoformat())
+            conexao.execute(
+                "insert or replace into grupos_replicados (grupo_id, carregado_em, marca) values (?, ?, ?)",
+                (grupo_id, agora, marca),
+            )
+        self.carregados[grupo_id] = agora
+        logging.info("Réplica: grupo %s carregado com %s produto(s).", grupo_id, len(linhas))
+
+    def listar(self, grupo_id, limite: int) -> list:
+        self._exigir_grupo(grupo_id)
+        return self.consultar(
+            'select * from produtos where grupo_id = ? order by "timestamp" desc limit ?', (grupo_id, limite)
+        )
+
+    def buscar(self, grupo_id, termo_normalizado: str, limite: int = -1) -> list:
+        """Mesmo critério do ilike em nome_normalizado (o termo já vem normalizado, sem % nem _)."""
+        self._exigir_grupo(grupo_id)
+        return self.consultar(
+            'select * from produtos where grupo_id = ? and nome_normalizado like ? order by "timestamp" desc limit ?',
+            (grupo_id, f"%{termo_normalizado}%", limite),
+        )
+
+    def grupo_do_usuario(self, user_id):
+        linha = self.consultar("select grupo_id from usuarios where user_id = ?", (user_id,))
+        return linha[0]['grupo_id'] if linha else None
+
+    def definir_grupo_do_usuario(self, user_id, grupo_id):
+        with self.transacao() as conexao:
+            conexao.execute("insert or replace into usuarios (user_id, grupo_id) values (?, ?)", (user_id, grupo_id))
+
+    # ---- Escrita (local + diário) ----
+    def _gravar_local(self, conexao, linha: dict):
+        conexao.execute(
+            f"insert or replace into produtos ({_COLUNAS_SQL}, atualizado_ts) "
+            f"values ({', '.join('?' * len(COLUNAS_REPLICA))}, ?)",
+            (*(linha.get(c) for c in COLUNAS_REPLICA), _epoch(linha['atualizado_em'])),
+        )
+
+    def _gravar_remota(self, conexao, linha: dict):
+        """Aplica uma linha vinda do Supabase se ela for mais nova que a local (por id ou por chave).
+
+        Com o mesmo atualizado_em e outro id é a própria escrita da réplica de volta do
+        banco: vale a linha remota, que troca o id provisório da réplica pelo do banco.
+        """
+        linha = {**linha, "id": str(linha['id'])}
+        ts = _epoch(linha['atualizado_em'])
+        locais = conexao.execute(
+            "select id, atualizado_ts from produtos where id = ? or (grupo_id = ? and chave_produto = ?)",
+            (linha['id'], linha['grupo_id'], linha['chave_produto']),
+        ).fetchall()
+        if any(local['atualizado_ts'] > ts or (local['atualizado_ts'] == ts and local['id'] == linha['id'])
+               for local in locais):
+            return
+        conexao.executemany("delete from produtos where id = ?", [(local['id'],) for local in locais])
+        self._gravar_local(conexao, linha)
+
+    def _anotar(self, conexao, operacao: str, dados: dict):
+        conexao.execute("insert into diario (operacao, dados) values (?, ?)", (operacao, json.dumps(dados, default=str)))
+        self.pendentes[_chave_pendente(dados)] += 1
+
+    def salvar(self, linhas: list) -> list:
+        """Insere ou atualiza (por grupo_id + chave_produto) linhas já preparadas."""
+        agora = datetime.now(timezone.utc).isoformat()
+        gravadas = []
+        with self.transacao() as conexao:
+            for linha in linhas:
+                existente = conexao.execute(
+                    "select id, versao from produtos where grupo_id = ? and chave_produto = ?",
+                    (linha['grupo_id'], linha['chave_produto']),
+                ).fetchone()
+                nova = {
+                    **linha,
+                    "id": existente['id'] if existente else str(uuid.uuid4()),
+                    "versao": existente['versao'] + 1 if existente else 1,
+                    "atualizado_em": agora,
+                }
+                self._gravar_local(conexao, nova)
+                self._anotar(conexao, "upsert", nova)
+                gravadas.append(nova)
+        return gravadas
+
+    def atualizar_condicional(self, itens: list, grupo_id) -> list:
+        """itens: (id, versao lida, campos). Retorna as linhas atualizadas."""
+        agora = datetime.now(timezone.utc).isoformat()
+        atualizadas = []
+        with self.transacao() as conexao:
+            for produto_id, versao, campos in itens:
+                atual = conexao.execute(
+                    "select * from produtos where id = ? and grupo_id = ? and versao = ?",
+                    (str(produto_id), grupo_id, versao),
+                ).fetchone()
+                if atual is None:
+                    continue
+                nova = {**dict(atual), **campos, "versao": versao + 1, "atualizado_em": agora}
+                nova.pop("atualizado_ts")
+                self._gravar_local(conexao, nova)
+                self._anotar(conexao, "upsert", nova)
+                atualizadas.append(nova)
+        return atualizadas
+
+    def excluir_condicional(self, itens: list, grupo_id) -> list:
+        """itens: (id, versao lida). Retorna os ids excluídos."""
+        agora = datetime.now(timezone.utc).isoformat()
+        excluidos = []
+        with self.transacao() as conexao:
+            for produto_id, versao in itens:
+                atual = conexao.execute(
+                    "select chave_produto from produtos where id = ? and grupo_id = ? and versao = ?",
+                    (str(produto_id), grupo_id, versao),
+                ).fetchone()
+                if atual is None:
+                    continue
+                conexao.execute("delete from produtos where id = ?", (str(produto_id),))
+                self._anotar(conexao, "excluir", {"grupo_id": grupo_id, "chave_produto": atual['chave_produto'],
+                                                  "atualizado_em": agora})
+                excluidos.append(str(produto_id))
+        return excluidos
+
+    # ---- Sincronização ----
+    def enviar_diario(self) -> int:
+        """Envia o próximo lote do diário. Se o Supabase falhar, o lote espera com backoff exponencial."""
+        entradas = self.consultar(
+            "select seq, operacao, dados, tentativas from diario where proxima_tentativa <= ? order by seq limit ?",
+            (time.time(), REPLICA_LOTE),
+        )
+        if not entradas:
+            return 0
+        # Vale a última operação de cada produto dentro do lote
+        ultimas = {}
+        chaves = []
+        for entrada in entradas:
+            dados = json.loads(entrada['dados'])
+            chaves.append(_chave_pendente(dados))
+            ultimas[chaves[-1]] = (entrada['operacao'], dados)
+        exclusoes = [dados for operacao, dados in ultimas.values() if operacao == "excluir"]
+        # Sem id: o da réplica é provisório (uuid4) e o banco atribui o seu no insert
+        linhas = [{c: dados.get(c) for c in COLUNAS_REPLICA if c not in ("id", "versao")}
+                  for operacao, dados in ultimas.values() if operacao == "upsert"]
+        seqs = [entrada['seq'] for entrada in entradas]
+        marcadores = ",".join("?" * len(seqs))
+        try:
+            if exclusoes:
+                obter_supabase().rpc("excluir_produtos_sincronizados", {"p_exclusoes": exclusoes}).execute()
+            if linhas:
+                obter_supabase().rpc("sincronizar_produtos", {"p_linhas": linhas}).execute()
+        except Exception as e:
+            tentativas = max(entrada['tentativas'] for entrada in entradas) + 1
+            atraso = min(2 ** tentativas, REPLICA_BACKOFF_MAX)
+            with self.transacao() as conexao:
+                conexao.execute(
+                    f"update diario set tentativas = ?, proxima_tentativa = ? where seq in ({marcadores})",
+                    (tentativas, time.time() + atraso, *seqs),
+                )
+            logging.warning("Réplica: falha ao enviar %s escrita(s) ao Supabase "
+                            "(tentativa %s, nova tentativa em %ss): %s", len(seqs), tentativas, atraso, e)
+            return 0
+        with self.transacao() as conexao:
+            conexao.execute(f"delete from diario where seq in ({marcadores})", seqs)
+            for chave in chaves:
+                self.pendentes[chave] -= 1
+                if self.pendentes[chave] <= 0:
+                    del self.pendentes[chave]
+        return len(seqs)
+
+    def buscar_alteracoes(self, tamanho_lote: int = 100, tamanho_pagina: int = 1000) -> int:
+        """Traz o que mudou no Supabase (inclusive por outras instâncias) nos grupos replicados.
+
+        Pagina em ordem de (atualizado_em, id), continuando depois da última linha
+        recebida: o PostgREST corta respostas grandes (1000 linhas por padrão) e um
+        UPDATE em massa dá o mesmo atualizado_em a muitas linhas. As marcas só
+        avançam depois que todas as páginas do lote foram aplicadas, e avançam juntas
+        até a última linha recebida: a consulta cobriu o lote inteiro até ali, e um
+        grupo parado não segura os demais numa marca antiga.
+        """
+        grupos = self.consultar("select grupo_id, marca from grupos_replicados")
+        recebidas = 0
+        for inicio in range(0, len(grupos), tamanho_lote):
+            lote = grupos[inicio:inicio + tamanho_lote]
+            marcas = {g['grupo_id']: g['marca'] for g in lote}
+            ultima = None  # (atualizado_em, id) da última linha recebida
+            while True:
+                consulta = (obter_supabase().table("produtos")
+                            .select(", ".join(COLUNAS_REPLICA))
+                            .in_("grupo_id", list(marcas)))
+                if ultima is None:
+                    consulta = consulta.gt("atualizado_em", min(marcas.values(), key=_epoch))
+                else:
+                    consulta = consulta.or_(f'atualizado_em.gt."{ultima[0]}",'
+                                            f'and(atualizado_em.eq."{ultima[0]}",id.gt."{ultima[1]}")')
+                linhas = consulta.order("atualizado_em").order("id").limit(tamanho_pagina).execute().data
+                if not linhas:
+                    break
+                pendentes = self.chaves_pendentes()
+                with self.transacao() as conexao:
+                    for linha in linhas:
+                        if (linha['grupo_id'], linha['chave_produto']) not in pendentes:
+                            self._gravar_remota(conexao, linha)
+                recebidas += len(linhas)
+                ultima = (linhas[-1]['atualizado_em'], linhas[-1]['id'])
+                if len(linhas) < tamanho_pagina:
+                    break  # Por isso tamanho_pagina não pode passar do max-rows do PostgREST
+            if ultima is None:
+                continue
+            with self.transacao() as conexao:
+                conexao.executemany("update grupos_replicados set marca = ? where grupo_id = ?", [
+                    (max(marca, ultima[0], key=_epoch), grupo_id) for grupo_id, marca in marcas.items()
+                ])
+        return recebidas
+
+    def pendencias(self) -> int:
+        return self.consultar("select count(*) as total from diario")[0]['total']
+
+_replica: Optional[ReplicaLocal] = None
+_tarefa_replica = None
+
+async def sincronizar_replica():
+    """Tarefa em segundo plano (start_bot): esvazia o diário e busca alterações remotas."""
+    ultima_busca = 0.0
+    while True:
+        await asyncio.sleep(REPLICA_SYNC_INTERVALO)
+        try:
+            while await asyncio.to_thread(_replica.enviar_diario):
+                pass
+            for grupo_id in list(_replica.recargas):
+                _replica.recargas.discard(grupo_id)
+                try:
+                    await asyncio.to_thread(_replica.carregar_grupo, grupo_id)
+                except Exception as e:
+                    logging.warning("Réplica: não foi possível recarregar o grupo %s, usando a cópia local: %s", grupo_id, e)
+            if time.monotonic() - ultima_busca >= REPLICA_ATUALIZACAO:
+                await asyncio.to_thread(_replica.buscar_alteracoes)
+                ultima_busca = time.monotonic()
+        except Exception as e:
+            logging.error("Réplica: erro na sincronização com o Supabase: %s", e)
+
+@registrar_gancho_encerramento
+async def encerrar_replica():
+    if _replica is None:
+        return
+    if _tarefa_replica is not None:
+        _tarefa_replica.cancel()
+    try:
+        while await asyncio.wait_for(asyncio.to_thread(_replica.enviar_diario), timeout=10):
+            pass
+    except Exception as e:
+        logging.warning("Réplica: diário não foi totalmente enviado no encerramento: %s", e)
+    pendentes = _replica.pendencias()
+    if pendentes:
+        logging.warning("Réplica: %s escrita(s) ficam no diário e serão enviadas no próximo boot.", pendentes)
+
 # ========================
 # Teclados
 # ========================
@@ -224,6 +1292,110 @@ def main_menu_keyboard():
 def cancel_keyboard():
     return ReplyKeyboardMarkup([[KeyboardButton("❌ Cancelar")]], resize_keyboard=True)
 
+# ========================
+# Estado das conversas (user_data)
+# ========================
+# user_data só guarda o que o fluxo em andamento precisa: os produtos da busca de
+# editar/excluir viram ProdutoSelecionado (slots, só as colunas usadas) e as
+# chaves do fluxo são removidas quando ele termina. Quem abandona a conversa no
+# meio tem o user_data descartado pela varredura de inatividade.
+CHAVES_ESTADO_CONVERSA = (
+    'current_product', 'unit_info', 'nfce_products',
+    'pending_products', 'editing_product', 'deleting_product', 'selected_products',
+)
+_ultima_atividade = {}  # user_id -> time.monotonic() da última mensagem
+_tarefa_varredura_user_data = None
+
+@dataclass(slots=True)
+class ProdutoSelecionado:
+    id: str
+    nome: str
+    tipo: str
+    marca: str
+    unidade: str
+    preco: Optional[float]
+    observacoes: Optional[str]
+    versao: int
+
+    @classmethod
+    def de_linha(cls, linha: dict) -> ProdutoSelecionado:
+        preco = linha.get('preco')  # Pode vir NULL; format_price mostra "0,00", como na listagem
+        return cls(str(linha['id']), linha['nome'], linha['tipo'], linha['marca'], linha['unidade'],
+                   float(preco) if preco is not None else None, linha.get('observacoes'), linha['versao'])
+
+def limpar_estado_conversa(context: ContextTypes.DEFAULT_TYPE):
+    for chave in CHAVES_ESTADO_CONVERSA:
+        context.user_data.pop(chave, None)
+
+async def conversa_expirada(update: Update) -> int:
+    """Resposta dos estados cujo user_data sumiu (varredura de inatividade ou bot reiniciado).
+
+    A varredura descarta o user_data mas não o estado do ConversationHandler; em vez
+    de seguir num passo sem dados, a conversa volta ao menu principal."""
+    await update.effective_message.reply_text(
+        "⌛ Essa conversa expirou por inatividade. Comece de novo pelo menu.",
+        reply_markup=main_menu_keyboard()
+    )
+    return MAIN_MENU
+
+def registrar_atividade(update: Update):
+    if update.effective_user is not None:
+        _ultima_atividade[update.effective_user.id] = time.monotonic()
+
+async def varrer_user_data_inativo():
+    """Tarefa em segundo plano (start_bot): descarta o user_data de quem está parado há USER_DATA_TTL."""
+    while True:
+        await asyncio.sleep(USER_DATA_VARREDURA)
+        limite = time.monotonic() - USER_DATA_TTL
+        inativos = [user_id for user_id, visto in _ultima_atividade.items() if visto < limite]
+        for user_id in inativos:
+            del _ultima_atividade[user_id]
+            bot_application.drop_user_data(user_id)
+        if inativos:
+            logging.info("user_data de %s usuário(s) inativo(s) descartado.", len(inativos))
+
+@registrar_gancho_encerramento
+async def parar_varredura_user_data():
+    if _tarefa_varredura_user_data is not None:
+        _tarefa_varredura_user_data.cancel()
+
+def tamanho_profundo(objeto, vistos=None) -> int:
+    """Bytes ocupados pelo objeto e por tudo que ele referencia (dicts, listas, registros com slots)."""
+    vistos = set() if vistos is None else vistos
+    if id(objeto) in vistos:
+        return 0
+    vistos.add(id(objeto))
+    tamanho = sys.getsizeof(objeto)
+    if isinstance(objeto, dict):
+        tamanho += sum(tamanho_profundo(k, vistos) + tamanho_profundo(v, vistos) for k, v in objeto.items())
+    elif isinstance(objeto, (list, tuple, set, frozenset)):
+        tamanho += sum(tamanho_profundo(item, vistos) for item in objeto)
+    elif hasattr(objeto, "__slots__"):
+        tamanho += sum(tamanho_profundo(getattr(objeto, campo), vistos)
+                       for campo in objeto.__slots__ if hasattr(objeto, campo))
+    return tamanho
+
+async def memory_report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/memoria (só administradores): quanto o user_data ocupa por conversa ativa."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    tamanhos = sorted(
+        (tamanho_profundo(dados) for dados in context.application.user_data.values() if dados),
+        reverse=True,
+    )
+    total = sum(tamanhos)
+    media = total / len(tamanhos) if tamanhos else 0
+    await update.message.reply_text(
+        f"🧠 *Memória das conversas*\n"
+        f"Usuários com user\\_data: {len(context.application.user_data)}\n"
+        f"Conversas com estado: {len(tamanhos)}\n"
+        f"Total: {total / 1024:.1f} KiB\n"
+        f"Média por conversa ativa: {media:.0f} bytes\n"
+        f"Maior conversa: {tamanhos[0] if tamanhos else 0} bytes\n"
+        f"Usuários acompanhados pela varredura: {len(_ultima_atividade)}",
+        parse_mode="Markdown"
+    )
+
 # ========================
 # Handlers
 # ========================
@@ -234,6 +1406,7 @@ def cancel_keyboard():
 # [Insira aqui todas as funções handlers, exatamente como do seu código, sem deixar nenhuma de fora]
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    limpar_estado_conversa(context)
     user_id = update.effective_user.id
     grupo_id = await get_grupo_id(user_id)
     await update.message.reply_text(
@@ -263,6 +1436,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "- Para produtos com múltiplas embalagens (como '3 tubos de 90g'), descreva assim para que o sistema calcule o custo por unidade.\n"
         "- O sistema automaticamente calculará o **preço por unidade de medida** (Kg, L, ml, g, und, rolo, metro, etc.) e informará qual opção é mais econômica.\n"
         "- Você também pode digitar diretamente o nome de um produto para pesquisar seu preço!\n"
+        "- Use /nota e envie o XML da NFC-e para cadastrar todos os produtos do cupom de uma vez.\n"
+        "- Use /lista com um item por linha para ver a opção mais barata de cada um e o total.\n"
+        "- Use /stats para ver os totais e as maiores variações de preço do seu grupo.\n"
+        "- Use /grafico Produto para ver a evolução do preço por unidade ao longo do tempo.\n"
+        "- Participa de mais de um grupo? Use /grupos para escolher o grupo ativo.\n"
         "- Use os botões abaixo para compartilhar ou acessar listas."
     )
     keyboard = [
@@ -275,6 +1453,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return MAIN_MENU
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    limpar_estado_conversa(context)
     await update.message.reply_text("❌ Operação cancelada.", reply_markup=main_menu_keyboard())
     return MAIN_MENU
 
@@ -306,6 +1485,44 @@ async def inserir_codigo_callback(update: Update, context: ContextTypes.DEFAULT_
     await query.message.reply_text("...", reply_markup=main_menu_keyboard())
     return AWAIT_INVITE_CODE_INPUT
 
+# ========================
+# Vários grupos por usuário (/grupos)
+# ========================
+async def list_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    try:
+        response = obter_supabase().table("usuarios").select("grupo_id, ativo").eq("user_id", user_id).order("grupo_id").execute()
+        grupos = response.data
+        if not grupos:
+            grupos = [{"grupo_id": await get_grupo_id(user_id), "ativo": True}]
+        keyboard = [
+            [InlineKeyboardButton(("✅ " if grupo['ativo'] else "") + grupo['grupo_id'], callback_data=f"trocar_grupo_{grupo['grupo_id']}")]
+            for grupo in grupos
+        ]
+        await update.message.reply_text(
+            "👪 *Seus grupos* — toque em um para torná-lo o grupo ativo:",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode="Markdown"
+        )
+    except Exception as e:
+        logging.error("Erro ao listar grupos de user_id %s: %s", user_id, e)
+        await update.message.reply_text("❌ Erro ao listar seus grupos.", reply_markup=main_menu_keyboard())
+    return MAIN_MENU
+
+async def switch_group_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    grupo_id = query.data[len("trocar_grupo_"):]
+    user_id = query.from_user.id
+    try:
+        if await trocar_grupo_ativo(user_id, grupo_id):
+            await query.edit_message_text(f"✅ Grupo ativo: `{grupo_id}`", parse_mode="Markdown")
+        else:
+            await query.edit_message_text("❌ Você não faz parte desse grupo.")
+    except Exception as e:
+        logging.error("Erro ao trocar grupo ativo de user_id %s: %s", user_id, e)
+        await query.edit_message_text("❌ Erro ao trocar de grupo. Tente novamente mais tarde.")
+
 # ========================
 # Função para compartilhar lista
 # ========================
@@ -322,7 +1539,7 @@ async def compartilhar_lista_callback(update: Update, context: ContextTypes.DEFA
         await query.message.reply_text(f"🔐 Código do grupo: `{grupo_id}`", parse_mode="Markdown")
         await query.message.reply_text("...", reply_markup=main_menu_keyboard())
     except Exception as e:
-        logging.error(f"Erro ao gerar convite para user_id {user_id}: {e}")
+        logging.error("Erro ao gerar convite para user_id %s: %s", user_id, e)
         await query.edit_message_text("❌ Erro ao gerar convite. Tente novamente mais tarde.")
         await query.message.reply_text("...", reply_markup=main_menu_keyboard())
 
@@ -366,7 +1583,7 @@ async def handle_product_data(update: Update, context: ContextTypes.DEFAULT_TYPE
         return AWAIT_PRODUCT_DATA
     price_str = data[4].strip()
     price = parse_price(price_str)
-    if price is None:
+    if not preco_valido(price):
         await update.message.reply_text(
             "⚠️ Preço inválido. Use **ponto como separador decimal** (ex: 4.99).\n"
             "Por favor, digite novamente os dados do produto:",
@@ -383,7 +1600,7 @@ async def handle_product_data(update: Update, context: ContextTypes.DEFAULT_TYPE
         'observacoes': data[5] if len(data) > 5 else ""
     }
     unit_info = calculate_unit_price(product['unidade'], price)
-    logging.info(f"Unit info calculado para {product['nome']}: {unit_info}")
+    logging.info("Unit info calculado para %s: %s", product['nome'], unit_info)
     
     message = f"📦 *Produto*: {product['nome']}\n"
     message += f"🏷️ *Tipo*: {product['tipo']}\n"
@@ -434,37 +1651,13 @@ async def confirm_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
     product = context.user_data.get('current_product')
     unit_info = context.user_data.get('unit_info')
     if not product or not unit_info:
-        await update.message.reply_text("❌ Erro ao confirmar produto. Tente novamente.")
-        return MAIN_MENU
+        return await conversa_expirada(update)
+    limpar_estado_conversa(context)  # O fluxo termina aqui, com ou sem sucesso
     user_id = update.effective_user.id
     try:
         grupo_id = await get_grupo_id(user_id)
-        if 'preco_por_metro' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_metro'])}/metro"
-        elif 'preco_por_100g' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_100g'])}/100g"
-        elif 'preco_por_kg' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_kg'])}/kg"
-        elif 'preco_por_100ml' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_100ml'])}/100ml"
-        elif 'preco_por_litro' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_litro'])}/L"
-        elif 'preco_por_unidade' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_unidade'])}/unidade"
-        elif 'preco_por_embalagem' in unit_info:
-            if 'preco_por_100' in unit_info:
-                unit_price_str = f"R$ {format_price(unit_info['preco_por_100'])}/100(g/ml)"
-            elif 'preco_por_100_base' in unit_info:
-                unit_price_str = f"R$ {format_price(unit_info['preco_por_100_base'])}/100(g/ml)"
-            else:
-                unit_price_str = f"R$ {format_price(unit_info['preco_por_embalagem'])}/embalagem"
-        elif 'preco_por_rolo' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_rolo'])}/rolo"
-        elif 'preco_por_folha' in unit_info:
-            unit_price_str = f"R$ {format_price(unit_info['preco_por_folha'])}/folha"
-        else:
-            unit_price_str = f"R$ {format_price(parse_price(product['preco']))}/unidade"
-        
+        unit_price_str = formatar_preco_unitario(unit_info, parse_price(product['preco']))
+
         novo_produto = {
             "grupo_id": grupo_id,
             "nome": product['nome'],
@@ -475,21 +1668,175 @@ async def confirm_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "observacoes": product['observacoes'],
             "preco_por_unidade_formatado": unit_price_str,
         }
-        response = supabase.table("produtos").insert(novo_produto).execute()
-        logging.info(f"Produto salvo no Supabase. Resposta: {response}")
+        response = salvar_produto(novo_produto)
+        invalidar_caches_grupo(grupo_id)
+        avaliar_alertas(grupo_id, product['nome'], product['unidade'], novo_produto['preco'])
+        logging.info("Produto %s salvo no Supabase.", product['nome'])
+        log_verboso("Resposta do Supabase ao salvar produto: %s", response)
         await update.message.reply_text(
             f"✅ Produto *{product['nome']}* salvo com sucesso na lista do grupo!",
             reply_markup=main_menu_keyboard(),
             parse_mode="Markdown"
         )
     except Exception as e:
-        logging.error(f"Erro ao salvar produto no Supabase: {e}")
+        logging.error("Erro ao salvar produto no Supabase: %s", e)
         await update.message.reply_text(
             "❌ Erro ao salvar produto. Tente novamente mais tarde.",
             reply_markup=main_menu_keyboard()
         )
     return MAIN_MENU
 
+# ========================
+# Importar NFC-e (/nota)
+# ========================
+# O XML da NFC-e é lido com iterparse: cada <det> (item) é convertido assim que
+# termina e depois descartado, então notas grandes não viram uma árvore inteira
+# em memória. iterar_itens_nfce e item_nfce_para_produto não dependem do
+# Telegram e são exercitadas com os XMLs de exemplo em tests/ (test_nfce.py).
+_UNIDADES_NFCE = {"KG": "kg", "G": "g", "L": "L", "LT": "L", "ML": "ml"}
+
+def _nome_local(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+def iterar_itens_nfce(origem):
+    """Gera (emitente, item) para cada produto da NFC-e; item tem xProd, qCom, uCom, vUnCom e vProd.
+
+    origem: caminho do arquivo ou objeto binário com read()."""
+    emitente = ""
+    for _, elem in ET.iterparse(origem, events=("end",)):
+        tag = _nome_local(elem.tag)
+        if tag == "emit":
+            nome = next((filho.text for filho in elem if _nome_local(filho.tag) == "xNome"), None)
+            emitente = (nome or "").strip()
+            elem.clear()
+        elif tag == "det":
+            prod = next((filho for filho in elem if _nome_local(filho.tag) == "prod"), None)
+            if prod is not None:
+                item = {_nome_local(campo.tag): (campo.text or "").strip() for campo in prod}
+                yield emitente, item
+            elem.clear()
+
+def item_nfce_para_produto(item: dict, emitente: str = "") -> Optional[dict]:
+    """Converte um item da NFC-e no formato de produto do bot (nome, unidade, preco...)."""
+    nome = re.sub(r"\s+", " ", item.get('xProd', "")).strip()
+    preco = parse_price(item.get('vUnCom', ""))
+    if not nome or not preco_valido(preco):
+        return None
+    unidade_comercial = item.get('uCom', "").upper()
+    observacoes = f"NFC-e {emitente.title()}".strip()
+    quantidade = parse_price(item.get('qCom', ""))
+    if quantidade and quantidade != 1:
+        # Quanto foi comprado (2 un, 0.534 kg); o preço gravado continua sendo o unitário
+        observacoes += f" ({quantidade:g} {unidade_comercial.lower() or 'und'})"
+    if unidade_comercial in _UNIDADES_NFCE:
+        # Vendido a granel: o preço unitário já é por kg/L/...
+        unidade = f"1 {_UNIDADES_NFCE[unidade_comercial]}"
+    else:
+        # Embalagem: tenta achar o tamanho na descrição ("ARROZ CAMIL 5KG")
+        tamanho = re.search(r"(\d+(?:[.,]\d+)?)\s*(KG|G|LT|L|ML)\b", nome.upper())
+        if tamanho:
+            unidade = f"{tamanho.group(1).replace(',', '.')} {_UNIDADES_NFCE[tamanho.group(2)]}"
+        else:
+            unidade = "1 und"
+    return {
+        'nome': nome.title(),
+        'tipo': "",
+        'marca': "",
+        'unidade': unidade,
+        'preco': preco,
+        'observacoes': observacoes,
+    }
+
+def ler_produtos_nfce(conteudo: bytes) -> list:
+    produtos = []
+    for emitente, item in iterar_itens_nfce(BytesIO(conteudo)):
+        produto = item_nfce_para_produto(item, emitente)
+        if produto:
+            produtos.append(produto)
+    return produtos
+
+async def ask_for_nfce(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "🧾 Envie o *arquivo XML* da NFC-e (como documento) para importar os produtos da nota.\n"
+        "O XML pode ser baixado no portal da SEFAZ a partir do QR-code do cupom.",
+        reply_markup=cancel_keyboard(),
+        parse_mode="Markdown"
+    )
+    return AWAIT_NFCE_DOCUMENT
+
+async def handle_nfce_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text == "❌ Cancelar":
+        return await cancel(update, context)
+    # A URL do QR-code só traz a chave de acesso, não os itens da nota
+    await update.message.reply_text(
+        "⚠️ Preciso do *arquivo XML* da nota. O link do QR-code só tem a chave de acesso;\n"
+        "abra-o no navegador, baixe o XML no portal da SEFAZ e envie aqui como documento.",
+        reply_markup=cancel_keyboard(),
+        parse_mode="Markdown"
+    )
+    return AWAIT_NFCE_DOCUMENT
+
+async def handle_nfce_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    documento = update.message.document
+    if documento.file_size and documento.file_size > NFCE_MAX_BYTES:
+        await update.message.reply_text("⚠️ Arquivo grande demais para uma NFC-e.", reply_markup=cancel_keyboard())
+        return AWAIT_NFCE_DOCUMENT
+    try:
+        arquivo = await documento.get_file()
+        conteudo = bytes(await arquivo.download_as_bytearray())
+        # O parsing roda fora do loop de eventos para não travar os outros usuários
+        produtos = await asyncio.to_thread(ler_produtos_nfce, conteudo)
+    except ET.ParseError:
+        await update.message.reply_text("⚠️ Não consegui ler esse arquivo como XML de NFC-e.", reply_markup=cancel_keyboard())
+        return AWAIT_NFCE_DOCUMENT
+    except Exception as e:
+        logging.error("Erro ao processar NFC-e de user_id %s: %s", update.effective_user.id, e, exc_info=True)
+        await update.message.reply_text("❌ Erro ao processar a nota. Tente novamente mais tarde.", reply_markup=main_menu_keyboard())
+        return MAIN_MENU
+    if not produtos:
+        await update.message.reply_text("📭 Nenhum produto encontrado nessa nota.", reply_markup=main_menu_keyboard())
+        return MAIN_MENU
+
+    context.user_data['nfce_products'] = produtos
+    texto = f"🧾 *{len(produtos)} produto(s) encontrados na nota:*\n"
+    for produto in produtos[:15]:
+        texto += f"• {produto['nome']} ({produto['unidade']}) — R$ {format_price(produto['preco'])}\n"
+    if len(produtos) > 15:
+        texto += f"... e mais {len(produtos) - 15}\n"
+    texto += "\nDigite ✅ *Confirmar* para salvar todos ou ❌ *Cancelar* para descartar"
+    await update.message.reply_text(
+        texto,
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("✅ Confirmar"), KeyboardButton("❌ Cancelar")]], resize_keyboard=True),
+        parse_mode="Markdown"
+    )
+    return CONFIRM_NFCE
+
+async def confirm_nfce(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text != "✅ Confirmar":
+        return await cancel(update, context)
+    produtos = context.user_data.get('nfce_products')
+    if not produtos:
+        return await conversa_expirada(update)
+    limpar_estado_conversa(context)  # O fluxo termina aqui, com ou sem sucesso
+    user_id = update.effective_user.id
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        novos_produtos = [
+            {**produto, "grupo_id": grupo_id,
+             "preco_por_unidade_formatado": formatar_preco_unitario(calculate_unit_price(produto['unidade'], produto['preco']), produto['preco'])}
+            for produto in produtos
+        ]
+        gravados = salvar_produtos_em_lote(novos_produtos)
+        invalidar_caches_grupo(grupo_id)
+        for produto in produtos:
+            avaliar_alertas(grupo_id, produto['nome'], produto['unidade'], produto['preco'])
+        logging.info("%s produto(s) da NFC-e salvos no Supabase para o grupo %s.", gravados, grupo_id)
+        await update.message.reply_text(f"✅ {gravados} produto(s) da nota salvos na lista do grupo!", reply_markup=main_menu_keyboard())
+    except Exception as e:
+        logging.error("Erro ao salvar produtos da NFC-e: %s", e)
+        await update.message.reply_text("❌ Erro ao salvar os produtos da nota. Tente novamente mais tarde.", reply_markup=main_menu_keyboard())
+    return MAIN_MENU
+
 # ========================
 # Pesquisar produto
 # ========================
@@ -503,44 +1850,21 @@ async def search_product_input(update: Update, context: ContextTypes.DEFAULT_TYP
 async def handle_search_product_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == "❌ Cancelar":
         return await cancel(update, context)
-    
-    # Verificação inicial para evitar que botões sejam tratados como pesquisa
-    botoes_especiais = [
-        "➕ Adicionar Produto", "✏️ Editar ou Excluir", "📋 Listar Produtos",
-        "🔍 Pesquisar Produto", "ℹ️ Ajuda", "❌ Cancelar",
-        "👪 Compartilhar Lista", "🔐 Inserir Código", "✅ Confirmar"
-    ]
-    
+
     # Se a mensagem for um botão, não faz pesquisa - trata como comando
-    if update.message.text.strip() in botoes_especiais:
-        # Trata como comando do botão, não como pesquisa
-        text = update.message.text.strip()
-        if text == "➕ Adicionar Produto":
-            return await ask_for_product_data(update, context)
-        elif text == "📋 Listar Produtos":
-            return await list_products(update, context)
-        elif text == "🔍 Pesquisar Produto":
-            return await search_product_input(update, context)
-        elif text == "ℹ️ Ajuda":
-            return await help_command(update, context)
-        elif text == "👪 Compartilhar Lista":
-            return await compartilhar_lista_callback(update, context)
-        elif text == "🔐 Inserir Código":
-            return await ask_for_invite_code(update, context)
-        elif text == "✏️ Editar ou Excluir":
-            return await ask_for_edit_delete_choice(update, context)
-        else:
-            # Para outros botões, volta ao menu principal
-            await update.message.reply_text("⚠️ Por favor, use os botões do menu principal para navegar.", reply_markup=main_menu_keyboard())
-            return MAIN_MENU
+    if update.message.text.strip() in BOTOES_ESPECIAIS:
+        return await despachar_botao(update, context)
     
     search_term = update.message.text.strip().lower()
     user_id = update.effective_user.id
     try:
         grupo_id = await get_grupo_id(user_id)
         # Corrigido: Selecionar explicitamente os campos necessários
-        response = supabase.table("produtos").select("nome, tipo, marca, unidade, preco, observacoes, preco_por_unidade_formatado").eq("grupo_id", grupo_id).ilike("nome", f"%{search_term}%").order("timestamp", desc=True).limit(10).execute()
-        produtos_encontrados = response.data
+        if _replica is not None:
+            produtos_encontrados = _replica.buscar(grupo_id, normalizar_campo_produto(search_term), 10)
+        else:
+            response = obter_supabase().table("produtos").select("nome, tipo, marca, unidade, preco, observacoes, preco_por_unidade_formatado").eq("grupo_id", grupo_id).ilike("nome_normalizado", f"%{normalizar_campo_produto(search_term)}%").order("timestamp", desc=True).limit(10).execute()
+            produtos_encontrados = response.data
         if not produtos_encontrados:
             await update.message.reply_text(f"📭 Nenhum produto encontrado para '{search_term}'.", reply_markup=main_menu_keyboard())
             return MAIN_MENU
@@ -600,7 +1924,7 @@ async def handle_search_product_input(update: Update, context: ContextTypes.DEFA
             # Se não houver preco_por_unidade_formatado, não mostra nada adicional
         await update.message.reply_text(texto, parse_mode="Markdown", reply_markup=main_menu_keyboard())
     except Exception as e:
-        logging.error(f"Erro ao pesquisar produtos no Supabase para user_id {user_id}: {e}")
+        logging.error("Erro ao pesquisar produtos no Supabase para user_id %s: %s", user_id, e)
         await update.message.reply_text("❌ Erro ao pesquisar produtos.", reply_markup=main_menu_keyboard())
     return MAIN_MENU
 
@@ -612,8 +1936,11 @@ async def list_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         grupo_id = await get_grupo_id(user_id)
         # Corrigido: Selecionar explicitamente os campos necessários
-        response = supabase.table("produtos").select("nome, tipo, marca, unidade, preco, observacoes, preco_por_unidade_formatado").eq("grupo_id", grupo_id).order("timestamp", desc=True).limit(20).execute()
-        produtos_do_grupo = response.data
+        if _replica is not None:
+            produtos_do_grupo = _replica.listar(grupo_id, 20)
+        else:
+            response = obter_supabase().table("produtos").select("nome, tipo, marca, unidade, preco, observacoes, preco_por_unidade_formatado").eq("grupo_id", grupo_id).order("timestamp", desc=True).limit(20).execute()
+            produtos_do_grupo = response.data
         if not produtos_do_grupo:
             await update.message.reply_text("📭 Nenhum produto na lista ainda.", reply_markup=main_menu_keyboard())
             return MAIN_MENU
@@ -638,10 +1965,496 @@ async def list_products(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 texto += f"   {produto['unidade']} - R${format_price(produto['preco'])}{obs}\n"
         await update.message.reply_text(texto, parse_mode="Markdown", reply_markup=main_menu_keyboard())
     except Exception as e:
-        logging.error(f"Erro ao listar produtos do Supabase: {e}")
+        logging.error("Erro ao listar produtos do Supabase: %s", e)
         await update.message.reply_text("❌ Erro ao acessar a lista.", reply_markup=main_menu_keyboard())
     return MAIN_MENU
 
+# ========================
+# Lista de compras (/lista)
+# ========================
+async def shopping_list_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Os itens podem vir na própria mensagem: "/lista\narroz\nfeijão\ncafé"
+    partes = update.message.text.split(maxsplit=1)
+    if len(partes) > 1:
+        return await answer_shopping_list(update, partes[1])
+    await update.message.reply_text(
+        "🛒 Envie os itens da sua lista, *um por linha*, que eu encontro a opção mais barata de cada um:",
+        reply_markup=cancel_keyboard(),
+        parse_mode="Markdown"
+    )
+    return AWAIT_SHOPPING_LIST
+
+async def handle_shopping_list_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text == "❌ Cancelar":
+        return await cancel(update, context)
+    return await answer_shopping_list(update, update.message.text)
+
+async def answer_shopping_list(update: Update, texto_lista: str):
+    # normalizar_campo_produto já remove vírgulas, parênteses e curingas que quebrariam o filtro "or" do PostgREST
+    itens = []
+    for linha in texto_lista.splitlines():
+        item = normalizar_campo_produto(linha)
+        if item and item not in itens:
+            itens.append(item)
+    if not itens:
+        await update.message.reply_text("⚠️ Envie pelo menos um item, um por linha.", reply_markup=main_menu_keyboard())
+        return MAIN_MENU
+    if len(itens) > LISTA_MAX_ITENS:
+        await update.message.reply_text(f"⚠️ A lista pode ter no máximo {LISTA_MAX_ITENS} itens.", reply_markup=main_menu_keyboard())
+        return MAIN_MENU
+
+    user_id = update.effective_user.id
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        # Uma única consulta para todos os itens
+        filtro = ",".join(f"nome_normalizado.ilike.%{item}%" for item in itens)
+        response = (obter_supabase().table("produtos")
+                    .select("nome, nome_normalizado, tipo, marca, unidade, preco")
+                    .eq("grupo_id", grupo_id)
+                    .or_(filtro)
+                    .order("timestamp", desc=True)
+                    .limit(1000)
+                    .execute())
+        candidatos = response.data
+
+        texto = "🛒 *Lista de compras — opções mais baratas:*\n"
+        total = 0.0
+        nao_encontrados = []
+        for item in itens:
+            opcoes = []
+            for produto in candidatos:
+                if item not in (produto['nome_normalizado'] or ""):
+                    continue
+                valor, base = preco_unitario_normalizado(produto['unidade'], produto['preco'])
+                if valor is not None:
+                    opcoes.append((valor, base, produto))
+            if not opcoes:
+                nao_encontrados.append(item)
+                continue
+            # Só compara preços na mesma unidade base; usa a base mais comum entre as opções
+            bases = [base for _, base, _ in opcoes]
+            base_escolhida = max(set(bases), key=bases.count)
+            valor, base, produto = min((o for o in opcoes if o[1] == base_escolhida), key=lambda o: o[0])
+            total += float(produto['preco'])
+            marca = f" {produto['marca']}" if produto.get('marca') and produto['marca'].strip() else ""
+            texto += (f"• *{produto['nome']}*{marca} ({produto['unidade']}) — R$ {format_price(produto['preco'])}"
+                      f"  📊 R$ {format_price(valor)}/{base}\n")
+        if nao_encontrados:
+            texto += "\n📭 *Sem preço cadastrado:* " + ", ".join(nao_encontrados) + "\n"
+        texto += f"\n💰 *Total estimado:* R$ {format_price(total)}"
+        await update.message.reply_text(texto, parse_mode="Markdown", reply_markup=main_menu_keyboard())
+    except Exception as e:
+        logging.error("Erro ao montar lista de compras para user_id %s: %s", user_id, e)
+        await update.message.reply_text("❌ Erro ao montar a lista de compras.", reply_markup=main_menu_keyboard())
+    return MAIN_MENU
+
+# ========================
+# Consulta inline (@bot arroz)
+# ========================
+# As consultas inline chegam a cada tecla. Três camadas evitam uma ida ao
+# Supabase por caractere: debounce por usuário, cache por (grupo_id, termo) com
+# TTL curto e, se um prefixo do termo já tem resultado completo em cache, o
+# filtro é feito em memória sobre ele.
+_cache_inline = OrderedDict()  # (grupo_id, termo) -> (expira_em, linhas, completo)
+_CACHE_INLINE_MAX = 2000
+_inline_ultima_consulta = {}  # user_id -> id da consulta inline mais recente
+
+def _guardar_inline(chave, entrada):
+    """Guarda no fim do LRU e descarta as consultas usadas há mais tempo."""
+    _cache_inline[chave] = entrada
+    _cache_inline.move_to_end(chave)
+    while len(_cache_inline) > _CACHE_INLINE_MAX:
+        _cache_inline.popitem(last=False)
+
+def buscar_produtos_inline(grupo_id, termo):
+    agora = time.monotonic()
+    for tamanho in range(len(termo), -1, -1):
+        entrada = _cache_inline.get((grupo_id, termo[:tamanho]))
+        if not entrada or entrada[0] <= agora:
+            continue
+        _, linhas, completo = entrada
+        if tamanho == len(termo):
+            _cache_inline.move_to_end((grupo_id, termo))
+            return linhas
+        if completo:
+            # Todo produto que contém o termo também contém o prefixo: basta filtrar
+            _cache_inline.move_to_end((grupo_id, termo[:tamanho]))
+            linhas = [p for p in linhas if termo in (p['nome_normalizado'] or "")]
+            _guardar_inline((grupo_id, termo), (entrada[0], linhas, True))
+            return linhas
+
+    response = (obter_supabase().table("produtos")
+                .select("id, nome, nome_normalizado, tipo, marca, unidade, preco, preco_por_unidade_formatado")
+                .eq("grupo_id", grupo_id)
+                .ilike("nome_normalizado", f"%{termo}%")
+                .order("timestamp", desc=True)
+                .limit(INLINE_MAX_RESULTADOS)
+                .execute())
+    linhas = response.data
+    _guardar_inline((grupo_id, termo), (agora + INLINE_CACHE_TTL, linhas, len(linhas) < INLINE_MAX_RESULTADOS))
+    return linhas
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    user_id = query.from_user.id
+    _inline_ultima_consulta[user_id] = query.id
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if _inline_ultima_consulta.get(user_id) != query.id:
+        return  # O usuário continuou digitando; só a última consulta é respondida
+    _inline_ultima_consulta.pop(user_id, None)
+
+    termo = normalizar_campo_produto(query.query)
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        produtos = buscar_produtos_inline(grupo_id, termo)
+        resultados = []
+        for produto in produtos[:INLINE_MAX_RESULTADOS]:
+            marca = f" - {produto['marca']}" if produto.get('marca') and produto['marca'].strip() else ""
+            preco_unidade = produto.get('preco_por_unidade_formatado') or ""
+            descricao = f"{produto['tipo']} | {produto['unidade']} | R$ {format_price(produto['preco'])}"
+            if preco_unidade:
+                descricao += f" | {preco_unidade}"
+            resultados.append(InlineQueryResultArticle(
+                id=str(produto['id']),
+                title=f"{produto['nome']}{marca}",
+                description=descricao,
+                input_message_content=InputTextMessageContent(f"🏷️ {produto['nome']}{marca}\n📦 {descricao}"),
+            ))
+        await query.answer(resultados, cache_time=int(INLINE_CACHE_TTL), is_personal=True)
+    except Exception as e:
+        logging.error("Erro ao responder consulta inline de user_id %s: %s", user_id, e)
+
+# ========================
+# Estatísticas do grupo (/stats)
+# ========================
+# Os agregados são mantidos por triggers em produtos (estatisticas_grupo,
+# estatisticas_categoria e variacoes_preco, ver supabase/migrations/0005_estatisticas.sql);
+# aqui só lemos o resultado pronto numa chamada, qualquer que seja o tamanho do grupo.
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        stats = obter_supabase().rpc("estatisticas_do_grupo", {"p_grupo_id": grupo_id}).execute().data or {}
+        if not stats.get('total_produtos'):
+            await update.message.reply_text("📭 Nenhum produto na lista ainda.", reply_markup=main_menu_keyboard())
+            return MAIN_MENU
+        texto = f"📈 *Estatísticas do seu Grupo*\n📦 *Produtos cadastrados:* {stats['total_produtos']}\n"
+        if stats.get('categorias'):
+            texto += "\n📊 *Preço por unidade (média | mín – máx):*\n"
+            for categoria in stats['categorias']:
+                base = categoria['unidade_base']
+                texto += (f"• *{categoria['categoria']}* ({categoria['quantidade']}): "
+                          f"R$ {format_price(categoria['media'])}/{base} | "
+                          f"R$ {format_price(categoria['minimo'])} – R$ {format_price(categoria['maximo'])}\n")
+        if stats.get('variacoes'):
+            texto += "\n🔀 *Maiores variações (30 dias):*\n"
+            for variacao in stats['variacoes']:
+                seta = "🔺" if variacao['variacao_pct'] > 0 else "🔻"
+                texto += (f"{seta} *{variacao['nome']}* ({variacao['unidade']}): R$ {format_price(variacao['preco_anterior'])} → "
+                          f"R$ {format_price(variacao['preco_novo'])} ({variacao['variacao_pct']:+.1f}%)\n")
+        await update.message.reply_text(texto, parse_mode="Markdown", reply_markup=main_menu_keyboard())
+    except Exception as e:
+        logging.error("Erro ao carregar estatísticas para user_id %s: %s", user_id, e)
+        await update.message.reply_text("❌ Erro ao carregar as estatísticas.", reply_markup=main_menu_keyboard())
+    return MAIN_MENU
+
+# ========================
+# Gráfico de preços (/grafico Arroz)
+# ========================
+# O histórico vem da tabela historico_precos (preenchida por trigger, ver
+# supabase/migrations/0011_historico_precos.sql). A renderização (matplotlib) roda
+# em até GRAFICO_PROCESSOS processos `python graficos.py`, reaproveitados entre os
+# pedidos, para não travar o event loop. Não é um ProcessPoolExecutor: com spawn
+# (ou forkserver) cada processo reimportaria este main.py como __mp_main__, com a
+# checagem de ambiente, o listener de logging e o app Flask. Cada gráfico enviado
+# fica em cache pelo file_id do Telegram, com chave (grupo_id, termo, versão dos
+# dados): repetir o pedido não renderiza nem reenvia o PNG.
+_cache_graficos = OrderedDict()  # (grupo_id, termo, versao) -> file_id
+_graficos_livres = []  # Processos de graficos.py parados esperando pedido
+_vagas_graficos = None  # asyncio.Semaphore(GRAFICO_PROCESSOS), criado no loop do bot
+
+async def renderizar_em_processo(titulo: str, series: dict, unidade_base: str) -> bytes:
+    """Pede o PNG a um processo de graficos.py (protocolo descrito em graficos.servir)."""
+    global _vagas_graficos
+    if _vagas_graficos is None:
+        _vagas_graficos = asyncio.Semaphore(GRAFICO_PROCESSOS)
+    async with _vagas_graficos:
+        if _graficos_livres:
+            processo = _graficos_livres.pop()
+        else:
+            processo = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "graficos.py"),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            )
+        try:
+            pedido = {"titulo": titulo, "series": series, "unidade_base": unidade_base}
+            processo.stdin.write(json.dumps(pedido).encode() + b"\n")
+            await processo.stdin.drain()
+            cabecalho = await processo.stdout.readexactly(5)
+            corpo = await processo.stdout.readexactly(int.from_bytes(cabecalho[1:], "big"))
+        except BaseException:
+            # Processo morto ou pedido cancelado no meio: a resposta ficaria dessincronizada.
+            # O wait recolhe o processo (sem zumbi) e fecha o transporte; shield porque,
+            # num cancelamento, esta tarefa já foi cancelada.
+            processo.kill()
+            await asyncio.shield(processo.wait())
+            raise
+        _graficos_livres.append(processo)
+    if cabecalho[0] != 0:
+        raise RuntimeError(f"graficos.py falhou: {corpo.decode(errors='replace')}")
+    return corpo
+
+@registrar_gancho_encerramento
+async def encerrar_processos_graficos():
+    while _graficos_livres:
+        processo = _graficos_livres.pop()
+        processo.stdin.close()  # EOF: graficos.servir() termina o laço
+        try:
+            await asyncio.wait_for(processo.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            processo.kill()
+
+def series_do_historico(historico: list):
+    """Agrupa o histórico em séries (nome + marca) na unidade base mais comum."""
+    base = Counter(ponto['unidade_base'] for ponto in historico).most_common(1)[0][0]
+    series = {}
+    for ponto in historico:
+        if ponto['unidade_base'] != base:
+            continue
+        rotulo = f"{ponto['nome']} {ponto['marca'] or ''}".strip()
+        datas, valores = series.setdefault(rotulo, ([], []))
+        datas.append(ponto['registrado_em'])
+        valores.append(float(ponto['preco_unitario_base']))
+    maiores = sorted(series, key=lambda rotulo: len(series[rotulo][0]), reverse=True)[:GRAFICO_MAX_SERIES]
+    return base, {rotulo: series[rotulo] for rotulo in maiores}
+
+async def price_chart_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    partes = update.message.text.split(maxsplit=1)
+    termo = normalizar_campo_produto(partes[1]) if len(partes) > 1 else ""
+    if not termo:
+        await update.message.reply_text(
+            "📉 Para ver a evolução do preço use:\n*/grafico Produto*\nEx: /grafico Arroz",
+            parse_mode="Markdown"
+        )
+        return
+    user_id = update.effective_user.id
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        historico = (obter_supabase().table("historico_precos")
+                     .select("id, nome, marca, preco_unitario_base, unidade_base, registrado_em")
+                     .eq("grupo_id", grupo_id)
+                     .ilike("nome_normalizado", f"%{termo}%")
+                     .order("registrado_em", desc=True)
+                     .limit(GRAFICO_MAX_PONTOS)
+                     .execute()).data
+        historico = [ponto for ponto in reversed(historico) if ponto['preco_unitario_base'] is not None]
+        if not historico:
+            await update.message.reply_text(f"📭 Nenhum histórico de preço para '{partes[1].strip()}'.")
+            return
+
+        # Qualquer preço novo muda o maior id do histórico, e com ele a chave do cache
+        chave = (grupo_id, termo, max(ponto['id'] for ponto in historico))
+        legenda = f"📉 Preço de *{partes[1].strip()}* ao longo do tempo"
+        file_id = _cache_graficos.get(chave)
+        if file_id:
+            _cache_graficos.move_to_end(chave)
+            await update.message.reply_photo(photo=file_id, caption=legenda, parse_mode="Markdown")
+            return
+
+        base, series = series_do_historico(historico)
+        png = await renderizar_em_processo(partes[1].strip().title(), series, base)
+        mensagem = await update.message.reply_photo(photo=png, caption=legenda, parse_mode="Markdown")
+        _cache_graficos[chave] = mensagem.photo[-1].file_id
+        if len(_cache_graficos) > GRAFICO_CACHE_MAX:
+            _cache_graficos.popitem(last=False)
+    except Exception as e:
+        logging.error("Erro ao gerar gráfico de '%s' para user_id %s: %s", termo, user_id, e, exc_info=True)
+        await update.message.reply_text("❌ Erro ao gerar o gráfico. Tente novamente mais tarde.")
+
+# ========================
+# Rastreamento sob demanda (/trace N [chat_id], só administradores)
+# ========================
+async def trace_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return  # Comando invisível para quem não é administrador
+    if not context.args:
+        restantes, chat_id = _rastreio["restantes"], _rastreio["chat_id"]
+        alvo = f"do chat {chat_id}" if chat_id is not None else "de qualquer chat"
+        await update.message.reply_text(
+            f"🔬 Rastreamento: {restantes} update(s) restante(s) {alvo}.\n"
+            f"Uso: /trace N [chat_id] (N = 0 desliga). Arquivos em {TRACE_DIR}/."
+        )
+        return
+    try:
+        quantidade = int(context.args[0])
+        chat_id = int(context.args[1]) if len(context.args) > 1 else None
+    except ValueError:
+        await update.message.reply_text("❌ Uso: /trace N [chat_id]")
+        return
+    _rastreio["restantes"] = max(quantidade, 0)
+    _rastreio["chat_id"] = chat_id
+    logging.info("Rastreamento ligado por %s: %s update(s), chat %s.", update.effective_user.id, quantidade, chat_id)
+    if quantidade <= 0:
+        await update.message.reply_text("🔬 Rastreamento desligado.")
+    else:
+        alvo = f"do chat {chat_id}" if chat_id is not None else ""
+        await update.message.reply_text(f"🔬 Rastreando os próximos {quantidade} update(s) {alvo}".rstrip() + ".")
+
+# ========================
+# Alertas de preço (/alerta Café < 15/kg)
+# ========================
+# Os alertas ficam na tabela alertas_preco e, em memória, indexados por
+# grupo_id -> nome normalizado do produto. Cada gravação de preço consulta só os
+# alertas daquele produto (sem varrer a tabela) e as notificações saem por uma
+# fila em segundo plano, sem atrasar a resposta de quem gravou.
+_indice_alertas = {}  # grupo_id -> {nome normalizado -> [alerta, ...]}
+_fila_notificacoes = asyncio.Queue()
+_tarefa_notificacoes = None
+
+_UNIDADES_ALERTA = {
+    "kg": "kg", "quilo": "kg",
+    "l": "L", "litro": "L",
+    "m": "m", "metro": "m",
+    "und": "und", "un": "und", "unidade": "und",
+    "rolo": "rolo", "folha": "folha",
+}
+
+def indexar_alerta(alerta: dict):
+    produtos = _indice_alertas.setdefault(alerta['grupo_id'], {})
+    produtos.setdefault(alerta['produto_chave'], []).append(alerta)
+
+def carregar_alertas(tamanho_lote: int = 1000):
+    """Carrega todos os alertas para o índice em memória (chamado no start_bot)."""
+    _indice_alertas.clear()
+    offset = 0
+    while True:
+        lote = (obter_supabase().table("alertas_preco")
+                .select("id, user_id, chat_id, grupo_id, produto, produto_chave, limite, unidade_base")
+                .order("id")
+                .range(offset, offset + tamanho_lote - 1)
+                .execute()).data
+        for alerta in lote:
+            # Recalcula a chave: alertas antigos podem ter sido gravados com outra normalização
+            alerta['produto_chave'] = normalizar_campo_produto(alerta['produto'])
+            indexar_alerta(alerta)
+        if len(lote) < tamanho_lote:
+            break
+        offset += tamanho_lote
+    logging.info("%s alerta(s) de preço carregados.", sum(len(a) for p in _indice_alertas.values() for a in p.values()))
+
+def avaliar_alertas(grupo_id, nome, unidade, preco):
+    """Enfileira avisos para os alertas do produto cujo limite ficou acima do novo preço unitário."""
+    alertas = _indice_alertas.get(grupo_id, {}).get(normalizar_campo_produto(nome))
+    if not alertas:
+        return
+    valor, base = preco_unitario_normalizado(unidade, preco)
+    if valor is None:
+        return
+    for alerta in alertas:
+        if alerta['unidade_base'] and alerta['unidade_base'] != base:
+            continue
+        if valor < float(alerta['limite']):
+            _fila_notificacoes.put_nowait((
+                alerta['chat_id'],
+                f"🔔 *Alerta de preço:* {nome} ({unidade}) por R$ {format_price(preco)} "
+                f"— R$ {format_price(valor)}/{base}, abaixo do seu limite de R$ {format_price(alerta['limite'])}/{base}."
+            ))
+
+async def enviar_notificacoes():
+    """Consome a fila de notificações; roda como tarefa em segundo plano desde o start_bot."""
+    while True:
+        chat_id, texto = await _fila_notificacoes.get()
+        try:
+            await bot_application.bot.send_message(chat_id, texto, parse_mode="Markdown")
+        except Exception as e:
+            logging.error("Erro ao enviar alerta de preço para chat %s: %s", chat_id, e)
+        finally:
+            _fila_notificacoes.task_done()
+        await asyncio.sleep(0.05)  # Fica bem abaixo do limite de ~30 mensagens/s do Telegram
+
+@registrar_gancho_encerramento
+async def esvaziar_fila_notificacoes():
+    if _tarefa_notificacoes is None:
+        return
+    try:
+        await asyncio.wait_for(_fila_notificacoes.join(), timeout=10)
+    except asyncio.TimeoutError:
+        logging.warning("%s alerta(s) de preço não foram enviados antes do encerramento.", _fila_notificacoes.qsize())
+    _tarefa_notificacoes.cancel()
+
+async def price_alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    partes = update.message.text.split(maxsplit=1)
+    match = re.match(r"^(.+?)\s*<\s*(?:R\$\s*)?(\d+(?:[.,]\d+)?)\s*(?:/\s*([a-zA-Z]+))?\s*$", partes[1]) if len(partes) > 1 else None
+    unidade_base = _UNIDADES_ALERTA.get(match.group(3).lower()) if match and match.group(3) else None
+    if not match or (match.group(3) and not unidade_base):
+        await update.message.reply_text(
+            "🔔 Para criar um alerta use:\n"
+            "*/alerta Produto < Preço/unidade*\n"
+            "*Exemplos:*\n"
+            "• /alerta Café < 15/kg\n"
+            "• /alerta Leite < 4.50/L\n"
+            "• /alerta Ovo < 0.60/und\n"
+            "Unidades: kg, L, m, und, rolo, folha. Veja seus alertas com /alertas.",
+            parse_mode="Markdown"
+        )
+        return
+    produto = match.group(1).strip().title()
+    limite = parse_price(match.group(2))
+    user_id = update.effective_user.id
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        response = obter_supabase().table("alertas_preco").insert({
+            "user_id": user_id,
+            "chat_id": update.effective_chat.id,
+            "grupo_id": grupo_id,
+            "produto": produto,
+            "produto_chave": normalizar_campo_produto(produto),
+            "limite": limite,
+            "unidade_base": unidade_base,
+        }).execute()
+        indexar_alerta(response.data[0])
+        unidade_texto = f"/{unidade_base}" if unidade_base else ""
+        await update.message.reply_text(
+            f"🔔 Combinado! Aviso quando *{produto}* for registrado abaixo de R$ {format_price(limite)}{unidade_texto}.",
+            parse_mode="Markdown"
+        )
+    except Exception as e:
+        logging.error("Erro ao criar alerta de preço para user_id %s: %s", user_id, e)
+        await update.message.reply_text("❌ Erro ao criar o alerta. Tente novamente mais tarde.")
+
+def alertas_do_usuario(user_id):
+    return sorted(
+        (a for produtos in _indice_alertas.values() for alertas in produtos.values() for a in alertas if a['user_id'] == user_id),
+        key=lambda a: a['id']
+    )
+
+async def list_price_alerts(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    alertas = alertas_do_usuario(update.effective_user.id)
+    if not alertas:
+        await update.message.reply_text("🔕 Você não tem alertas de preço. Crie um com /alerta Café < 15/kg")
+        return
+    texto = "🔔 *Seus alertas de preço:*\n"
+    for idx, alerta in enumerate(alertas):
+        unidade_texto = f"/{alerta['unidade_base']}" if alerta['unidade_base'] else ""
+        texto += f"{idx + 1}. {alerta['produto']} < R$ {format_price(alerta['limite'])}{unidade_texto}\n"
+    texto += "\nPara remover: /alerta\\_remover *número*"
+    await update.message.reply_text(texto, parse_mode="Markdown")
+
+async def remove_price_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    alertas = alertas_do_usuario(update.effective_user.id)
+    try:
+        alerta = alertas[int(context.args[0]) - 1]
+    except (IndexError, ValueError):
+        await update.message.reply_text("⚠️ Informe o número do alerta mostrado em /alertas. Ex: /alerta_remover 1")
+        return
+    try:
+        obter_supabase().table("alertas_preco").delete().eq("id", alerta['id']).eq("user_id", alerta['user_id']).execute()
+        _indice_alertas[alerta['grupo_id']][alerta['produto_chave']].remove(alerta)
+        await update.message.reply_text(f"🔕 Alerta de *{alerta['produto']}* removido.", parse_mode="Markdown")
+    except Exception as e:
+        logging.error("Erro ao remover alerta %s: %s", alerta['id'], e)
+        await update.message.reply_text("❌ Erro ao remover o alerta. Tente novamente mais tarde.")
+
 # ========================
 # Editar/Excluir produto
 # ========================
@@ -661,20 +2474,23 @@ async def handle_edit_delete_choice(update: Update, context: ContextTypes.DEFAUL
         return await cancel(update, context)
 
     search_term = update.message.text.strip().title()
+    termo_normalizado = normalizar_campo_produto(search_term)
     user_id = update.effective_user.id
     try:
         grupo_id = await get_grupo_id(user_id)
 
         # Função auxiliar para buscar todos os produtos com paginação
         def fetch_all_products():
+            if _replica is not None:
+                return _replica.buscar(grupo_id, termo_normalizado)
             all_data = []
             offset = 0
             page_size = 101 # Ajuste conforme necessário, 100 é um valor comum
             while True:
-                response = (supabase.table("produtos")
-                            .select("id, nome, tipo, marca, unidade, preco, observacoes")
+                response = (obter_supabase().table("produtos")
+                            .select("id, nome, tipo, marca, unidade, preco, observacoes, versao")
                             .eq("grupo_id", grupo_id)
-                            .ilike("nome", f"%{search_term}%") # Usar ilike para busca parcial
+                            .ilike("nome_normalizado", f"%{termo_normalizado}%") # Usar ilike para busca parcial
                             .order("timestamp", desc=True)
                             .range(offset, offset + page_size - 1)
                             .execute())
@@ -687,7 +2503,8 @@ async def handle_edit_delete_choice(update: Update, context: ContextTypes.DEFAUL
                 offset += page_size
             return all_data
 
-        matching_products = fetch_all_products()
+        # Só as colunas usadas pelo fluxo ficam em user_data
+        matching_products = [ProdutoSelecionado.de_linha(linha) for linha in fetch_all_products()]
 
         if not matching_products:
             await update.message.reply_text(
@@ -701,18 +2518,18 @@ async def handle_edit_delete_choice(update: Update, context: ContextTypes.DEFAUL
             product = matching_products[0]
             context.user_data['editing_product'] = product
             keyboard = [
-                [InlineKeyboardButton("✏️ Editar Preço", callback_data=f"edit_price_{product['id']}")],
-                [InlineKeyboardButton("🗑️ Excluir", callback_data=f"delete_{product['id']}")]
+                [InlineKeyboardButton("✏️ Editar Preço", callback_data=f"edit_price_{product.id}")],
+                [InlineKeyboardButton("🗑️ Excluir", callback_data=f"delete_{product.id}")]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await update.message.reply_text(
                 f"✏️ *Produto Selecionado:*\n"
-                f"📦 *{product['nome']}*\n"
-                f"🏷️ *Tipo:* {product['tipo']}\n"
-                f"🏭 *Marca:* {product['marca']}\n"
-                f"📏 *Unidade:* {product['unidade']}\n"
-                f"💰 *Preço:* R$ {format_price(product['preco'])}\n"
-                f"📝 *Observações:* {product['observacoes'] or ''}\n"
+                f"📦 *{product.nome}*\n"
+                f"🏷️ *Tipo:* {product.tipo}\n"
+                f"🏭 *Marca:* {product.marca}\n"
+                f"📏 *Unidade:* {product.unidade}\n"
+                f"💰 *Preço:* R$ {format_price(product.preco)}\n"
+                f"📝 *Observações:* {product.observacoes or ''}\n"
                 f"Escolha uma ação:",
                 reply_markup=reply_markup,
                 parse_mode="Markdown"
@@ -723,14 +2540,15 @@ async def handle_edit_delete_choice(update: Update, context: ContextTypes.DEFAUL
         # Correção: Sempre listar produtos encontrados como texto com numeração
         context.user_data['pending_products'] = matching_products # Armazena a lista para uso posterior
         texto_lista = f"🔍 Encontrei {len(matching_products)} produto(s) com o nome semelhante a '{search_term}'.\n\n"
-        texto_lista += "Por favor, digite o *número* do produto que deseja editar ou excluir:\n\n"
+        texto_lista += "Por favor, digite o *número* do produto que deseja editar ou excluir.\n"
+        texto_lista += "Para vários de uma vez, separe por vírgula ou use intervalos (ex: 1,3,5-8):\n\n"
 
         for idx, prod in enumerate(matching_products):
-            marca = f" - {prod['marca']}" if prod.get('marca') and prod['marca'].strip() else ""
-            preco_str = format_price(prod['preco'])
-            obs = f" ({prod['observacoes']})" if prod.get('observacoes') and prod['observacoes'].strip() else ""
+            marca = f" - {prod.marca}" if prod.marca and prod.marca.strip() else ""
+            preco_str = format_price(prod.preco)
+            obs = f" ({prod.observacoes})" if prod.observacoes and prod.observacoes.strip() else ""
             # Formato: 1. Nome - Marca (Tipo, Unidade, R$Preco) (Obs)
-            texto_lista += f"{idx + 1}. *{prod['nome']}*{marca} ({prod['tipo']}, {prod['unidade']}, R${preco_str}){obs}\n"
+            texto_lista += f"{idx + 1}. *{prod.nome}*{marca} ({prod.tipo}, {prod.unidade}, R${preco_str}){obs}\n"
 
         # Correção: Garantir botão de Cancelar na tela de escolha
         await update.message.reply_text(texto_lista, parse_mode="Markdown", reply_markup=cancel_keyboard())
@@ -738,7 +2556,7 @@ async def handle_edit_delete_choice(update: Update, context: ContextTypes.DEFAUL
         return AWAIT_ENTRY_CHOICE
 
     except Exception as e:
-        logging.error(f"Erro ao buscar produto '{search_term}' para edição/exclusão: {e}", exc_info=True) # Adiciona exc_info para mais detalhes
+        logging.error("Erro ao buscar produto '%s' para edição/exclusão: %s", search_term, e, exc_info=True) # Adiciona exc_info para mais detalhes
         await update.message.reply_text(
             "❌ Erro ao acessar os produtos. Tente novamente mais tarde.",
             reply_markup=main_menu_keyboard()
@@ -752,53 +2570,206 @@ async def process_entry_choice(update: Update, context: ContextTypes.DEFAULT_TYP
     if update.message.text == "❌ Cancelar":
         return await cancel(update, context)
 
-    try:
-        choice = int(update.message.text)
-    except ValueError:
-        await update.message.reply_text("⚠️ Entrada inválida. Por favor, digite apenas o *número* do produto.", reply_markup=cancel_keyboard(), parse_mode="Markdown")
-        return AWAIT_ENTRY_CHOICE # Permanece no mesmo estado
-
     pending_products = context.user_data.get('pending_products')
     if not pending_products or not isinstance(pending_products, list):
-         await update.message.reply_text("❌ Erro ao recuperar a lista de produtos. Tente novamente.", reply_markup=main_menu_keyboard())
-         return AWAIT_ACTION_CHOICE # <--- CORRETO
+        return await conversa_expirada(update)
 
-    if choice < 1 or choice > len(pending_products):
-        await update.message.reply_text(f"⚠️ Número inválido. Escolha um número entre 1 e {len(pending_products)}.", reply_markup=cancel_keyboard())
-        # Reenvia a lista para facilitar
-        # (Opcional: reenviar a lista aqui, mas pode ser verboso. Só pede o número novamente)
+    escolhas = parse_selecao(update.message.text, len(pending_products))
+    if not escolhas:
+        await update.message.reply_text(
+            f"⚠️ Entrada inválida. Digite o *número* do produto (entre 1 e {len(pending_products)}) "
+            f"ou vários números, como 1,3,5-8.",
+            reply_markup=cancel_keyboard(),
+            parse_mode="Markdown"
+        )
         return AWAIT_ENTRY_CHOICE # Permanece no mesmo estado
 
-    selected_product = pending_products[choice - 1]
+    if len(escolhas) > 1:
+        return await show_bulk_selection(update, context, [pending_products[i - 1] for i in escolhas])
+
+    selected_product = pending_products[escolhas[0] - 1]
     context.user_data['editing_product'] = selected_product # Reutiliza a chave editing_product
 
     # Criar teclado inline para Editar/Excluir o produto selecionado
     keyboard = [
-        [InlineKeyboardButton("✏️ Editar Preço", callback_data=f"edit_price_{selected_product['id']}")],
-        [InlineKeyboardButton("🗑️ Excluir", callback_data=f"delete_{selected_product['id']}")]
+        [InlineKeyboardButton("✏️ Editar Preço", callback_data=f"edit_price_{selected_product.id}")],
+        [InlineKeyboardButton("🗑️ Excluir", callback_data=f"delete_{selected_product.id}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    marca_display = f" - {selected_product['marca']}" if selected_product.get('marca') and selected_product['marca'].strip() else ""
-    obs_display = f"\n📝 *Observações:* {selected_product['observacoes']}" if selected_product.get('observacoes') and selected_product['observacoes'].strip() else ""
-
-await update.message.reply_text(
-    f"✏️ *Produto Selecionado:*\n"
-    f"📦 *{selected_product['nome']}*{marca_display}\n"
-    f"🏷️ *Tipo:* {selected_product['tipo']}\n"
-    f"📏 *Unidade:* {selected_product['unidade']}\n"
-    f"💰 *Preço:* R$ {format_price(selected_product['preco'])}"
-    f"{obs_display}\n\n"
-    f"Escolha uma ação:",
-    reply_markup=reply_markup,
-    parse_mode="Markdown"
-)
-# Sai do estado AWAIT_ENTRY_CHOICE e entra no estado que aguarda o clique nos botões inline
-return AWAIT_ACTION_CHOICE # <--- LINHA CORRIGIDA
+    marca_display = f" - {selected_product.marca}" if selected_product.marca and selected_product.marca.strip() else ""
+    obs_display = f"\n📝 *Observações:* {selected_product.observacoes}" if selected_product.observacoes and selected_product.observacoes.strip() else ""
+
+    await update.message.reply_text(
+        f"✏️ *Produto Selecionado:*\n"
+        f"📦 *{selected_product.nome}*{marca_display}\n"
+        f"🏷️ *Tipo:* {selected_product.tipo}\n"
+        f"📏 *Unidade:* {selected_product.unidade}\n"
+        f"💰 *Preço:* R$ {format_price(selected_product.preco)}"
+        f"{obs_display}\n\n"
+        f"Escolha uma ação:",
+        reply_markup=reply_markup,
+        parse_mode="Markdown"
+    )
+    # Sai do estado AWAIT_ENTRY_CHOICE e entra no estado que aguarda o clique nos botões inline
+    return AWAIT_ACTION_CHOICE # <--- LINHA CORRIGIDA
     
+# ========================
+# Seleção múltipla: exclusão e edição de preço em lote
+# ========================
+def parse_selecao(texto: str, total: int):
+    """Converte "1,3,5-8" em [1, 3, 5, 6, 7, 8]. Retorna None se algum número estiver fora de 1..total."""
+    escolhas = set()
+    for parte in re.split(r"[,;\s]+", re.sub(r"\s*-\s*", "-", texto.strip())):
+        if not parte:
+            continue
+        intervalo = re.fullmatch(r"(\d+)-(\d+)", parte)
+        if intervalo:
+            inicio, fim = int(intervalo.group(1)), int(intervalo.group(2))
+        elif parte.isdigit():
+            inicio = fim = int(parte)
+        else:
+            return None
+        if inicio < 1 or fim > total or inicio > fim:
+            return None
+        escolhas.update(range(inicio, fim + 1))
+    return sorted(escolhas) or None
+
+def formatar_produtos_selecionados(produtos: list) -> str:
+    texto = ""
+    for idx, prod in enumerate(produtos):
+        marca = f" - {prod.marca}" if prod.marca and prod.marca.strip() else ""
+        texto += f"{idx + 1}. *{prod.nome}*{marca} ({prod.tipo}, {prod.unidade}, R${format_price(prod.preco)})\n"
+    return texto
+
+async def show_bulk_selection(update: Update, context: ContextTypes.DEFAULT_TYPE, produtos: list):
+    context.user_data['selected_products'] = produtos
+    keyboard = [
+        [InlineKeyboardButton(f"✏️ Editar Preços ({len(produtos)})", callback_data="bulk_edit")],
+        [InlineKeyboardButton(f"🗑️ Excluir Todos ({len(produtos)})", callback_data="bulk_delete")]
+    ]
+    await update.message.reply_text(
+        f"✏️ *{len(produtos)} Produtos Selecionados:*\n"
+        f"{formatar_produtos_selecionados(produtos)}\n"
+        f"Escolha uma ação:",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    return AWAIT_ACTION_CHOICE
+
+async def bulk_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    produtos = context.user_data.get('selected_products')
+    if not produtos:
+        await query.edit_message_text("❌ Seleção não encontrada. Busque os produtos novamente.")
+        await query.message.reply_text("...", reply_markup=main_menu_keyboard())
+        return MAIN_MENU
+    await query.edit_message_text(
+        f"🗑️ *Excluir {len(produtos)} Produtos:*\n"
+        f"{formatar_produtos_selecionados(produtos)}",
+        parse_mode="Markdown"
+    )
+    await query.message.reply_text(
+        "Tem certeza que deseja excluir todos esses produtos?",
+        reply_markup=ReplyKeyboardMarkup([[KeyboardButton("✅ Confirmar"), KeyboardButton("❌ Cancelar")]], resize_keyboard=True)
+    )
+    return CONFIRM_BULK_DELETION
+
+async def confirm_bulk_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text != "✅ Confirmar":
+        return await cancel(update, context)
+    produtos = context.user_data.get('selected_products')
+    if not produtos:
+        return await conversa_expirada(update)
+    limpar_estado_conversa(context)  # O fluxo termina aqui, com ou sem sucesso
+    user_id = update.effective_user.id
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        excluidos = excluir_produtos_em_lote(produtos, grupo_id)
+        invalidar_caches_grupo(grupo_id)
+        logging.info("%s produto(s) excluídos em lote do Supabase: %s", len(excluidos), excluidos)
+        texto = f"✅ {len(excluidos)} produto(s) excluído(s) com sucesso!"
+        if len(excluidos) < len(produtos):
+            texto += f"\n⚠️ {len(produtos) - len(excluidos)} produto(s) foram alterados ou excluídos por outra pessoa do grupo e ficaram como estavam."
+        await update.message.reply_text(texto, reply_markup=main_menu_keyboard())
+    except Exception as e:
+        logging.error("Erro ao excluir produtos em lote: %s", e)
+        await update.message.reply_text("❌ Erro ao excluir produtos. Tente novamente mais tarde.", reply_markup=main_menu_keyboard())
+    return MAIN_MENU
+
+async def bulk_edit_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    produtos = context.user_data.get('selected_products')
+    if not produtos:
+        await query.edit_message_text("❌ Seleção não encontrada. Busque os produtos novamente.")
+        await query.message.reply_text("...", reply_markup=main_menu_keyboard())
+        return MAIN_MENU
+    await query.edit_message_text(
+        f"✏️ *Editar Preços de {len(produtos)} Produtos:*\n"
+        f"{formatar_produtos_selecionados(produtos)}\n"
+        f"Digite os *novos preços, um por linha*, na mesma ordem da lista,\n"
+        f"ou um único preço para aplicar a todos (use **ponto como separador decimal**):",
+        parse_mode="Markdown"
+    )
+    await query.message.reply_text("...", reply_markup=cancel_keyboard())
+    return AWAIT_BULK_PRICES
+
+async def handle_bulk_prices_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.text == "❌ Cancelar":
+        return await cancel(update, context)
+    produtos = context.user_data.get('selected_products')
+    if not produtos:
+        return await conversa_expirada(update)
+    precos = [parse_price(linha.strip()) for linha in update.message.text.strip().splitlines() if linha.strip()]
+    if len(precos) == 1:
+        precos = precos * len(produtos)
+    if len(precos) != len(produtos) or not all(preco_valido(preco) for preco in precos):
+        await update.message.reply_text(
+            f"⚠️ Envie {len(produtos)} preços válidos, maiores que zero (um por linha), ou um único preço para todos.\n"
+            "Use **ponto como separador decimal** (ex: 4.99).",
+            reply_markup=cancel_keyboard(),
+            parse_mode="Markdown"
+        )
+        return AWAIT_BULK_PRICES
+    limpar_estado_conversa(context)  # O fluxo termina aqui, com ou sem sucesso
+    user_id = update.effective_user.id
+    try:
+        grupo_id = await get_grupo_id(user_id)
+        # O preço por unidade de cada linha é recalculado a partir da sua própria unidade
+        itens = [
+            {"id": produto.id, "versao": produto.versao, **campos_novo_preco(produto.unidade, preco)}
+            for produto, preco in zip(produtos, precos)
+        ]
+        atualizados = set(str(i) for i in atualizar_precos_em_lote(itens, grupo_id))
+        invalidar_caches_grupo(grupo_id)
+        for produto, preco in zip(produtos, precos):
+            if str(produto.id) in atualizados:
+                avaliar_alertas(grupo_id, produto.nome, produto.unidade, preco)
+        logging.info("%s preço(s) atualizados em lote no Supabase.", len(atualizados))
+        texto = f"✅ {len(atualizados)} preço(s) atualizado(s) com sucesso!"
+        if len(atualizados) < len(produtos):
+            texto += f"\n⚠️ {len(produtos) - len(atualizados)} produto(s) foram alterados ou excluídos por outra pessoa do grupo e ficaram como estavam."
+        await update.message.reply_text(texto, reply_markup=main_menu_keyboard())
+    except Exception as e:
+        logging.error("Erro ao atualizar preços em lote: %s", e)
+        await update.message.reply_text("❌ Erro ao atualizar preços. Tente novamente mais tarde.", reply_markup=main_menu_keyboard())
+    return MAIN_MENU
+
 # ========================
 # Callbacks para editar/excluir
 # ========================
+async def obter_produto_selecionado(context: ContextTypes.DEFAULT_TYPE, product_id: str, grupo_id: str):
+    """Produto escolhido na busca, já guardado em user_data (com sua versao).
+    Só volta ao banco se o botão for de uma conversa antiga."""
+    candidatos = [context.user_data.get('editing_product')] + (context.user_data.get('pending_products') or [])
+    for produto in candidatos:
+        if produto and produto.id == product_id:
+            return produto
+    linha = buscar_produto_do_grupo(product_id, grupo_id)
+    return ProdutoSelecionado.de_linha(linha) if linha else None
+
 async def edit_price_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -806,8 +2777,7 @@ async def edit_price_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = query.from_user.id
     try:
         grupo_id = await get_grupo_id(user_id)
-        response = supabase.table("produtos").select("*").eq("id", product_id).eq("grupo_id", grupo_id).limit(1).execute()
-        product = response.data[0] if response.data else None
+        product = await obter_produto_selecionado(context, product_id, grupo_id)
         if not product:
             await query.edit_message_text("❌ Produto não encontrado ou você não tem permissão para editá-lo.")
             await query.message.reply_text("...", reply_markup=main_menu_keyboard())
@@ -815,18 +2785,18 @@ async def edit_price_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data['editing_product'] = product
         await query.edit_message_text(
             f"✏️ *Editar Preço do Produto:*\n"
-            f"📦 *{product['nome']}*\n"
-            f"🏷️ *Tipo:* {product['tipo']}\n"
-            f"🏭 *Marca:* {product['marca']}\n"
-            f"📏 *Unidade:* {product['unidade']}\n"
-            f"💰 *Preço Atual:* R$ {format_price(product['preco'])}\n"
+            f"📦 *{product.nome}*\n"
+            f"🏷️ *Tipo:* {product.tipo}\n"
+            f"🏭 *Marca:* {product.marca}\n"
+            f"📏 *Unidade:* {product.unidade}\n"
+            f"💰 *Preço Atual:* R$ {format_price(product.preco)}\n"
             f"Digite o *novo preço* (use **ponto como separador decimal**):",
             parse_mode="Markdown"
         )
         await query.message.reply_text("...", reply_markup=cancel_keyboard())
         return AWAIT_EDIT_PRICE
     except Exception as e:
-        logging.error(f"Erro ao preparar edição de preço para produto ID {product_id}: {e}")
+        logging.error("Erro ao preparar edição de preço para produto ID %s: %s", product_id, e)
         await query.edit_message_text("❌ Erro ao preparar edição. Tente novamente mais tarde.")
         await query.message.reply_text("...", reply_markup=main_menu_keyboard())
         return MAIN_MENU
@@ -836,7 +2806,7 @@ async def handle_edit_price_input(update: Update, context: ContextTypes.DEFAULT_
         return await cancel(update, context)
     new_price_str = update.message.text.strip()
     new_price = parse_price(new_price_str)
-    if new_price is None:
+    if not preco_valido(new_price):
         await update.message.reply_text(
             "⚠️ Preço inválido. Use **ponto como separador decimal** (ex: 4.99).\n"
             "Por favor, digite novamente o novo preço:",
@@ -846,55 +2816,37 @@ async def handle_edit_price_input(update: Update, context: ContextTypes.DEFAULT_
         return AWAIT_EDIT_PRICE
     product = context.user_data.get('editing_product')
     if not product:
-        await update.message.reply_text("❌ Erro ao editar preço. Tente novamente.")
-        return MAIN_MENU
+        return await conversa_expirada(update)
+    limpar_estado_conversa(context)  # O fluxo termina aqui, com ou sem sucesso
     user_id = update.effective_user.id
     try:
         grupo_id = await get_grupo_id(user_id)
-        check_response = supabase.table("produtos").select("id, preco_por_unidade_formatado").eq("id", product['id']).eq("grupo_id", grupo_id).limit(1).execute()
-        if not check_response.data:
-            await update.message.reply_text("❌ Você não tem permissão para editar este produto.")
-            return MAIN_MENU
-        unit_info = calculate_unit_price(product['unidade'], new_price)
-        if 'preco_por_metro' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_metro'])}/metro"
-        elif 'preco_por_100g' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_100g'])}/100g"
-        elif 'preco_por_kg' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_kg'])}/kg"
-        elif 'preco_por_100ml' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_100ml'])}/100ml"
-        elif 'preco_por_litro' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_litro'])}/L"
-        elif 'preco_por_unidade' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_unidade'])}/unidade"
-        elif 'preco_por_embalagem' in unit_info:
-            if 'preco_por_100' in unit_info:
-                new_unit_price_str = f"R$ {format_price(unit_info['preco_por_100'])}/100(g/ml)"
-            elif 'preco_por_100_base' in unit_info:
-                new_unit_price_str = f"R$ {format_price(unit_info['preco_por_100_base'])}/100(g/ml)"
+        updated_product = campos_novo_preco(product.unidade, new_price)
+        response = atualizar_produto_condicional(product.id, grupo_id, product.versao, updated_product)
+        if response is None:
+            if buscar_produto_do_grupo(product.id, grupo_id) is None:
+                await update.message.reply_text(
+                    "❌ Este produto não existe mais ou não é do seu grupo ativo. Nada foi alterado.",
+                    reply_markup=main_menu_keyboard()
+                )
             else:
-                new_unit_price_str = f"R$ {format_price(unit_info['preco_por_embalagem'])}/embalagem"
-        elif 'preco_por_rolo' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_rolo'])}/rolo"
-        elif 'preco_por_folha' in unit_info:
-            new_unit_price_str = f"R$ {format_price(unit_info['preco_por_folha'])}/folha"
-        else:
-            new_unit_price_str = f"R$ {format_price(new_price)}/unidade"
-        
-        updated_product = {
-            "preco": new_price,
-            "preco_por_unidade_formatado": new_unit_price_str,
-        }
-        response = supabase.table("produtos").update(updated_product).eq("id", product['id']).execute()
-        logging.info(f"Produto ID {product['id']} atualizado no Supabase. Resposta: {response}")
+                await update.message.reply_text(
+                    "⚠️ Este produto foi alterado por outra pessoa do grupo enquanto você editava.\n"
+                    "Busque o produto novamente para ver o preço atual.",
+                    reply_markup=main_menu_keyboard()
+                )
+            return MAIN_MENU
+        invalidar_caches_grupo(grupo_id)
+        avaliar_alertas(grupo_id, product.nome, product.unidade, new_price)
+        logging.info("Produto ID %s atualizado no Supabase.", product.id)
+        log_verboso("Resposta do Supabase ao atualizar produto: %s", response)
         await update.message.reply_text(
-            f"✅ Preço do produto *{product['nome']}* atualizado com sucesso para R$ {format_price(new_price)}!",
+            f"✅ Preço do produto *{product.nome}* atualizado com sucesso para R$ {format_price(new_price)}!",
             reply_markup=main_menu_keyboard(),
             parse_mode="Markdown"
         )
     except Exception as e:
-        logging.error(f"Erro ao atualizar preço do produto ID {product['id']}: {e}")
+        logging.error("Erro ao atualizar preço do produto ID %s: %s", product.id, e)
         await update.message.reply_text(
             "❌ Erro ao atualizar preço. Tente novamente mais tarde.",
             reply_markup=main_menu_keyboard()
@@ -908,8 +2860,7 @@ async def delete_product_callback(update: Update, context: ContextTypes.DEFAULT_
     user_id = query.from_user.id
     try:
         grupo_id = await get_grupo_id(user_id)
-        response = supabase.table("produtos").select("*").eq("id", product_id).eq("grupo_id", grupo_id).limit(1).execute()
-        product = response.data[0] if response.data else None
+        product = await obter_produto_selecionado(context, product_id, grupo_id)
         if not product:
             await query.edit_message_text("❌ Produto não encontrado ou você não tem permissão para excluí-lo.")
             await query.message.reply_text("...", reply_markup=main_menu_keyboard())
@@ -917,19 +2868,19 @@ async def delete_product_callback(update: Update, context: ContextTypes.DEFAULT_
         context.user_data['deleting_product'] = product
         await query.edit_message_text(
             f"🗑️ *Excluir Produto:*\n"
-            f"📦 *{product['nome']}*\n"
-            f"🏷️ *Tipo:* {product['tipo']}\n"
-            f"🏭 *Marca:* {product['marca']}\n"
-            f"📏 *Unidade:* {product['unidade']}\n"
-            f"💰 *Preço:* R$ {format_price(product['preco'])}\n"
-            f"📝 *Observações:* {product['observacoes']}\n"
+            f"📦 *{product.nome}*\n"
+            f"🏷️ *Tipo:* {product.tipo}\n"
+            f"🏭 *Marca:* {product.marca}\n"
+            f"📏 *Unidade:* {product.unidade}\n"
+            f"💰 *Preço:* R$ {format_price(product.preco)}\n"
+            f"📝 *Observações:* {product.observacoes}\n"
             f"Tem certeza que deseja excluir este produto?",
             reply_markup=ReplyKeyboardMarkup([[KeyboardButton("✅ Confirmar"), KeyboardButton("❌ Cancelar")]], resize_keyboard=True),
             parse_mode="Markdown"
         )
         return CONFIRM_DELETION
     except Exception as e:
-        logging.error(f"Erro ao preparar exclusão para produto ID {product_id}: {e}")
+        logging.error("Erro ao preparar exclusão para produto ID %s: %s", product_id, e)
         await query.edit_message_text("❌ Erro ao preparar exclusão. Tente novamente mais tarde.")
         await query.message.reply_text("...", reply_markup=main_menu_keyboard())
         return MAIN_MENU
@@ -939,53 +2890,493 @@ async def confirm_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await cancel(update, context)
     product = context.user_data.get('deleting_product')
     if not product:
-        await update.message.reply_text("❌ Erro ao confirmar exclusão. Tente novamente.")
-        return MAIN_MENU
+        return await conversa_expirada(update)
+    limpar_estado_conversa(context)  # O fluxo termina aqui, com ou sem sucesso
     user_id = update.effective_user.id
     try:
         grupo_id = await get_grupo_id(user_id)
-        check_response = supabase.table("produtos").select("id").eq("id", product['id']).eq("grupo_id", grupo_id).limit(1).execute()
-        if not check_response.data:
-            await update.message.reply_text("❌ Você não tem permissão para excluir este produto.")
+        if not excluir_produto_condicional(product.id, grupo_id, product.versao):
+            if buscar_produto_do_grupo(product.id, grupo_id) is None:
+                await update.message.reply_text(
+                    "❌ Este produto já foi excluído ou não é do seu grupo ativo.",
+                    reply_markup=main_menu_keyboard()
+                )
+            else:
+                await update.message.reply_text(
+                    "⚠️ Este produto foi alterado por outra pessoa do grupo. Nada foi excluído.\n"
+                    "Busque o produto novamente para ver a versão atual.",
+                    reply_markup=main_menu_keyboard()
+                )
             return MAIN_MENU
-        response = supabase.table("produtos").delete().eq("id", product['id']).execute()
-        logging.info(f"Produto ID {product['id']} excluído do Supabase. Resposta: {response}")
+        invalidar_caches_grupo(grupo_id)
+        logging.info("Produto ID %s excluído do Supabase.", product.id)
         await update.message.reply_text(
-            f"✅ Produto *{product['nome']}* excluído com sucesso!",
+            f"✅ Produto *{product.nome}* excluído com sucesso!",
             reply_markup=main_menu_keyboard(),
             parse_mode="Markdown"
         )
     except Exception as e:
-        logging.error(f"Erro ao excluir produto ID {product['id']}: {e}")
+        logging.error("Erro ao excluir produto ID %s: %s", product.id, e)
         await update.message.reply_text(
             "❌ Erro ao excluir produto. Tente novamente mais tarde.",
             reply_markup=main_menu_keyboard()
         )
     return MAIN_MENU
 
+# ========================
+# Roteamento dos botões do teclado
+# ========================
+# Uma tabela só (texto exato do botão -> handler) serve aos entry points do
+# ConversationHandler e ao estado MAIN_MENU: um lookup num dict em vez de um
+# filters.Regex por botão avaliado em sequência e de uma cadeia de if/elif.
+ROTAS_BOTOES = {
+    "➕ Adicionar Produto": ask_for_product_data,
+    "✏️ Editar ou Excluir": ask_for_edit_delete_choice,
+    "📋 Listar Produtos": list_products,
+    "🔍 Pesquisar Produto": search_product_input,
+    "ℹ️ Ajuda": help_command,
+    "👪 Compartilhar Lista": compartilhar_lista_callback,
+    "🔐 Inserir Código": ask_for_invite_code,
+}
+# Botões sem ação fora do próprio estado: no MAIN_MENU só devolvem o aviso. O
+# "❌ Cancelar" exato é tratado antes, em handle_search_product_input e nos fallbacks.
+BOTOES_SEM_ROTA = frozenset({"✅ Confirmar", "❌ Cancelar"})
+BOTOES_ESPECIAIS = frozenset(ROTAS_BOTOES) | BOTOES_SEM_ROTA
+# Os botões do main_menu_keyboard iniciam a conversa de qualquer lugar
+BOTOES_MENU_PRINCIPAL = frozenset({
+    "➕ Adicionar Produto", "✏️ Editar ou Excluir", "📋 Listar Produtos",
+    "🔍 Pesquisar Produto", "ℹ️ Ajuda",
+})
+FILTRO_BOTOES_MENU = filters.Text(BOTOES_MENU_PRINCIPAL)
+
+async def despachar_botao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rota = ROTAS_BOTOES.get(update.message.text.strip())
+    if rota is None:
+        # Para outros botões, volta ao menu principal
+        await update.message.reply_text("⚠️ Por favor, use os botões do menu principal para navegar.", reply_markup=main_menu_keyboard())
+        return MAIN_MENU
+    return await rota(update, context)
+
+# ========================
+# Deduplicação de updates (update_id)
+# ========================
+# O Telegram reenvia o update quando a resposta 200 demora. Guardamos os últimos
+# update_id vistos (conjunto + fila circular) para descartar a reentrega antes do
+# Update.de_json. Com DEDUP_SUPABASE, a tabela updates_processados compartilha
+# essa informação entre réplicas.
+_updates_vistos = set()
+_updates_vistos_ordem = deque()
+_dedup_lock = Lock()
+
+def registrar_update_id(update_id) -> bool:
+    """Retorna True se o update é novo e False se já foi recebido antes."""
+    if update_id is None:
+        return True
+    with _dedup_lock:
+        metricas["updates_recebidos"] += 1
+        if update_id in _updates_vistos:
+            metricas["updates_duplicados"] += 1
+            return False
+        _updates_vistos.add(update_id)
+        _updates_vistos_ordem.append(update_id)
+        if len(_updates_vistos_ordem) > DEDUP_MAX_IDS:
+            _updates_vistos.discard(_updates_vistos_ordem.popleft())
+
+    if DEDUP_SUPABASE:
+        try:
+            # ignore_duplicates: se o update_id já existe, nenhuma linha é devolvida
+            resp = (obter_supabase().table("updates_processados")
+                    .upsert({"update_id": update_id}, on_conflict="update_id", ignore_duplicates=True)
+                    .execute())
+            if not resp.data:
+                with _dedup_lock:
+                    metricas["updates_duplicados"] += 1
+                return False
+        except Exception as e:
+            # Na dúvida, processa: perder um update é pior que processá-lo duas vezes
+            logging.warning("Falha ao consultar deduplicação compartilhada para update %s: %s", update_id, e)
+    return True
+
+def esquecer_update_id(update_id):
+    """Remove o update_id da memória local para que a reentrega do Telegram seja aceita."""
+    with _dedup_lock:
+        if update_id in _updates_vistos:
+            _updates_vistos.discard(update_id)
+            # Quase sempre é o último registrado; senão, remove do meio da janela
+            if _updates_vistos_ordem and _updates_vistos_ordem[-1] == update_id:
+                _updates_vistos_ordem.pop()
+            else:
+                _updates_vistos_ordem.remove(update_id)
+    if DEDUP_SUPABASE:
+        try:
+            obter_supabase().table("updates_processados").delete().eq("update_id", update_id).execute()
+        except Exception as e:
+            logging.warning("Falha ao liberar update %s na deduplicação compartilhada: %s", update_id, e)
+
+# ========================
+# Justiça entre grupos e cotas
+# ========================
+# Aplicado em processar_update, antes de qualquer handler. Cada usuário tem um
+# balde de tokens e processa um update por vez (o que também mantém a ordem das
+# mensagens dentro de uma conversa); cada grupo tem outro balde e no máximo
+# GRUPO_MAX_CONCORRENTES updates em execução, com uma fila curta de espera. Fora
+# da cota o update é recusado com um aviso educado, e os contadores por grupo
+# aparecem em /metrics. Consultas inline ficam de fora: já têm debounce e cache.
+AVISO_COTA_INTERVALO = 30  # Segundos entre dois avisos de cota para o mesmo usuário
+COTA_MAX_BALDES = 50000  # Baldes em memória; os menos usados (já cheios) são descartados
+
+class BaldeTokens:
+    __slots__ = ("taxa", "capacidade", "tokens", "atualizado")
+
+    def __init__(self, taxa: float, capacidade: int):
+        self.taxa = taxa
+        self.capacidade = capacidade
+        self.tokens = float(capacidade)
+        self.atualizado = time.monotonic()
+
+    def consumir(self, custo: float = 1) -> bool:
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+        if self.tokens < custo:
+            return False
+        self.tokens -= custo
+        return True
+
+_baldes_usuario = OrderedDict()  # user_id -> BaldeTokens
+_baldes_grupo = OrderedDict()  # grupo_id -> BaldeTokens
+_semaforos_usuario = {}  # user_id -> [asyncio.Semaphore, updates usando ou esperando]
+_semaforos_grupo = {}  # grupo_id -> [asyncio.Semaphore, updates usando ou esperando]
+_avisos_cota = OrderedDict()  # user_id -> monotonic do último aviso
+_carga_grupos = OrderedDict()  # grupo_id -> contadores expostos em /metrics; os mais parados saem primeiro
+CARGA_MAX_GRUPOS = 2000
+
+def obter_balde(baldes: OrderedDict, chave, taxa: float, capacidade: int) -> BaldeTokens:
+    balde = baldes.get(chave)
+    if balde is None:
+        balde = baldes[chave] = BaldeTokens(taxa, capacidade)
+        if len(baldes) > COTA_MAX_BALDES:
+            baldes.popitem(last=False)
+    else:
+        baldes.move_to_end(chave)
+    return balde
+
+@asynccontextmanager
+async def vaga(semaforos: dict, chave, limite: int):
+    """Ocupa uma das `limite` vagas da chave; a entrada some quando ninguém mais a usa."""
+    entrada = semaforos.get(chave)
+    if entrada is None:
+        entrada = semaforos[chave] = [asyncio.Semaphore(limite), 0]
+    entrada[1] += 1
+    try:
+        async with entrada[0]:
+            yield
+    finally:
+        entrada[1] -= 1
+        if entrada[1] == 0:
+            del semaforos[chave]
+
+async def avisar_cota_excedida(update: Update):
+    user_id = update.effective_user.id
+    agora = time.monotonic()
+    if agora - _avisos_cota.get(user_id, float("-inf")) < AVISO_COTA_INTERVALO:
+        return
+    _avisos_cota[user_id] = agora
+    _avisos_cota.move_to_end(user_id)
+    if len(_avisos_cota) > COTA_MAX_BALDES:
+        _avisos_cota.popitem(last=False)
+    texto = "⏳ Muitas mensagens em pouco tempo. Aguarde alguns segundos e tente novamente."
+    try:
+        if update.callback_query:
+            await update.callback_query.answer(texto)
+        elif update.effective_message:
+            await update.effective_message.reply_text(texto)
+    except Exception as e:
+        logging.error("Erro ao avisar cota excedida para user_id %s: %s", user_id, e)
+
+async def executar_com_cotas(update: Update, processar):
+    """Executa processar() respeitando as cotas e a concorrência do usuário e do grupo."""
+    usuario = update.effective_user
+    if usuario is None or update.inline_query is not None:
+        await processar()
+        return
+    grupo_id = await get_grupo_id(usuario.id)
+    carga = _carga_grupos.get(grupo_id)
+    if carga is None:
+        carga = _carga_grupos[grupo_id] = {"updates": 0, "recusados": 0, "espera_ms": 0.0}
+        if len(_carga_grupos) > CARGA_MAX_GRUPOS:
+            _carga_grupos.popitem(last=False)
+    else:
+        _carga_grupos.move_to_end(grupo_id)
+    carga["updates"] += 1
+
+    fila_grupo = _semaforos_grupo[grupo_id][1] if grupo_id in _semaforos_grupo else 0
+    if (not obter_balde(_baldes_usuario, usuario.id, COTA_USUARIO_TAXA, COTA_USUARIO_RAJADA).consumir()
+            or not obter_balde(_baldes_grupo, grupo_id, COTA_GRUPO_TAXA, COTA_GRUPO_RAJADA).consumir()
+            or fila_grupo >= GRUPO_MAX_CONCORRENTES + GRUPO_MAX_FILA):
+        carga["recusados"] += 1
+        metricas["updates_recusados"] += 1
+        logging.warning("Update %s de user_id %s recusado: cota do usuário ou do grupo %s esgotada.", update.update_id, usuario.id, grupo_id)
+        await avisar_cota_excedida(update)
+        return
+
+    inicio = time.perf_counter()
+    async with vaga(_semaforos_usuario, usuario.id, 1):
+        async with vaga(_semaforos_grupo, grupo_id, GRUPO_MAX_CONCORRENTES):
+            carga["espera_ms"] += (time.perf_counter() - inicio) * 1000
+            await processar()
+
+def rotulo_grupo(grupo_id) -> str:
+    """Identificador opaco do grupo para o /metrics, que é público.
+
+    O grupo_id é também o código de convite (entrar_grupo o aceita), então nunca
+    pode sair no /metrics. HMAC com o token do bot: quem não tem o token não
+    consegue testar códigos contra o rótulo; quem administra o bot calcula o
+    rótulo de um grupo com esta função.
+    """
+    return hmac.new(TOKEN.encode(), str(grupo_id).encode(), hashlib.sha256).hexdigest()[:12]
+
+def resumo_carga_grupos(limite: int = 20) -> dict:
+    """Os grupos com mais updates, para /metrics (lido da thread do Flask: só cópias)."""
+    carga = _carga_grupos.copy()
+    maiores = sorted(carga.items(), key=lambda item: item[1]["updates"], reverse=True)[:limite]
+    return {
+        rotulo_grupo(grupo_id): {**contadores.copy(), "espera_ms": round(contadores["espera_ms"], 1),
+                   "em_andamento": _semaforos_grupo[grupo_id][1] if grupo_id in _semaforos_grupo else 0}
+        for grupo_id, contadores in maiores
+    }
+
+# ========================
+# Processamento e encerramento gracioso
+# ========================
+# Tarefas de process_update ainda em execução; o shutdown espera por elas
+_updates_em_andamento = set()
+
+async def processar_update(update: Update):
+    """Envolve bot_application.process_update para que o shutdown saiba o que está em andamento."""
+    tarefa = asyncio.current_task()
+    _updates_em_andamento.add(tarefa)
+    _log_update_id.set(update.update_id)
+    registrar_atividade(update)
+    rastro = Rastro(update.update_id) if deve_rastrear(update) else None
+    _rastro_atual.set(rastro)
+    inicio = time.perf_counter()
+    try:
+        with span("process_update", "update", update_id=update.update_id):
+            await executar_com_cotas(update, lambda: bot_application.process_update(update))
+    finally:
+        _updates_em_andamento.discard(tarefa)
+        logging.info("Update processado.", extra={"duration_ms": round((time.perf_counter() - inicio) * 1000, 1)})
+        if rastro is not None:
+            try:
+                caminho = await asyncio.to_thread(rastro.gravar)
+                logging.info("Rastro do update %s gravado em %s.", update.update_id, caminho)
+            except Exception as e:
+                logging.error("Erro ao gravar o rastro do update %s: %s", update.update_id, e)
+
+async def encerrar_bot(prazo: float = PRAZO_ENCERRAMENTO):
+    """Para de aceitar webhooks, drena os updates em andamento e desliga o bot_application."""
+    global aceitando_updates
+    with _webhook_lock:
+        aceitando_updates = False
+        agendados = {asyncio.wrap_future(futuro) for futuro in _webhooks_agendados}
+    logging.info("Encerramento iniciado: webhook deixou de aceitar updates.")
+    await parar_polling()
+
+    if _updates_iniciais:
+        logging.warning("%s update(s) recebidos durante a inicialização não chegaram a ser processados.", len(_updates_iniciais))
+
+    # Os updates contam desde o agendamento: os do webhook antes de a tarefa começar, os do
+    # polling inclusive os ainda na fila do seu chat
+    pendentes = _updates_em_andamento | _tarefas_polling | {futuro for futuro in agendados if not futuro.done()}
+    if pendentes:
+        # Um update do webhook já iniciado aparece duas vezes (future e tarefa): a contagem é de tarefas
+        logging.info("Aguardando %s tarefa(s) de update em andamento (prazo de %.0fs)...", len(pendentes), prazo)
+        _, atrasados = await asyncio.wait(pendentes, timeout=prazo)
+        if atrasados:
+            logging.warning("%s tarefa(s) de update não terminaram dentro do prazo e serão canceladas.", len(atrasados))
+    await confirmar_updates_polling()
+
+    for gancho in _ganchos_encerramento:
+        try:
+            await gancho()
+        except Exception as e:
+            logging.error("Erro no gancho de encerramento %s: %s", gancho.__name__, e, exc_info=True)
+
+    if bot_application is not None:
+        try:
+            if bot_application.running:
+                await bot_application.stop()
+            await bot_application.shutdown()
+        except Exception as e:
+            logging.error("Erro ao desligar o bot_application: %s", e, exc_info=True)
+    logging.info("Encerramento concluído.")
+
+# ========================
+# Long polling (--polling)
+# ========================
+# Alternativa ao webhook para rodar sem domínio público (testes de carga locais,
+# hosts sem HTTPS de entrada). Cada getUpdates traz até POLLING_LIMITE updates e
+# espera até POLLING_TIMEOUT s por novos; os updates do lote são processados em
+# paralelo, mas os de um mesmo chat continuam em ordem de chegada. Com
+# POLLING_MAX_EM_ANDAMENTO updates em andamento o próximo getUpdates espera alguns
+# terminarem e só pede o que cabe (sem isso, um handler lento acumularia tarefas
+# sem limite). No shutdown,
+# encerrar_bot espera também os que ainda aguardam o anterior do mesmo chat, e
+# confirmar_updates_polling só confirma ao Telegram os updates concluídos.
+_tarefa_polling = None
+_polling_interrompivel = False  # True só enquanto espera vaga ou o getUpdates: parar_polling cancela ali
+_offset_polling = None  # update_id + 1 do último update despachado; o próximo getUpdates o envia
+_offset_enviado = None  # Último offset enviado ao Telegram (os updates anteriores já estão confirmados)
+_ids_polling_pendentes = set()  # update_ids recebidos e ainda não concluídos
+_tarefas_polling = set()  # Todas as tarefas criadas por despachar_em_ordem (referência forte até terminarem)
+_ultimo_por_chat = {}  # chat_id (ou user_id) -> tarefa do último update desse chat
+
+async def _processar_depois(anterior, update: Update):
+    if anterior is not None:
+        await asyncio.wait([anterior])  # Só a ordem importa: erros do anterior já foram tratados lá
+    try:
+        await processar_update(update)
+    except asyncio.CancelledError:
+        raise  # Não terminou: continua em _ids_polling_pendentes e não é confirmado
+    except Exception as e:
+        logging.error("Erro ao processar o update %s: %s", update.update_id, e, exc_info=True)
+    _ids_polling_pendentes.discard(update.update_id)
+
+def despachar_em_ordem(update: Update):
+    """Agenda o update logo atrás do último do mesmo chat; chats diferentes correm em paralelo."""
+    chat = update.effective_chat or update.effective_user
+    chave = chat.id if chat is not None else None
+    tarefa = asyncio.create_task(_processar_depois(_ultimo_por_chat.get(chave), update))
+    _tarefas_polling.add(tarefa)
+    tarefa.add_done_callback(_tarefas_polling.discard)
+    if chave is not None:
+        _ultimo_por_chat[chave] = tarefa
+        tarefa.add_done_callback(lambda t: _ultimo_por_chat.pop(chave, None) if _ultimo_por_chat.get(chave) is t else None)
+
+async def consumir_updates_polling():
+    """Tarefa em segundo plano (start_bot, com --polling): busca e despacha updates em lote."""
+    global _offset_polling, _offset_enviado, _polling_interrompivel
+    espera = 1
+    while aceitando_updates:
+        _polling_interrompivel = True
+        try:
+            while len(_tarefas_polling) >= POLLING_MAX_EM_ANDAMENTO:
+                await asyncio.wait(set(_tarefas_polling), return_when=asyncio.FIRST_COMPLETED)
+            _offset_enviado = _offset_polling
+            updates = await bot_application.bot.get_updates(
+                offset=_offset_polling, limit=min(POLLING_LIMITE, POLLING_MAX_EM_ANDAMENTO - len(_tarefas_polling)),
+                timeout=POLLING_TIMEOUT, allowed_updates=Update.ALL_TYPES,
+            )
+            espera = 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Erro no getUpdates (nova tentativa em %ss): %s", espera, e)
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 30)
+            continue
+        finally:
+            _polling_interrompivel = False
+        # Daqui até o próximo getUpdates não há cancelamento: um update registrado na
+        # deduplicação mas não despachado se perderia (a reentrega seria descartada)
+        for update in updates:
+            if not aceitando_updates:
+                break  # O resto do lote não é confirmado e volta na próxima instância
+            _ids_polling_pendentes.add(update.update_id)
+            novo = (await asyncio.to_thread(registrar_update_id, update.update_id) if DEDUP_SUPABASE
+                    else registrar_update_id(update.update_id))
+            if novo:
+                despachar_em_ordem(update)
+            else:
+                _ids_polling_pendentes.discard(update.update_id)
+                logging.info("Update %s duplicado ignorado.", update.update_id)
+            _offset_polling = update.update_id + 1
+
+async def parar_polling():
+    """Para de buscar updates: interrompe o getUpdates em curso ou espera o lote atual ser despachado."""
+    if _tarefa_polling is None:
+        return
+    if _polling_interrompivel:
+        _tarefa_polling.cancel()
+    try:
+        await _tarefa_polling
+    except asyncio.CancelledError:
+        pass
+
+async def confirmar_updates_polling():
+    """Confirma ao Telegram os updates concluídos (encerrar_bot, depois de drenar os em andamento).
+
+    O offset para no primeiro update inacabado, que a próxima instância recebe de novo;
+    os inacabados saem da deduplicação para que essa reentrega seja aceita.
+    """
+    inacabados = sorted(_ids_polling_pendentes)
+    perdidos = [i for i in inacabados if _offset_enviado is not None and i < _offset_enviado]
+    reentregar = inacabados[len(perdidos):]
+    if perdidos:
+        logging.warning("%s update(s) inacabados já tinham sido confirmados ao Telegram e se perdem: %s", len(perdidos), perdidos)
+    if reentregar:
+        logging.warning("%s update(s) inacabados ficam sem confirmação para a próxima instância.", len(reentregar))
+    for update_id in reentregar:
+        if DEDUP_SUPABASE:
+            await asyncio.to_thread(esquecer_update_id, update_id)
+        else:
+            esquecer_update_id(update_id)
+    offset = reentregar[0] if reentregar else _offset_polling
+    if offset is None or (_offset_enviado is not None and offset <= _offset_enviado):
+        return  # Nada além do que o último getUpdates já confirmou
+    try:
+        await bot_application.bot.get_updates(offset=offset, limit=1, timeout=0)
+    except Exception as e:
+        logging.warning("Não foi possível confirmar os updates recebidos por polling: %s", e)
+
 # ========================
 # Webhook handler
 # ========================
 @app.route("/webhook", methods=["POST"])
 def webhook():
     global bot_application, bot_event_loop
-    if bot_application is None or bot_event_loop is None:
-        logging.warning("Bot application ou event loop ainda não está pronto para receber atualizações.")
-        return "Service Unavailable", 503
-
     json_data = request.get_json()
     if not json_data:
         logging.warning("Requisição POST /webhook sem dados JSON.")
         return "Bad Request", 400
 
+    if not aceitando_updates:
+        # Em shutdown: o Telegram reenvia o update, que cai na instância nova
+        return "Service Unavailable", 503
+
+    update_id = json_data.get("update_id")
+    if not registrar_update_id(update_id):
+        logging.info("Update %s duplicado ignorado.", update_id)
+        return "OK", 200
+
+    if not bot_pronto:
+        with _prontidao_lock:
+            # Confere de novo sob o lock: start_bot pode ter acabado de esvaziar o buffer
+            if not bot_pronto:
+                if len(_updates_iniciais) >= UPDATES_INICIAIS_MAX:
+                    logging.warning("Buffer de updates iniciais cheio; o Telegram vai reenviar o update.")
+                    esquecer_update_id(update_id)
+                    return "Service Unavailable", 503
+                _updates_iniciais.append(json_data)
+                logging.info("Update %s guardado até o bot ficar pronto.", update_id)
+                return "OK", 200
+
     try:
         update = Update.de_json(json_data, bot_application.bot)
-        asyncio.run_coroutine_threadsafe(
-            bot_application.process_update(update),
-            bot_event_loop
-        )
+        with _webhook_lock:
+            if not aceitando_updates:
+                esquecer_update_id(update_id)
+                return "Service Unavailable", 503
+            futuro = asyncio.run_coroutine_threadsafe(
+                processar_update(update),
+                bot_event_loop
+            )
+            _webhooks_agendados.add(futuro)
+        futuro.add_done_callback(_webhooks_agendados.discard)
     except Exception as e:
-        logging.error(f"Erro ao agendar atualização no loop de eventos: {e}", exc_info=True)
+        logging.error("Erro ao agendar atualização no loop de eventos: %s", e, exc_info=True)
+        esquecer_update_id(update_id)
         return "Internal Server Error", 500
 
     return "OK", 200
@@ -999,7 +3390,7 @@ async def select_product_callback(update: Update, context: ContextTypes.DEFAULT_
     product_id = query.data.split("_")[2]  # select_prod_{id}
 
     pending_products = context.user_data.get('pending_products', [])
-    product = next((p for p in pending_products if p['id'] == product_id), None)
+    product = next((p for p in pending_products if p.id == product_id), None)
 
     if not product:
         await query.edit_message_text("❌ Produto não encontrado.")
@@ -1009,19 +3400,19 @@ async def select_product_callback(update: Update, context: ContextTypes.DEFAULT_
     context.user_data['editing_product'] = product
 
     keyboard = [
-        [InlineKeyboardButton("✏️ Editar Preço", callback_data=f"edit_price_{product['id']}")],
-        [InlineKeyboardButton("🗑️ Excluir", callback_data=f"delete_{product['id']}")]
+        [InlineKeyboardButton("✏️ Editar Preço", callback_data=f"edit_price_{product.id}")],
+        [InlineKeyboardButton("🗑️ Excluir", callback_data=f"delete_{product.id}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text(
         f"🗑️ *Excluir Produto:*\n" \
-        f"📦 *{product['nome']}*\n" \
-        f"🏷️ *Tipo:* {product['tipo']}\n" \
-        f"🏭 *Marca:* {product['marca']}\n" \
-        f"📏 *Unidade:* {product['unidade']}\n" \
-        f"💰 *Preço:* R$ {format_price(product['preco'])}\n" \
-        f"📝 *Observações:* {product['observacoes']}\n" \
+        f"📦 *{product.nome}*\n" \
+        f"🏷️ *Tipo:* {product.tipo}\n" \
+        f"🏭 *Marca:* {product.marca}\n" \
+        f"📏 *Unidade:* {product.unidade}\n" \
+        f"💰 *Preço:* R$ {format_price(product.preco)}\n" \
+        f"📝 *Observações:* {product.observacoes}\n" \
         f"Tem certeza que deseja excluir este produto?",
         reply_markup=ReplyKeyboardMarkup([[KeyboardButton("✅ Confirmar"), KeyboardButton("❌ Cancelar")]], resize_keyboard=True),
         parse_mode="Markdown"
@@ -1030,7 +3421,7 @@ async def select_product_callback(update: Update, context: ContextTypes.DEFAULT_
 
 async def start_bot():
     global bot_application
-    bot_application = Application.builder().token(TOKEN).build()
+    bot_application = Application.builder().token(TOKEN).request(RequestRastreado(connection_pool_size=256)).build()
 
     # ========================
     # Handlers de comandos
@@ -1038,13 +3429,24 @@ async def start_bot():
     bot_application.add_handler(CommandHandler("start", start))
     bot_application.add_handler(CommandHandler("help", help_command))
     bot_application.add_handler(CommandHandler("cancel", cancel))
+    bot_application.add_handler(CommandHandler("grupos", list_groups))
+    bot_application.add_handler(CommandHandler("stats", stats_command))
+    bot_application.add_handler(CommandHandler("alerta", price_alert_command))
+    bot_application.add_handler(CommandHandler("alertas", list_price_alerts))
+    bot_application.add_handler(CommandHandler("alerta_remover", remove_price_alert))
+    bot_application.add_handler(CommandHandler("grafico", price_chart_command))
+    bot_application.add_handler(CommandHandler("trace", trace_command))
+    bot_application.add_handler(CommandHandler("memoria", memory_report_command))
 
     # ========================
     # CallbackQueryHandler (botões inline)
     # ========================
     bot_application.add_handler(CallbackQueryHandler(compartilhar_lista_callback, pattern="^compartilhar_lista$"))
     bot_application.add_handler(CallbackQueryHandler(inserir_codigo_callback, pattern="^inserir_codigo$"))
+    bot_application.add_handler(CallbackQueryHandler(switch_group_callback, pattern="^trocar_grupo_"))
     bot_application.add_handler(CallbackQueryHandler(select_product_callback, pattern="^select_prod_"))
+    # block=False: o debounce dorme sem segurar os demais updates
+    bot_application.add_handler(InlineQueryHandler(inline_query, block=False))
     
     # ========================
     # ConversationHandler (fluxos de conversa)
@@ -1052,11 +3454,9 @@ async def start_bot():
     conv_handler = ConversationHandler(
         entry_points=[
             CommandHandler("start", start),
-            MessageHandler(filters.Regex("^➕ Adicionar Produto$"), ask_for_product_data),
-            MessageHandler(filters.Regex("^✏️ Editar ou Excluir$"), ask_for_edit_delete_choice),
-            MessageHandler(filters.Regex("^📋 Listar Produtos$"), list_products),
-            MessageHandler(filters.Regex("^🔍 Pesquisar Produto$"), search_product_input),
-            MessageHandler(filters.Regex("^ℹ️ Ajuda$"), help_command),
+            CommandHandler("lista", shopping_list_command),
+            CommandHandler("nota", ask_for_nfce),
+            MessageHandler(FILTRO_BOTOES_MENU, despachar_botao),
         ],
         states={
             MAIN_MENU: [
@@ -1086,6 +3486,22 @@ async def start_bot():
             AWAIT_INVITE_CODE_INPUT: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, handle_invite_code_input),
             ],
+            AWAIT_SHOPPING_LIST: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_shopping_list_input),
+            ],
+            CONFIRM_BULK_DELETION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_bulk_deletion),
+            ],
+            AWAIT_BULK_PRICES: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_bulk_prices_input),
+            ],
+            AWAIT_NFCE_DOCUMENT: [
+                MessageHandler(filters.Document.ALL, handle_nfce_document),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_nfce_text),
+            ],
+            CONFIRM_NFCE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_nfce),
+            ],
             # Correção: Novo estado para esperar a escolha numérica do produto
         AWAIT_ENTRY_CHOICE: [
             MessageHandler(filters.Regex("^❌ Cancelar$"), cancel), # Permite cancelar
@@ -1095,23 +3511,84 @@ async def start_bot():
         AWAIT_ACTION_CHOICE: [
              CallbackQueryHandler(edit_price_callback, pattern="^edit_price_"),
              CallbackQueryHandler(delete_product_callback, pattern="^delete_"),
+             CallbackQueryHandler(bulk_edit_callback, pattern="^bulk_edit$"),
+             CallbackQueryHandler(bulk_delete_callback, pattern="^bulk_delete$"),
              # Opcional: Adicionar um handler para cancelar aqui também, se quiser um botão inline de cancelar
              # MessageHandler(filters.Regex("^❌ Cancelar$"), cancel), # Se tiver um botão de cancelar inline
         ],
     },
         fallbacks=[
             CommandHandler("cancel", cancel),
+            CommandHandler("lista", shopping_list_command),
+            CommandHandler("nota", ask_for_nfce),
             MessageHandler(filters.Regex("^❌ Cancelar$"), cancel),
         ],
     )
     bot_application.add_handler(conv_handler)
+    instrumentar_handlers(bot_application)
 
-    # Inicialização padrão
+    # Inicialização padrão. O cliente Supabase é criado numa thread enquanto o
+    # initialize() conversa com o Telegram, em vez de pesar no import do módulo.
+    inicio = time.perf_counter()
+    aquecimento_supabase = asyncio.create_task(asyncio.to_thread(obter_supabase))
     await bot_application.initialize()
     await bot_application.start()
-    url = f"{WEBHOOK_DOMAIN}/webhook"
-    await bot_application.bot.set_webhook(url=url)
-    logging.info(f"Webhook do Telegram setado para: {url}")
+    await aquecimento_supabase
+    tempos_inicializacao["bot_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+
+    global _tarefa_notificacoes
+    carga_alertas = asyncio.create_task(asyncio.to_thread(carregar_alertas))
+    _tarefa_notificacoes = asyncio.create_task(enviar_notificacoes())
+    global _tarefa_varredura_user_data
+    _tarefa_varredura_user_data = asyncio.create_task(varrer_user_data_inativo())
+    if REPLICA_LOCAL:
+        global _replica, _tarefa_replica
+        _replica = ReplicaLocal(REPLICA_LOCAL)
+        _tarefa_replica = asyncio.create_task(sincronizar_replica())
+        logging.info("Réplica local em %s (%s escrita(s) pendentes no diário).", REPLICA_LOCAL, _replica.pendencias())
+
+    inicio = time.perf_counter()
+    if MODO_POLLING:
+        # Com webhook ativo o getUpdates é recusado; os updates pendentes continuam na fila do Telegram
+        await bot_application.bot.delete_webhook(drop_pending_updates=False)
+        logging.info("Webhook removido: recebendo updates por long polling.")
+    else:
+        url = f"{WEBHOOK_DOMAIN}/webhook"
+        info = await bot_application.bot.get_webhook_info()
+        if info.url != url:
+            await bot_application.bot.set_webhook(url=url)
+            logging.info("Webhook do Telegram setado para: %s", url)
+        else:
+            logging.info("Webhook do Telegram já aponta para %s; set_webhook ignorado.", url)
+    tempos_inicializacao["webhook_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+
+    try:
+        await carga_alertas
+    except Exception as e:
+        logging.error("Erro ao carregar alertas de preço: %s", e)
+
+    marcar_bot_pronto()
+    if MODO_POLLING:
+        global _tarefa_polling
+        _tarefa_polling = asyncio.create_task(consumir_updates_polling())
+    tempos_inicializacao["total_ms"] = round((time.perf_counter() - _inicio_processo) * 1000, 1)
+    logging.info("Bot pronto. Tempos de inicialização (ms): %s", tempos_inicializacao)
+
+def marcar_bot_pronto():
+    """Libera o webhook e agenda, em ordem de chegada, os updates guardados durante o boot."""
+    global bot_pronto
+    with _prontidao_lock:
+        pendentes = list(_updates_iniciais)
+        _updates_iniciais.clear()
+        bot_pronto = True
+    for json_data in pendentes:
+        try:
+            update = Update.de_json(json_data, bot_application.bot)
+            asyncio.get_running_loop().create_task(processar_update(update))
+        except Exception as e:
+            logging.error("Erro ao processar update guardado durante a inicialização: %s", e, exc_info=True)
+    if pendentes:
+        logging.info("%s update(s) recebidos durante a inicialização foram agendados.", len(pendentes))
 
 # ========================
 # Função para rodar Flask
@@ -1119,18 +3596,27 @@ async def start_bot():
 def run_flask():
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)), debug=False)
 
+tempos_inicializacao["import_ms"] = round((time.perf_counter() - _inicio_processo) * 1000, 1)
+
 # ========================
 # Main
 # ========================
 if __name__ == "__main__":
-    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
-    logging.info("Iniciando bot com webhook via Flask e Python 3.13.4")
+    # Tarefas de manutenção avulsas: python main.py <tarefa>
+    if len(sys.argv) > 1 and sys.argv[1] == "compactar-produtos":
+        compactar_produtos_duplicados()
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "recalcular-produtos":
+        recalcular_campos_derivados()
+        sys.exit(0)
+
+    logging.info("Iniciando bot com %s via Flask e Python 3.13.4", 'long polling' if MODO_POLLING else 'webhook')
 
     # Crie o event loop principal e salve na global
     bot_event_loop = asyncio.new_event_loop()
     asyncio.set_event_loop(bot_event_loop)
 
-    # Rode Flask em thread separada
+    # Rode Flask em thread separada (no modo polling, só para /healthz e /metrics)
     flask_thread = Thread(target=run_flask)
     flask_thread.daemon = True
     flask_thread.start()
@@ -1139,7 +3625,13 @@ if __name__ == "__main__":
     # Inicialize o bot (e set o webhook) no event loop principal
     init_task = bot_event_loop.create_task(start_bot())
     bot_event_loop.run_until_complete(init_task)
-    logging.info("Bot initialized and webhook set.")
+    logging.info("Bot initialized and %s.", 'polling started' if MODO_POLLING else 'webhook set')
+
+    # SIGTERM (deploy/reinício do host) interrompe o run_forever para o encerramento gracioso
+    try:
+        bot_event_loop.add_signal_handler(signal.SIGTERM, bot_event_loop.stop)
+    except NotImplementedError:
+        signal.signal(signal.SIGTERM, lambda *_: bot_event_loop.call_soon_threadsafe(bot_event_loop.stop))
 
     # Deixe o event loop ativo enquanto Flask roda
     logging.info("Mantendo o loop de eventos principal ativo com loop.run_forever()...")
@@ -1148,7 +3640,8 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("Recebido KeyboardInterrupt. Encerrando...")
     finally:
-        # Limpeza (opcional)
+        bot_event_loop.run_until_complete(encerrar_bot())
+        # O que sobrou (tarefas que estouraram o prazo) é cancelado
         pending = asyncio.all_tasks(loop=bot_event_loop)
         for task in pending:
             task.cancel()
@@ -0,0 +1,12 @@
+-- Deduplicação compartilhada de updates do Telegram (usada com DEDUP_SUPABASE=1).
+create table if not exists updates_processados (
+    update_id bigint primary key,
+    recebido_em timestamptz not null default now()
+);
+
+create index if not exists updates_processados_recebido_em_idx
+    on updates_processados (recebido_em);
+
+-- O Telegram só reenvia updates por até 24h; linhas antigas podem ser apagadas
+-- periodicamente (ex.: pg_cron):
+--   delete from updates_processados where recebido_em < now() - interval '1 day';
@@ -0,0 +1,3 @@
+-- Identidade canônica do produto dentro do grupo: nome|tipo|marca|unidade normalizados
+-- (ver chave_produto() em main.py). Preenchida pela aplicação a cada gravação.
+alter table produtos add column if not exists chave_produto text;
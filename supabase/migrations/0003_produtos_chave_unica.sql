@@ -0,0 +1,5 @@
+-- Antes de aplicar: rode `python main.py compactar-produtos` para preencher
+-- chave_produto nas linhas antigas e remover as duplicatas de cada grupo.
+-- O índice é o alvo do upsert em salvar_produto (on_conflict=grupo_id,chave_produto).
+create unique index if not exists produtos_grupo_chave_idx
+    on produtos (grupo_id, chave_produto);
@@ -0,0 +1,15 @@
+-- Alertas de preço criados com /alerta. A aplicação carrega todos na inicialização
+-- e os avalia em memória a cada gravação de preço.
+create table if not exists alertas_preco (
+    id bigint generated by default as identity primary key,
+    user_id bigint not null,
+    chat_id bigint not null,
+    grupo_id text not null,
+    produto text not null,
+    produto_chave text not null,  -- nome normalizado (normalizar_campo_produto)
+    limite numeric not null,
+    unidade_base text,            -- kg, L, m, und, rolo, folha; nulo = qualquer unidade
+    criado_em timestamptz not null default now()
+);
+
+create index if not exists alertas_preco_user_idx on alertas_preco (user_id);
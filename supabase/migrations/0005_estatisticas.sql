@@ -0,0 +1,148 @@
+-- Agregados por grupo para o /stats, mantidos incrementalmente por trigger em
+-- produtos. A leitura (estatisticas_do_grupo) não varre produtos.
+
+-- Preço por unidade base (kg, L, m, und, rolo, folha), gravado pela aplicação
+-- (campos_preco_base em main.py). Linhas antigas: python main.py recalcular-produtos
+alter table produtos
+    add column if not exists preco_unitario_base numeric,
+    add column if not exists unidade_base text;
+
+create index if not exists produtos_grupo_nome_idx on produtos (grupo_id, nome);
+
+create table if not exists estatisticas_grupo (
+    grupo_id text primary key,
+    total_produtos bigint not null default 0,
+    atualizado_em timestamptz not null default now()
+);
+
+create table if not exists estatisticas_categoria (
+    grupo_id text not null,
+    categoria text not null,
+    unidade_base text not null,
+    quantidade bigint not null,
+    soma numeric not null,
+    minimo numeric not null,
+    maximo numeric not null,
+    primary key (grupo_id, categoria, unidade_base)
+);
+
+create table if not exists variacoes_preco (
+    id bigint generated by default as identity primary key,
+    grupo_id text not null,
+    produto_id text not null,
+    nome text not null,
+    marca text,
+    unidade text,
+    preco_anterior numeric not null,
+    preco_novo numeric not null,
+    variacao_pct numeric not null,
+    variacao_abs numeric generated always as (abs(variacao_pct)) stored,
+    registrado_em timestamptz not null default now()
+);
+
+create index if not exists variacoes_preco_grupo_idx on variacoes_preco (grupo_id, registrado_em desc);
+
+create or replace function atualizar_estatisticas_produtos() returns trigger
+language plpgsql as $$
+begin
+    if tg_op in ('UPDATE', 'DELETE') then
+        update estatisticas_grupo
+           set total_produtos = total_produtos - 1, atualizado_em = now()
+         where grupo_id = old.grupo_id;
+
+        if old.preco_unitario_base is not null then
+            update estatisticas_categoria
+               set quantidade = quantidade - 1, soma = soma - old.preco_unitario_base
+             where grupo_id = old.grupo_id and categoria = old.nome
+               and unidade_base = coalesce(old.unidade_base, '');
+
+            -- Mínimo/máximo só são recalculados (pelo índice grupo_id, nome) quando
+            -- o valor removido era um dos extremos da categoria
+            update estatisticas_categoria c
+               set minimo = e.minimo, maximo = e.maximo
+              from (select min(preco_unitario_base) as minimo, max(preco_unitario_base) as maximo
+                      from produtos
+                     where grupo_id = old.grupo_id and nome = old.nome
+                       and coalesce(unidade_base, '') = coalesce(old.unidade_base, '')) e
+             where c.grupo_id = old.grupo_id and c.categoria = old.nome
+               and c.unidade_base = coalesce(old.unidade_base, '')
+               and (old.preco_unitario_base <= c.minimo or old.preco_unitario_base >= c.maximo)
+               and e.minimo is not null;
+
+            delete from estatisticas_categoria
+             where grupo_id = old.grupo_id and categoria = old.nome
+               and unidade_base = coalesce(old.unidade_base, '') and quantidade <= 0;
+        end if;
+    end if;
+
+    if tg_op in ('INSERT', 'UPDATE') then
+        insert into estatisticas_grupo (grupo_id, total_produtos, atualizado_em)
+        values (new.grupo_id, 1, now())
+        on conflict (grupo_id) do update
+            set total_produtos = estatisticas_grupo.total_produtos + 1, atualizado_em = now();
+
+        if new.preco_unitario_base is not null then
+            insert into estatisticas_categoria as c
+                (grupo_id, categoria, unidade_base, quantidade, soma, minimo, maximo)
+            values (new.grupo_id, new.nome, coalesce(new.unidade_base, ''), 1,
+                    new.preco_unitario_base, new.preco_unitario_base, new.preco_unitario_base)
+            on conflict (grupo_id, categoria, unidade_base) do update
+                set quantidade = c.quantidade + 1,
+                    soma = c.soma + excluded.soma,
+                    minimo = least(c.minimo, excluded.minimo),
+                    maximo = greatest(c.maximo, excluded.maximo);
+        end if;
+    end if;
+
+    if tg_op = 'UPDATE' and new.preco is distinct from old.preco and old.preco > 0 then
+        insert into variacoes_preco
+            (grupo_id, produto_id, nome, marca, unidade, preco_anterior, preco_novo, variacao_pct)
+        values (new.grupo_id, new.id::text, new.nome, new.marca, new.unidade, old.preco, new.preco,
+                round((new.preco - old.preco) / old.preco * 100, 2));
+    end if;
+
+    return null;
+end $$;
+
+drop trigger if exists produtos_estatisticas on produtos;
+create trigger produtos_estatisticas
+    after insert or update or delete on produtos
+    for each row execute function atualizar_estatisticas_produtos();
+
+-- Reconstrói os agregados do zero (carga inicial ou correção manual)
+create or replace function reconstruir_estatisticas() returns void
+language sql as $$
+    delete from estatisticas_grupo;
+    delete from estatisticas_categoria;
+    insert into estatisticas_grupo (grupo_id, total_produtos)
+        select grupo_id, count(*) from produtos group by grupo_id;
+    insert into estatisticas_categoria (grupo_id, categoria, unidade_base, quantidade, soma, minimo, maximo)
+        select grupo_id, nome, coalesce(unidade_base, ''), count(*), sum(preco_unitario_base),
+               min(preco_unitario_base), max(preco_unitario_base)
+          from produtos
+         where preco_unitario_base is not null
+         group by grupo_id, nome, coalesce(unidade_base, '');
+$$;
+
+select reconstruir_estatisticas();
+
+create or replace function estatisticas_do_grupo(p_grupo_id text) returns jsonb
+language sql stable as $$
+    select jsonb_build_object(
+        'total_produtos', coalesce((select total_produtos from estatisticas_grupo where grupo_id = p_grupo_id), 0),
+        'categorias', coalesce((
+            select jsonb_agg(c) from (
+                select categoria, unidade_base, quantidade, round(soma / quantidade, 2) as media, minimo, maximo
+                  from estatisticas_categoria
+                 where grupo_id = p_grupo_id
+                 order by quantidade desc, categoria
+                 limit 10) c), '[]'::jsonb),
+        'variacoes', coalesce((
+            select jsonb_agg(v) from (
+                select nome, marca, unidade, preco_anterior, preco_novo, variacao_pct
+                  from variacoes_preco
+                 where grupo_id = p_grupo_id and registrado_em > now() - interval '30 days'
+                 order by variacao_abs desc
+                 limit 5) v), '[]'::jsonb)
+    );
+$$;
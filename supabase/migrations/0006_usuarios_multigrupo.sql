@@ -0,0 +1,98 @@
+-- Um usuário pode participar de vários grupos; exatamente um fica ativo.
+-- Entrar num grupo e descobrir o grupo ativo passam a ser uma chamada RPC cada.
+
+alter table usuarios add column if not exists ativo boolean not null default true;
+
+-- Remove a restrição de unicidade (ou chave primária) apenas em user_id, que
+-- impedia mais de uma linha por usuário
+do $$
+declare
+    r record;
+begin
+    for r in
+        select c.conname
+          from pg_constraint c
+          join pg_attribute a on a.attrelid = c.conrelid and a.attname = 'user_id'
+         where c.conrelid = 'usuarios'::regclass
+           and c.contype in ('p', 'u')
+           and c.conkey = array[a.attnum]::smallint[]
+    loop
+        execute format('alter table usuarios drop constraint %I', r.conname);
+    end loop;
+end $$;
+
+-- (user_id, grupo_id) também atende às buscas só por user_id
+create unique index if not exists usuarios_user_grupo_idx on usuarios (user_id, grupo_id);
+create unique index if not exists usuarios_grupo_ativo_idx on usuarios (user_id) where ativo;
+create index if not exists usuarios_grupo_idx on usuarios (grupo_id);
+
+-- Grupo ativo do usuário; cria um grupo novo no primeiro acesso
+create or replace function obter_grupo_ativo(p_user_id bigint) returns text
+language plpgsql as $$
+declare
+    v_grupo text;
+begin
+    select grupo_id into v_grupo from usuarios where user_id = p_user_id and ativo;
+    if found then
+        return v_grupo;
+    end if;
+
+    -- Serializa chamadas concorrentes do mesmo usuário (ex.: dois updates no primeiro acesso)
+    perform pg_advisory_xact_lock(p_user_id);
+    select grupo_id into v_grupo from usuarios where user_id = p_user_id and ativo;
+    if found then
+        return v_grupo;
+    end if;
+
+    -- Membro de grupos, mas nenhum ativo: reativa um deles
+    update usuarios set ativo = true
+     where user_id = p_user_id
+       and grupo_id = (select min(grupo_id) from usuarios where user_id = p_user_id)
+    returning grupo_id into v_grupo;
+    if found then
+        return v_grupo;
+    end if;
+
+    insert into usuarios (user_id, grupo_id, ativo)
+    values (p_user_id, gen_random_uuid()::text, true)
+    returning grupo_id into v_grupo;
+    return v_grupo;
+end $$;
+
+-- Entra (ou volta) no grupo do código de convite e o torna ativo.
+-- Retorna 'invalido', 'ja_ativo', 'reativado' ou 'adicionado'.
+create or replace function entrar_grupo(p_user_id bigint, p_codigo text) returns text
+language plpgsql as $$
+declare
+    v_ativo boolean;
+begin
+    if not exists (select 1 from usuarios where grupo_id = p_codigo) then
+        return 'invalido';
+    end if;
+
+    perform pg_advisory_xact_lock(p_user_id);
+    select ativo into v_ativo from usuarios where user_id = p_user_id and grupo_id = p_codigo;
+    if v_ativo then
+        return 'ja_ativo';
+    end if;
+
+    update usuarios set ativo = false where user_id = p_user_id and ativo;
+    insert into usuarios (user_id, grupo_id, ativo)
+    values (p_user_id, p_codigo, true)
+    on conflict (user_id, grupo_id) do update set ativo = true;
+
+    return case when v_ativo is null then 'adicionado' else 'reativado' end;
+end $$;
+
+-- Troca o grupo ativo entre os grupos de que o usuário já participa
+create or replace function ativar_grupo(p_user_id bigint, p_grupo_id text) returns boolean
+language plpgsql as $$
+begin
+    perform pg_advisory_xact_lock(p_user_id);
+    if not exists (select 1 from usuarios where user_id = p_user_id and grupo_id = p_grupo_id) then
+        return false;
+    end if;
+    update usuarios set ativo = false where user_id = p_user_id and ativo and grupo_id <> p_grupo_id;
+    update usuarios set ativo = true where user_id = p_user_id and grupo_id = p_grupo_id;
+    return true;
+end $$;
@@ -0,0 +1,19 @@
+-- Controle de concorrência otimista: editar/excluir filtram por id + grupo_id + versao
+-- numa única escrita; se outra pessoa mexeu no produto antes, nada é alterado.
+alter table produtos
+    add column if not exists versao integer not null default 1,
+    add column if not exists atualizado_em timestamptz not null default now();
+
+create or replace function incrementar_versao_produto() returns trigger
+language plpgsql as $$
+begin
+    new.versao := old.versao + 1;
+    new.atualizado_em := now();
+    return new;
+end $$;
+
+-- Vale também para o upsert de salvar_produto (ON CONFLICT DO UPDATE)
+drop trigger if exists produtos_versao on produtos;
+create trigger produtos_versao
+    before update on produtos
+    for each row execute function incrementar_versao_produto();
@@ -0,0 +1,20 @@
+-- Edição de preço em lote numa única chamada. Cada item traz a versão lida; linhas
+-- alteradas por outra pessoa no meio do caminho são ignoradas (e não devolvidas).
+-- O id do produto trafega como text, como em estatisticas (0005) e historico_precos (0011).
+drop function if exists atualizar_precos_em_lote(text, jsonb);
+create or replace function atualizar_precos_em_lote(p_grupo_id text, p_itens jsonb)
+returns table (id text)
+language sql as $$
+    update produtos p
+       set preco = i.preco,
+           preco_por_unidade_formatado = i.preco_por_unidade_formatado,
+           preco_unitario_base = i.preco_unitario_base,
+           unidade_base = i.unidade_base
+      from jsonb_to_recordset(p_itens) as i(
+               id text, versao integer, preco numeric, preco_por_unidade_formatado text,
+               preco_unitario_base numeric, unidade_base text)
+     where p.id::text = i.id
+       and p.grupo_id = p_grupo_id
+       and p.versao = i.versao
+    returning p.id::text;
+$$;
@@ -0,0 +1,12 @@
+-- Nome normalizado (sem acento, unidades canônicas, sinônimos aplicados), gravado
+-- pela aplicação em preparar_linha_produto. As buscas usam ilike nesta coluna.
+-- Depois de aplicar, rode na ordem:
+--   python main.py compactar-produtos   (regrava chave_produto com a nova normalização
+--                                        e junta os produtos que passaram a ser iguais)
+--   python main.py recalcular-produtos  (preenche nome_normalizado nas linhas antigas)
+alter table produtos add column if not exists nome_normalizado text;
+
+-- Índice de trigramas para o ilike '%termo%' não varrer a tabela inteira
+create extension if not exists pg_trgm;
+create index if not exists produtos_nome_normalizado_trgm_idx
+    on produtos using gin (nome_normalizado gin_trgm_ops);
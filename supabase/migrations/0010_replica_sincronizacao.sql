@@ -0,0 +1,67 @@
+-- Sincronização da réplica local (REPLICA_LOCAL em main.py): o diário de escritas
+-- chega em lotes e vence a escrita mais recente (atualizado_em).
+
+-- O trigger de versão passa a respeitar um atualizado_em enviado explicitamente
+-- (o da escrita original na réplica); nos demais UPDATEs continua valendo now().
+create or replace function incrementar_versao_produto() returns trigger
+language plpgsql as $$
+begin
+    new.versao := old.versao + 1;
+    if new.atualizado_em is not distinct from old.atualizado_em then
+        new.atualizado_em := now();
+    end if;
+    return new;
+end $$;
+
+-- Insere ou atualiza por (grupo_id, chave_produto), só se a linha recebida for mais nova.
+-- O id não vem da réplica (lá ele é um uuid provisório e o tipo de produtos.id não é
+-- garantido por estas migrações): num produto novo, o banco atribui o seu.
+create or replace function sincronizar_produtos(p_linhas jsonb)
+returns integer
+language sql as $$
+    with aplicadas as (
+        insert into produtos (grupo_id, nome, nome_normalizado, tipo, marca, unidade, preco,
+                              observacoes, preco_por_unidade_formatado, chave_produto,
+                              preco_unitario_base, unidade_base, "timestamp", atualizado_em)
+        select grupo_id, nome, nome_normalizado, tipo, marca, unidade, preco,
+               observacoes, preco_por_unidade_formatado, chave_produto,
+               preco_unitario_base, unidade_base, "timestamp", atualizado_em
+          from jsonb_populate_recordset(null::produtos, p_linhas)
+        on conflict (grupo_id, chave_produto) do update
+           set nome = excluded.nome,
+               nome_normalizado = excluded.nome_normalizado,
+               tipo = excluded.tipo,
+               marca = excluded.marca,
+               unidade = excluded.unidade,
+               preco = excluded.preco,
+               observacoes = excluded.observacoes,
+               preco_por_unidade_formatado = excluded.preco_por_unidade_formatado,
+               preco_unitario_base = excluded.preco_unitario_base,
+               unidade_base = excluded.unidade_base,
+               "timestamp" = excluded."timestamp",
+               atualizado_em = excluded.atualizado_em
+         where produtos.atualizado_em < excluded.atualizado_em
+        returning 1
+    )
+    select count(*)::integer from aplicadas;
+$$;
+
+-- Exclui só se ninguém gravou o produto depois da exclusão. A identidade é a mesma do
+-- upsert acima, (grupo_id, chave_produto): o id gerado na réplica para um produto que
+-- outra instância já tinha criado não é o id do banco.
+create or replace function excluir_produtos_sincronizados(p_exclusoes jsonb)
+returns integer
+language sql as $$
+    with excluidas as (
+        delete from produtos p
+         using jsonb_to_recordset(p_exclusoes) as e(grupo_id text, chave_produto text, atualizado_em timestamptz)
+         where p.grupo_id = e.grupo_id
+           and p.chave_produto = e.chave_produto
+           and p.atualizado_em <= e.atualizado_em
+        returning 1
+    )
+    select count(*)::integer from excluidas;
+$$;
+
+-- Busca incremental da réplica (atualizado_em > marca)
+create index if not exists produtos_grupo_atualizado_idx on produtos (grupo_id, atualizado_em);
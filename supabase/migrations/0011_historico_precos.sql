@@ -0,0 +1,49 @@
+-- Histórico de preços para o /grafico: uma linha por preço gravado (inserção ou
+-- mudança de preço), preenchida por trigger em produtos.
+create table if not exists historico_precos (
+    id bigint generated by default as identity primary key,
+    grupo_id text not null,
+    produto_id text not null,
+    nome text not null,
+    nome_normalizado text,
+    marca text,
+    unidade text,
+    preco numeric not null,
+    preco_unitario_base numeric,
+    unidade_base text,
+    registrado_em timestamptz not null default now()
+);
+
+create index if not exists historico_precos_grupo_nome_idx
+    on historico_precos (grupo_id, nome_normalizado, registrado_em desc);
+-- O /grafico busca por trecho do nome (ilike '%termo%')
+create index if not exists historico_precos_nome_trgm_idx
+    on historico_precos using gin (nome_normalizado gin_trgm_ops);
+
+create or replace function registrar_historico_preco() returns trigger
+language plpgsql as $$
+begin
+    if tg_op = 'INSERT' or new.preco is distinct from old.preco
+       or new.preco_unitario_base is distinct from old.preco_unitario_base then
+        insert into historico_precos
+            (grupo_id, produto_id, nome, nome_normalizado, marca, unidade, preco,
+             preco_unitario_base, unidade_base, registrado_em)
+        values (new.grupo_id, new.id::text, new.nome, new.nome_normalizado, new.marca, new.unidade,
+                new.preco, new.preco_unitario_base, new.unidade_base, new.atualizado_em);
+    end if;
+    return null;
+end $$;
+
+drop trigger if exists produtos_historico on produtos;
+create trigger produtos_historico
+    after insert or update on produtos
+    for each row execute function registrar_historico_preco();
+
+-- Carga inicial: o preço atual de cada produto vira o primeiro ponto do histórico
+insert into historico_precos
+    (grupo_id, produto_id, nome, nome_normalizado, marca, unidade, preco,
+     preco_unitario_base, unidade_base, registrado_em)
+select grupo_id, id::text, nome, nome_normalizado, marca, unidade, preco,
+       preco_unitario_base, unidade_base, atualizado_em
+  from produtos
+ where not exists (select 1 from historico_precos h where h.produto_id = produtos.id::text);
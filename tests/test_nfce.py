@@ -0,0 +1,81 @@
+"""Leitura de NFC-e (/nota) a partir dos XMLs de exemplo em tests/fixtures.
+
+Uso: python -m unittest discover tests   (ou python -m pytest tests)
+"""
+import os
+import sys
+import unittest
+import xml.etree.ElementTree as ET
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(RAIZ, "tests", "fixtures")
+sys.path.insert(0, RAIZ)
+# main.py exige a configuração no import; nenhuma conexão é feita
+for variavel, valor in {
+    "TELEGRAM_BOT_TOKEN": "123:teste",
+    "SUPABASE_URL": "https://teste.supabase.co",
+    "SUPABASE_KEY": "teste",
+    "WEBHOOK_DOMAIN": "https://teste.invalid",
+}.items():
+    os.environ.setdefault(variavel, valor)
+
+import main  # noqa: E402
+
+def ler_fixture(nome: str) -> list:
+    with open(os.path.join(FIXTURES, nome), "rb") as arquivo:
+        return main.ler_produtos_nfce(arquivo.read())
+
+class IterarItensNfceTest(unittest.TestCase):
+    def test_com_namespace(self):
+        itens = list(main.iterar_itens_nfce(os.path.join(FIXTURES, "nfce_com_namespace.xml")))
+        self.assertEqual(len(itens), 3)
+        emitente, item = itens[0]
+        # O xNome do endereço não pode sobrescrever o do emitente
+        self.assertEqual(emitente, "SUPERMERCADO EXEMPLO LTDA")
+        self.assertEqual(item["xProd"], "ARROZ CAMIL   TIPO 1 5KG")
+        self.assertEqual(item["uCom"], "UN")
+        self.assertEqual(item["qCom"], "2.0000")
+        self.assertEqual(item["vUnCom"], "27.90")
+
+    def test_sem_namespace(self):
+        itens = list(main.iterar_itens_nfce(os.path.join(FIXTURES, "nfce_sem_namespace.xml")))
+        self.assertEqual([emitente for emitente, _ in itens], ["MERCADINHO DO BAIRRO"] * 3)
+        self.assertNotIn("uCom", itens[1][1])
+
+class LerProdutosNfceTest(unittest.TestCase):
+    def test_com_namespace(self):
+        arroz, banana, leite = ler_fixture("nfce_com_namespace.xml")
+        self.assertEqual(arroz["nome"], "Arroz Camil Tipo 1 5Kg")
+        self.assertEqual(arroz["unidade"], "5 kg")
+        self.assertEqual(arroz["preco"], 27.90)
+        self.assertEqual(arroz["observacoes"], "NFC-e Supermercado Exemplo Ltda (2 un)")
+        # A granel: o preço unitário já é por kg e a quantidade vai para a observação
+        self.assertEqual(banana["unidade"], "1 kg")
+        self.assertEqual(banana["preco"], 5.99)
+        self.assertEqual(banana["observacoes"], "NFC-e Supermercado Exemplo Ltda (1.234 kg)")
+        self.assertEqual(leite["unidade"], "1 L")
+        self.assertEqual(leite["preco"], 4.79)
+        self.assertEqual(leite["observacoes"], "NFC-e Supermercado Exemplo Ltda")
+
+    def test_sem_namespace_igual_ao_com_namespace(self):
+        com_ns = ler_fixture("nfce_com_namespace.xml")[0]
+        sem_ns = ler_fixture("nfce_sem_namespace.xml")[0]
+        self.assertEqual({**com_ns, "observacoes": None}, {**sem_ns, "observacoes": None})
+
+    def test_item_sem_unidade(self):
+        produtos = ler_fixture("nfce_sem_namespace.xml")
+        pao = next(p for p in produtos if p["nome"] == "Pao De Queijo Congelado")
+        self.assertEqual(pao["unidade"], "1 und")
+        self.assertEqual(pao["preco"], 12.50)
+
+    def test_item_sem_preco_e_ignorado(self):
+        nomes = [p["nome"] for p in ler_fixture("nfce_sem_namespace.xml")]
+        self.assertNotIn("Brinde Sacola", nomes)
+        self.assertIsNone(main.item_nfce_para_produto({"xProd": "", "vUnCom": "1.00"}))
+
+    def test_xml_malformado(self):
+        with self.assertRaises(ET.ParseError):
+            ler_fixture("nfce_malformada.xml")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""Identidade de produto: normalizar_campo_produto, SINONIMOS e chave_produto.
+
+A chave decide quais linhas o compactar-produtos junta (e apaga); os casos de
+"não juntar" aqui valem tanto quanto os de "juntar".
+
+Uso: python -m unittest discover tests   (ou python -m pytest tests)
+"""
+import os
+import sys
+import unittest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+# main.py exige a configuração no import; nenhuma conexão é feita
+for variavel, valor in {
+    "TELEGRAM_BOT_TOKEN": "123:teste",
+    "SUPABASE_URL": "https://teste.supabase.co",
+    "SUPABASE_KEY": "teste",
+    "WEBHOOK_DOMAIN": "https://teste.invalid",
+}.items():
+    os.environ.setdefault(variavel, valor)
+
+import main  # noqa: E402
+
+normalizar = main.normalizar_campo_produto
+
+class NormalizarCampoProdutoTest(unittest.TestCase):
+    def test_acentos_e_maiusculas(self):
+        self.assertEqual(normalizar("Feijão Preto"), "feijao preto")
+        self.assertEqual(normalizar("AÇÚCAR Refinado"), "acucar refinado")
+        self.assertEqual(normalizar("Detergente Ypê"), "detergente ype")
+
+    def test_vazio(self):
+        self.assertEqual(normalizar(None), "")
+        self.assertEqual(normalizar(""), "")
+        self.assertEqual(normalizar(" - "), "")
+
+    def test_unidades(self):
+        self.assertEqual(normalizar("1 Litro"), "1l")
+        self.assertEqual(normalizar("1,5 L"), "1.5l")
+        self.assertEqual(normalizar("1.5l"), "1.5l")
+        self.assertEqual(normalizar("500 Gramas"), "500g")
+        self.assertEqual(normalizar("2 Kg"), "2kg")
+        self.assertEqual(normalizar("12 un"), "12und")
+
+    def test_quantidades_diferentes_nao_se_juntam(self):
+        self.assertNotEqual(normalizar("1 L"), normalizar("1,5 L"))
+        self.assertNotEqual(normalizar("1 kg"), normalizar("1 g"))
+
+    def test_coca_cola(self):
+        self.assertEqual(normalizar("Coca-Cola"), "coca cola")
+        self.assertEqual(normalizar("CocaCola"), "coca cola")
+        self.assertEqual(normalizar("Coca Cola Zero 2L"), "coca cola zero 2l")
+
+    def test_sinonimos_de_varias_palavras(self):
+        self.assertEqual(normalizar("Sab. em pó"), "sabao em po")
+        self.assertEqual(normalizar("Papel Hig."), "papel higienico")
+        self.assertEqual(normalizar("leite cond. Moça"), "leite condensado moca")
+
+    def test_sem_sinonimo_amplo(self):
+        # "coca" sozinho não vira "coca cola": coca zero e coca cola zero são produtos distintos
+        self.assertEqual(normalizar("Coca"), "coca")
+        self.assertNotEqual(normalizar("coca zero"), normalizar("coca cola zero"))
+
+class ChaveProdutoTest(unittest.TestCase):
+    def test_grafias_diferentes_mesma_chave(self):
+        self.assertEqual(
+            main.chave_produto("Coca-Cola", "Refrigerante", "Coca Cola", "2 Litros"),
+            main.chave_produto("CocaCola", "refrigerante", "coca-cola", "2L"),
+        )
+
+    def test_campos_nao_se_misturam(self):
+        # O separador mantém cada campo no seu lugar
+        self.assertNotEqual(main.chave_produto("Arroz", "Tipo 1", "", "5 kg"),
+                            main.chave_produto("Arroz Tipo 1", "", "", "5 kg"))
+
+    def test_marcas_diferentes(self):
+        self.assertNotEqual(main.chave_produto("Arroz", "Grão", "Camil", "5 kg"),
+                            main.chave_produto("Arroz", "Grão", "Tio João", "5 kg"))
+
+if __name__ == "__main__":
+    unittest.main()